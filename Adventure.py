@@ -1,23 +1,32 @@
 #Louis Ye
 #Block 5
 from graphics3d import *
+from maze import WallGrid, VisibilityTable, TiledMap, TiledWallGrid, isTiledMap
+import collections, hashlib, math
 
-makeGraphicsWindow(1024, 600)
-mapAdventure = open("map.txt", "r")
-loadTexture("scary-wall.jpg")
-#http://smg.photobucket.com/user/totorojonathan/media/brick01_zps778348bb.jpg.html
-loadTexture("XxhFVCZ.jpg")
-#http://i.imgur.com/XxhFVCZ.jpg
-loadTexture("character_217_demonuvwmap.jpg")
-#https://kevinwtaylor.files.wordpress.com/2011/09/character_217_demonuvwmap.jpg
-scare = loadImage("scare.png")
-#https://i.ytimg.com/vi/b8qolupfhkQ/maxresdefault.jpg
-breath = loadSound("breathing.wav")
-#https://www.youtube.com/watch?v=jSyIGm7dNb4
-fun = loadSound("scare.wav", 1.0)
-#https://www.youtube.com/watch?v=Uufq_PFXbpA
-player = loadImage("triangle.png")
-#http://etc.usf.edu/clipart/36900/36972/isoc_tri_040_36972_lg.gif
+mapFilename = "map.txt"
+breath = None
+fun = None
+
+# the game can also be imported (benchmark.py does), so nothing is loaded until the window is made
+# sounds=False leaves breath and fun as None, and the game runs silently
+def loadResources(sounds=True):
+    global scare, breath, fun, player
+    loadTexture("scary-wall.jpg")
+    #http://smg.photobucket.com/user/totorojonathan/media/brick01_zps778348bb.jpg.html
+    loadTexture("XxhFVCZ.jpg")
+    #http://i.imgur.com/XxhFVCZ.jpg
+    loadTexture("character_217_demonuvwmap.jpg")
+    #https://kevinwtaylor.files.wordpress.com/2011/09/character_217_demonuvwmap.jpg
+    scare = loadImage("scare.png")
+    #https://i.ytimg.com/vi/b8qolupfhkQ/maxresdefault.jpg
+    if sounds:
+        breath = loadSound("breathing.wav")
+        #https://www.youtube.com/watch?v=jSyIGm7dNb4
+        fun = loadSound("scare.wav", 1.0)
+        #https://www.youtube.com/watch?v=Uufq_PFXbpA
+    player = loadImage("triangle.png")
+    #http://etc.usf.edu/clipart/36900/36972/isoc_tri_040_36972_lg.gif
 
 class Place:
     def __init__ (self, x, z):
@@ -74,16 +83,19 @@ class Monster:
     def __init__ (self, x, z):
         self.velocity = Vector(0.4, 0.4)
         self.location = Place(x, z)
-        self.model = ObjModel3D("Models/marionette.obj", stats=True)
+        self.previousLocation = (x, z)
+        self.model = ObjModel3D("Models/marionette.obj", stats=True, lod=4)
         
     def update(self, characterx, characterz, world):
+        self.previousLocation = (self.location.x, self.location.z)
         character = Place(characterx, characterz)
         characterVector = self.location.makeVectorTo(character)
         characterVector.multiply(0.15)
         self.velocity.add(characterVector)
         speed = 0.15
         volume = 1.0 - (self.location.distance(character) / 60.0)
-        breath.set_volume(volume)                    
+        if breath is not None:
+            breath.set_volume(volume)
         if self.location.distance(character) > 50:
             speed = 1
         if self.velocity.length() > speed:
@@ -98,26 +110,143 @@ class Monster:
        
     
     def draw(self):
-        draw3D(self.model, self.location.x, -1, self.location.z, angley = self.angle - 195, scale = 0.035)        
+        # draw the monster between its last two updates, since frames and updates are not in step
+        alpha = getInterpolationAlpha()
+        (previousx, previousz) = self.previousLocation
+        x = previousx + (self.location.x - previousx) * alpha
+        z = previousz + (self.location.z - previousz) * alpha
+        draw3D(self.model, x, -1, z, angley = self.angle - 195, scale = 0.035)        
+        
+class Minimap:
+    # the whole map is drawn once, one pixel per cell, into self.map
+    # each frame only the window of cells around the player is scaled up into self.canvas
+    def __init__ (self, wallList, cellSize=7, radius=10):
+        self.cellSize = cellSize
+        self.radius = radius
+        self.margin = radius + 2
+        self.canvas = Canvas2D(2*radius*cellSize, 2*radius*cellSize, 1.0)
+        mapWidth = max([x for (x, z) in wallList]) + 1
+        mapHeight = max([z for (x, z) in wallList]) + 1
+        self.map = Canvas2D(mapWidth + 2*self.margin, mapHeight + 2*self.margin, 1.0)
+        # the map cell that is drawn at (margin, margin) in self.map
+        self.originx = 0
+        self.originz = 0
+        clearCanvas2D(self.map, 'black')
+        for (x, z) in wallList:
+            drawPoint2D(self.map, x + self.margin, z + self.margin, 'white')
+        self.lastState = None
+        
+    def update (self, x, z, heading, monsterx, monsterz):
+        cells = 2*self.radius + 2
+        left = int(math.floor(x)) - self.radius
+        top = int(math.floor(z)) - self.radius
+        center = self.canvas.width / 2
+        offsetx = int(center + self.cellSize*(left - x))
+        offsetz = int(center + self.cellSize*(top - z))
+        minimonsterx = int(center + self.cellSize*(monsterx - x))
+        minimonsterz = int(center + self.cellSize*(monsterz - z))
+        # nothing moved by a whole pixel, so the canvas already shows this frame
+        state = (left, top, offsetx, offsetz, int(heading), minimonsterx, minimonsterz)
+        if state == self.lastState:
+            return
+        self.lastState = state
+        region = getImageRegion(self.map.image, left - self.originx + self.margin, top - self.originz + self.margin, cells, cells)
+        window = resizeImage(region, cells*self.cellSize, cells*self.cellSize)
+        drawImage2D(self.canvas, window, offsetx + window.get_width()/2, offsetz + window.get_height()/2)
+        drawImage2D(self.canvas, player, center, center, rotate = heading, scale = 0.02)
+        fillCircle2D(self.canvas, minimonsterx, minimonsterz, 4, "white")
+
+# A Minimap for a TiledMap: self.map only holds the 3 by 3 tiles around the player,
+# and is drawn again when the player walks onto another tile.
+class TiledMinimap(Minimap):
+    def __init__ (self, tiledMap, cellSize=7, radius=10):
+        self.tiledMap = tiledMap
+        self.cellSize = cellSize
+        self.radius = radius
+        self.margin = radius + 2
+        self.canvas = Canvas2D(2*radius*cellSize, 2*radius*cellSize, 1.0)
+        self.map = Canvas2D(3*tiledMap.tileSize + 2*self.margin, 3*tiledMap.tileSize + 2*self.margin, 1.0)
+        self.centerTile = None
+        self.lastState = None
+
+    def update (self, x, z, heading, monsterx, monsterz):
+        tileSize = self.tiledMap.tileSize
+        tile = (int(math.floor(x)) // tileSize, int(math.floor(z)) // tileSize)
+        if tile != self.centerTile:
+            self.centerTile = tile
+            self.originx = (tile[0] - 1) * tileSize
+            self.originz = (tile[1] - 1) * tileSize
+            clearCanvas2D(self.map, 'black')
+            for tilez in range(tile[1] - 1, tile[1] + 2):
+                for tilex in range(tile[0] - 1, tile[0] + 2):
+                    for (wallx, wallz) in self.tiledMap.getTile(tilex, tilez):
+                        drawPoint2D(self.map, wallx - self.originx + self.margin, wallz - self.originz + self.margin, 'white')
+            self.lastState = None
+        Minimap.update(self, x, z, heading, monsterx, monsterz)
+
+# Draws the walls of a TiledMap: the walls of each tile near the camera are baked into a
+# StaticBatch3D when the camera first comes within radius of the tile, and the batches of the
+# tiles that were near the camera longest ago are deleted once there are more than maxBatches.
+# At most bakesPerFrame tiles are baked in one frame, nearest first, so walking onto a new
+# part of the map spreads the work over a few frames (radius reaches past the fog, so the
+# tiles that wait are not visible yet).
+class StreamedWalls:
+    def __init__ (self, wall, tiledMap, radius=64, maxBatches=64, bakesPerFrame=1):
+        self.wall = wall
+        self.tiledMap = tiledMap
+        self.radius = radius
+        self.maxBatches = maxBatches
+        self.bakesPerFrame = bakesPerFrame
+        self.batches = collections.OrderedDict()    # key = tile, value = StaticBatch3D, oldest first
+
+    def draw (self, x, z):
+        bakes = 0
+        for tile in self.tiledMap.tilesNear(x, z, self.radius):
+            if tile in self.batches:
+                batch = self.batches.pop(tile)
+            elif bakes < self.bakesPerFrame:
+                walls = self.tiledMap.getTile(*tile)
+                batch = StaticBatch3D(self.wall, [(wallX, 1, wallZ) for (wallX, wallZ) in walls], chunkSize=10)
+                bakes += 1
+            else:
+                continue
+            self.batches[tile] = batch
+            draw3D(batch)
+        while len(self.batches) > self.maxBatches:
+            (tile, batch) = self.batches.popitem(False)
+            batch.delete()
+
+    def delete (self):
+        for batch in self.batches.values():
+            batch.delete()
+        self.batches = collections.OrderedDict()
         
         
 def startWorld(world):
     world.run = True
     world.stamina = 0
     world.screen = Canvas2D(1200, 600, 1.0)
-    world.minimap = Canvas2D(140, 140, 1.0)
     world.kill = False
     world.wall = Box3D(1, 5, 1, texture = "scary-wall.jpg")
     world.floor = Rect3D(500, 500, texture="character_217_demonuvwmap.jpg", textureRepeat = 70)
     world.sky = Hemisphere3D(500, 24, texture="XxhFVCZ.jpg")
     counterz = 0
-    world.goal = Sphere3D(1, colors=["gray", "black"])
+    world.goal = Sphere3D(1, colors=["gray", "black"], lod=2)
     world.wallList = []
     world.win = False
-    world.wallRadar = []
     
     setWindowTitle("The Maze")
-    for mapLine in mapAdventure:
+    enableFogCulling(True)
+    # movement, stamina and the monster are tuned per update, so keep them at 60 updates per second
+    setFixedTimestep(60)
+    if isTiledMap(mapFilename):
+        startTiledWorld(world)
+        return
+    world.tiledMap = None
+    mapAdventure = open(mapFilename, "r")
+    mapLines = mapAdventure.readlines()
+    mapAdventure.close()
+    for mapLine in mapLines:
         counterz += 1
         counterx = 0
         for character in mapLine:
@@ -131,9 +260,31 @@ def startWorld(world):
             if character == 'W':
                 world.winx = counterx
                 world.winz = counterz
+    world.wallGrid = WallGrid(world.wallList)
+    world.walls = StaticBatch3D(world.wall, [(wallX, 1, wallZ) for (wallX, wallZ) in world.wallList], chunkSize=10)
+    mapWidth = max([len(mapLine) for mapLine in mapLines])
+    world.visibility = VisibilityTable(world.wallGrid, mapWidth, len(mapLines), 30)
+    world.visibility.build(mapFilename + ".pvs", hashlib.md5("".join(mapLines)).hexdigest())
+    world.minimap = Minimap(world.wallList)
+
+# a tiled map (made with python maze.py map.txt map.tiles) is streamed in as the player moves,
+#  so there is no wall list or visibility table, and the fog hides the walls that are not loaded yet
+def startTiledWorld(world):
+    world.tiledMap = TiledMap(mapFilename)
+    (startx, startz) = world.tiledMap.start
+    setCameraPosition(startx, 1, startz)
+    world.monster = Monster(*world.tiledMap.monster)
+    (world.winx, world.winz) = world.tiledMap.goal
+    world.wallList = None
+    world.visibility = None
+    world.wallGrid = TiledWallGrid(world.tiledMap)
+    world.walls = StreamedWalls(world.wall, world.tiledMap)
+    world.minimap = TiledMinimap(world.tiledMap)
 
 
 def updateWorld(world):
+    # drawWorld draws the camera between where it was before this update and where it is after it
+    world.previousCamera = (getCameraPosition(), getCameraRotation())
     (mouseX, mouseY) = getMousePosition()    
     (cameraHeading, cameraPitch, cameraRoll) = getCameraRotation()
     moveMouse(getWindowWidth()/2, getWindowHeight()/2)
@@ -174,15 +325,7 @@ def updateWorld(world):
     (newx, newy, newz) = getCameraPosition()
     
     def inWall(x, y, z):
-        for wall in world.wallList:
-            (xcoord, zcoord) = wall
-            upperBoundx = xcoord - 0.7
-            lowerBoundx = xcoord + 0.7
-            upperBoundz = zcoord - 0.7
-            lowerBoundz = zcoord + 0.7
-            if x > upperBoundx and x < lowerBoundx and z > upperBoundz and z < lowerBoundz:
-                return True
-        return False
+        return world.wallGrid.inWall(x, z)
     
     if inWall(newx, oldy, newz) == True:
         if inWall(oldx, oldy, newz) == True:
@@ -205,15 +348,6 @@ def updateWorld(world):
             return True
         return False
     
-    def radar(x, z, otherx, otherz):
-        upperBoundx = otherx - 10
-        lowerBoundx = otherx + 10
-        upperBoundz = otherz - 10
-        lowerBoundz = otherz + 10
-        if x > upperBoundx and x < lowerBoundx and z > upperBoundz and z < lowerBoundz:
-            return True
-        return False    
-    
     if kill(finalx, finalz, world.monster.location.x, world.monster.location.z) == True:
         setCameraPosition(oldx, oldy, oldz)
         world.kill = True
@@ -221,72 +355,62 @@ def updateWorld(world):
     if kill(finalx, finalz, world.winx, world.winz) == True:
         setCameraPosition(oldx, oldy, oldz)
         world.win = True
-        
-    (x, y, z) = getCameraPosition()
-    world.monsterx -= x
-    world.monsterz -= z
-    world.wallRadar = []
-    for walls in world.wallList:
-        (xcoord, zcoord) = walls
-        if radar(x, z ,xcoord, zcoord) == True:
-            world.wallRadar.append((xcoord - x, zcoord - z))
             
     
                     
 
-# Return boolean
-def inRange(camX, camZ, wallX, wallZ):
-    deltax = camX - wallX
-    deltaz = camZ - wallZ
-    distance = (deltax**2 + deltaz**2)**0.5
-    if distance < 30:
-        return True
-    else:
-        return False
-
 def drawWorld(world):
-    playSound(breath, True)
+    if breath is not None:
+        playSound(breath, True)
+    # draw the camera between its last two updates, like the monster
+    alpha = getInterpolationAlpha()
+    ((previousx, previousy, previousz), (previousHeading, previousPitch, previousRoll)) = world.previousCamera
+    (x, y, z) = getCameraPosition()
+    (heading, pitch, roll) = getCameraRotation()
+    setFrameCamera(previousx + (x - previousx) * alpha, previousy + (y - previousy) * alpha,
+                   previousz + (z - previousz) * alpha, previousHeading + (heading - previousHeading) * alpha,
+                   previousPitch + (pitch - previousPitch) * alpha, roll)
     makeFog(0.1, (0, 0, 0), 1)
-    (camX, camY, camZ) = getCameraPosition()    
-    for wall in world.wallList:
-        (wallX, wallZ) = wall
-        if inRange(camX, camZ, wallX, wallZ) == True:       
-            draw3D(world.wall, wallX, 1, wallZ)
-    draw3D(world.floor, 0, -1, 0, 90)
+    (camX, camY, camZ) = getCameraPosition()
+    if world.tiledMap is None:
+        world.walls.setVisibleChunks(world.visibility.visibleChunks(camX, camZ, world.walls.chunkSize))
+        draw3D(world.walls)
+    else:
+        world.walls.draw(camX, camZ)
+    # the floor and the sky follow the camera, so they still reach around it far out on a large map
+    # (the floor moves in whole texture tiles, so it looks like it stays still)
+    floorTile = 500.0 / 70
+    draw3D(world.floor, round(camX / floorTile) * floorTile, -1, round(camZ / floorTile) * floorTile, 90)
     removeFog()
     makeFog(0.002, (0, 0, 0), 1)
-    draw3D(world.sky, 0, 0, 0)    
+    draw3D(world.sky, camX, 0, camZ)
     world.monster.draw()
     draw3D(world.goal, world.winx, 1, world.winz)
     
-    clearCanvas2D(world.minimap, 'black')
-    for wall in world.wallRadar:
-        (wallx, wally) = wall
-        minix = 70 + 7*wallx
-        miniy = 70 + 7*wally
-        drawRectangle2D(world.minimap, minix, miniy, 7, 7, "white")
     (cameraHeading, cameraPitch, cameraRoll) = getCameraRotation()    
-    drawImage2D(world.minimap, player, 70, 70, rotate = cameraHeading, scale = 0.02)
-    minimonsterx = 70 + 7*world.monsterx
-    minimonsterz = 70 + 7*world.monsterz
-    fillCircle2D(world.minimap, minimonsterx, minimonsterz, 4,"white")
-    draw2D(world.minimap, 0, 460)
+    world.minimap.update(camX, camZ, cameraHeading, world.monster.location.x, world.monster.location.z)
+    draw2D(world.minimap.canvas, 0, 460)
     
     if world.kill == True:
         clearCanvas2D(world.screen, 'black')
         drawImage2D(world.screen, scare, 600, 300)
         drawString2D(world.screen, "You Lose", 400, 200, size=100, color="red")
         draw2D(world.screen, 0, 0)
-        stopSound(breath)
-        playSound(fun, False)
+        if breath is not None:
+            stopSound(breath)
+            playSound(fun, False)
         
     if world.kill == False:
-        drawString2D(world.screen, "Run Away from the Monster", 400, 10, size=40, color="red")
-        drawString2D(world.screen, "Shift to Run, WASD to move", 450, 35, size=20, color="red")
-        draw2D(world.screen, 0, 0)
+        drawText3DOverlay("Run Away from the Monster", 400, 10, size=40, color="red")
+        drawText3DOverlay("Shift to Run, WASD to move", 450, 35, size=20, color="red")
+        if world.win == True:
+            draw2D(world.screen, 0, 0)
     if world.win == True:
         clearCanvas2D(world.screen, 'gray')
         drawString2D(world.screen, "You Win!", 400, 200, size=100, color="white")
     
         
-runGraphics(startWorld, updateWorld, drawWorld)
\ No newline at end of file
+if __name__ == "__main__":
+    makeGraphicsWindow(1024, 600)
+    loadResources()
+    runGraphics(startWorld, updateWorld, drawWorld)
\ No newline at end of file
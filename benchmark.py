@@ -0,0 +1,457 @@
+#Scripted benchmarks for graphics3d and the maze game.
+#Each scenario loads its models (timed as its load time) and then draws a fixed number of
+#frames as fast as possible, while the frame profiler records the frame times and GL work.
+#The results are written as JSON, and can be compared with an earlier run:
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --baseline baseline.json --output current.json
+#The comparison fails (exit status 1) when the load time or the median or 95th percentile
+#frame time of a scenario got slower by more than the tolerance.
+#--scaling runs the game instead on maps made by mazegen.py that are 1, 10 and 100 times the area
+#of map.txt (or --sizes), and plots how the frame and load times grow with the size of the map:
+#   python benchmark.py --scaling backtracker,rooms,field --plot scaling.png
+#The maps are kept in --mapdir with their visibility caches, which take tens of minutes to compute
+#for the largest maps the first time. --tiled runs them as tiled maps (see TiledMap in maze.py),
+#which are streamed in around the camera instead.
+import argparse, collections, csv, json, math, os, sys, time
+
+parser = argparse.ArgumentParser(description="Runs the graphics3d benchmarks.")
+parser.add_argument("--frames", type=int, default=300, help="frames measured in each scenario")
+parser.add_argument("--warmup", type=int, default=30, help="frames drawn before measuring each scenario")
+parser.add_argument("--scenarios", default=None, help="comma separated names of the scenarios to run")
+parser.add_argument("--output", default=None, help="JSON file for the results (printed if not given)")
+parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown, 0.10 is 10%%")
+parser.add_argument("--headless", default=None, choices=["osmesa", "egl", "hidden"], help="draw without a window")
+parser.add_argument("--scaling", default=None, help="comma separated mazegen.py styles of maps to run the game on")
+parser.add_argument("--sizes", default="1,10,100", help="areas of the --scaling maps, in times the area of map.txt")
+parser.add_argument("--mapdir", default="scalingmaps", help="folder for the --scaling maps")
+parser.add_argument("--tiled", action="store_true", help="convert the --scaling maps to tiled maps")
+parser.add_argument("--plot", default=None, help="image (or .csv file without matplotlib) of the --scaling results")
+arguments = parser.parse_args()
+if arguments.warmup < 1:
+    parser.error("--warmup has to be at least 1 frame")
+
+# osmesa and egl have to be chosen before graphics3d imports OpenGL
+if arguments.headless is not None:
+    os.environ["GRAPHICS3D_HEADLESS"] = arguments.headless
+from graphics3d import *
+import Adventure
+
+try:
+    import resource
+except ImportError:
+    resource = None     # Windows
+
+# the largest resident set size of the process so far in megabytes, or None where it cannot be found
+def getPeakMemory():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)     # bytes on Mac OS
+    return peak / 1024.0                    # kilobytes on Linux
+
+
+#########################################################
+
+# A benchmark scenario: start() loads what it needs and is timed as the load time,
+# then update() and draw() are called once for each frame.
+class Scenario:
+    name = ""
+
+    def start(self):
+        pass
+
+    def update(self, frame):
+        pass
+
+    def draw(self, frame):
+        pass
+
+    def finish(self):
+        pass
+
+# Flies through a maze along the shortest path from the start to the goal, with the game's own
+# updateWorld (collisions and the monster) and drawWorld. group names the set of maps a map belongs
+# to in a --scaling run.
+class MazeScenario(Scenario):
+    name = "maze"
+
+    def __init__(self, mapFilename="map.txt", name="maze", group=None):
+        self.mapFilename = mapFilename
+        self.name = name
+        self.group = group
+
+    def start(self):
+        Adventure.loadResources(sounds=False)
+        Adventure.mapFilename = self.mapFilename
+        self.world = World()
+        Adventure.startWorld(self.world)
+        # one update per frame, so the path is the same however fast the frames are
+        setFixedTimestep(0)
+        (startx, starty, startz) = getCameraPosition()
+        self.startCell = (int(round(startx)), int(round(startz)))
+        self.monsterStart = (self.world.monster.location.x, self.world.monster.location.z)
+        # the path is found in the first (warmup) frame, so it is not part of the load time
+        self.path = None
+        self.position = 0.0
+
+    # returns the list of cells from start to goal, walking only on floor cells inside the map,
+    #  or just [start] if the goal cannot be reached
+    def findPath(self, start, goal):
+        wallGrid = self.world.wallGrid
+        if self.world.tiledMap is None:
+            (width, height) = (self.world.visibility.width, self.world.visibility.height)
+        else:
+            (width, height) = (self.world.tiledMap.width, self.world.tiledMap.height)
+        previous = {start: None}
+        queue = collections.deque([start])
+        while len(queue) > 0:
+            cell = queue.popleft()
+            if cell == goal:
+                break
+            (cellx, cellz) = cell
+            for neighbor in ((cellx+1, cellz), (cellx-1, cellz), (cellx, cellz+1), (cellx, cellz-1)):
+                if (neighbor not in previous and 1 <= neighbor[0] <= width and 1 <= neighbor[1] <= height
+                        and not wallGrid.isWall(*neighbor)):
+                    previous[neighbor] = cell
+                    queue.append(neighbor)
+        if goal not in previous:
+            return [start]
+        path = []
+        cell = goal
+        while cell is not None:
+            path.append(cell)
+            cell = previous[cell]
+        path.reverse()
+        return path
+
+    def update(self, frame):
+        if self.path is None:
+            self.path = self.findPath(self.startCell, (self.world.winx, self.world.winz))
+        # 0.2 cells per frame, the walking speed of the game, and back to the start at the end of the path
+        self.position = (self.position + 0.2) % len(self.path)
+        index = int(self.position)
+        (cellx, cellz) = self.path[index]
+        (nextx, nextz) = self.path[min(index + 1, len(self.path) - 1)]
+        fraction = self.position - index
+        x = cellx + (nextx - cellx) * fraction
+        z = cellz + (nextz - cellz) * fraction
+        setCameraPosition(x, 1, z)
+        Adventure.updateWorld(self.world)
+        # the game never ends, so the frames keep drawing the maze instead of the end screens:
+        #  a monster that caught the camera goes back to where it started, to chase it again
+        if self.world.kill:
+            self.world.monster.location = Adventure.Place(*self.monsterStart)
+            self.world.monster.previousLocation = self.monsterStart
+        self.world.kill = False
+        self.world.win = False
+        # the path decides where the camera looks, not the mouse
+        if (nextx, nextz) != (cellx, cellz):
+            setCameraRotation(cartesianToPolarAngle(nextx - cellx, nextz - cellz), 0, 0)
+
+    def draw(self, frame):
+        Adventure.drawWorld(self.world)
+
+    def getResults(self):
+        results = {'map': self.mapFilename, 'group': self.group, 'pathLength': len(self.path)}
+        tiledMap = self.world.tiledMap
+        if tiledMap is None:
+            wallList = self.world.wallList
+            results.update({'mapWidth': max([x for (x, z) in wallList]), 'mapHeight': max([z for (x, z) in wallList]),
+                            'walls': len(wallList)})
+        else:
+            results.update({'mapWidth': tiledMap.width, 'mapHeight': tiledMap.height, 'walls': None,
+                            'tilesLoaded': tiledMap.loadCount, 'wallBatches': len(self.world.walls.batches)})
+        return results
+
+    def finish(self):
+        removeFog()
+        enableFogCulling(False)
+        setWindowTitle("benchmark")
+        if self.world.tiledMap is not None:
+            self.world.walls.delete()
+            self.world.tiledMap.close()
+
+# A grid of spheres in front of the camera, which turns slowly so culling changes from frame to frame.
+class SphereScenario(Scenario):
+    name = "spheres"
+
+    def start(self):
+        self.spheres = [Sphere3D(0.5, 24, colors=["red", "white"]), Sphere3D(0.5, 12, texture="XxhFVCZ.jpg")]
+        setCameraPosition(0, 0, 0)
+
+    def update(self, frame):
+        setCameraRotation(math.sin(frame * 0.02) * 30, 0, 0)
+
+    def draw(self, frame):
+        for row in range(20):
+            for column in range(20):
+                draw3D(self.spheres[(row + column) % 2], column*2 - 19, row*2 - 19, -30)
+
+# A 128 by 128 height field seen from above as the camera circles around it.
+class TerrainScenario(Scenario):
+    name = "terrain"
+
+    def start(self):
+        heights = [[math.sin(x * 0.15) * math.cos(z * 0.1) * 4 for z in range(129)] for x in range(129)]
+        self.terrain = Terrain3D(heights, 1, texture="character_217_demonuvwmap.jpg", textureRepeat=16)
+
+    def update(self, frame):
+        angle = frame * 0.5
+        (dx, dz) = polarToCartesian(angle, 100)
+        setCameraPosition(64 - dx, 40, 64 - dz)
+        setCameraRotation(angle, -25, 0)
+
+    def draw(self, frame):
+        draw3D(self.terrain, 0, 0, 0)
+
+# Loads the marionette without its cache and then from it (both are also reported on their own),
+# then draws a crowd of them.
+class ModelScenario(Scenario):
+    name = "model"
+
+    def start(self):
+        filename = os.path.join(os.path.dirname(os.path.abspath(Adventure.__file__)), "Models", "marionette.obj")
+        startTime = time.time()
+        ObjModel3D(filename, stats=False, cache=False)
+        self.coldLoadTime = time.time() - startTime
+        ObjModel3D(filename, stats=False)         # writes the cache if there is none yet
+        startTime = time.time()
+        self.model = ObjModel3D(filename, stats=False)
+        self.warmLoadTime = time.time() - startTime
+        setCameraPosition(0, 3, 12)
+        setCameraRotation(0, 0, 0)
+
+    def draw(self, frame):
+        for row in range(6):
+            for column in range(8):
+                draw3D(self.model, column*3 - 10.5, 0, -row*4, angley=frame*2 + column*30, scale=0.035)
+
+    def getResults(self):
+        return {'coldLoadTime': self.coldLoadTime, 'warmLoadTime': self.warmLoadTime}
+
+# Redraws a full screen Canvas2D every frame, so it is uploaded as a texture every frame.
+class CanvasScenario(Scenario):
+    name = "canvas"
+
+    def start(self):
+        self.canvas = Canvas2D(getWindowWidth(), getWindowHeight(), 1.0)
+
+    def draw(self, frame):
+        clearCanvas2D(self.canvas, "black")
+        for index in range(50):
+            fillCircle2D(self.canvas, (frame*7 + index*37) % self.canvas.width, (index*53) % self.canvas.height, 20, "red")
+        fillRectangle2D(self.canvas, frame % self.canvas.width, 100, 80, 80, "white")
+        draw2D(self.canvas, 0, 0)
+
+# Draws text that changes every frame, which renders it with pygame fonts and uploads it again.
+class TextScenario(Scenario):
+    name = "text"
+
+    def start(self):
+        self.canvas = Canvas2D(getWindowWidth(), getWindowHeight(), 1.0)
+
+    def draw(self, frame):
+        clearCanvas2D(self.canvas, "clear")
+        for line in range(20):
+            drawString2D(self.canvas, "frame " + str(frame) + " line " + str(line), 10, line*28, size=24, color="white")
+        draw2D(self.canvas, 0, 0)
+
+SCENARIOS = [MazeScenario, SphereScenario, TerrainScenario, ModelScenario, CanvasScenario, TextScenario]
+
+
+#########################################################
+
+# the results of each scenario, in the order they ran
+results = collections.OrderedDict()
+
+def startBenchmark(world):
+    setFrameRate(0)
+    world.scenarios = list(scenarios)
+    world.scenario = None
+    nextScenario(world)
+
+def nextScenario(world):
+    if world.scenario is not None:
+        world.scenario.finish()
+    if len(world.scenarios) == 0:
+        world.scenario = None
+        endGraphics()
+        return
+    world.scenario = world.scenarios.pop(0)
+    world.frame = 0
+    print "running " + world.scenario.name
+    startTime = time.time()
+    world.scenario.start()
+    world.loadTime = time.time() - startTime
+
+def updateBenchmark(world):
+    if world.scenario is None:
+        return
+    if world.frame == arguments.warmup + arguments.frames:
+        saveResults(world)
+        enableProfiler(False)
+        nextScenario(world)
+        if world.scenario is None:
+            return
+    # the profiler is turned on in the middle of the frame before the measured ones, and
+    #  keeps only the last arguments.frames samples, so that partly measured frame is dropped
+    if world.frame == arguments.warmup - 1:
+        enableProfiler(True, arguments.frames)
+    world.scenario.update(world.frame)
+
+def drawBenchmark(world):
+    if world.scenario is None:
+        return
+    world.scenario.draw(world.frame)
+    world.frame += 1
+
+def saveResults(world):
+    stats = getProfilerStats()
+    scenarioResults = {'loadTime': world.loadTime, 'frames': arguments.frames,
+                       'frameTime': stats['frame'], 'phases': dict(), 'counters': dict()}
+    for phase in FrameProfiler.phases:
+        scenarioResults['phases'][phase] = stats[phase]
+    for counter in FrameProfiler.counters:
+        scenarioResults['counters'][counter] = stats[counter]
+    if hasattr(world.scenario, "getResults"):
+        scenarioResults.update(world.scenario.getResults())
+    results[world.scenario.name] = scenarioResults
+
+
+#########################################################
+
+# returns a list of messages, one for each measurement that is slower than in the baseline,
+#  scenarios that only ran in one of the two are listed but are not regressions
+#  (a run of a few --scenarios leaves out the others on purpose)
+def compareResults(results, baseline, tolerance):
+    regressions = []
+    print "%-16s %-16s %10s %10s %8s" % ("", "", "baseline", "current", "change")
+    for name in baseline:
+        if name not in results:
+            print "%-16s %-16s" % (name, "did not run")
+    for name in results:
+        if name not in baseline:
+            print "%-16s %-16s" % (name, "not in baseline")
+            continue
+        measurements = [('loadTime', results[name]['loadTime'], baseline[name]['loadTime'])]
+        for percentile in ('p50', 'p95'):
+            measurements.append(('frameTime ' + percentile, results[name]['frameTime'][percentile],
+                                 baseline[name]['frameTime'][percentile]))
+        for (measurement, value, baselineValue) in measurements:
+            change = (value - baselineValue) / max(baselineValue, 1e-6)
+            print "%-16s %-16s %10.3f %10.3f %+7.1f%%" % (name, measurement, baselineValue, value, change * 100)
+            if change > tolerance:
+                regressions.append(name + " " + measurement + " is " + str(int(round(change * 100))) + "% slower")
+    return regressions
+
+# writes the maps of a --scaling run into mapdir (unless they are there already, so their visibility
+#  caches stay valid) and returns a MazeScenario for each of them
+def makeScalingScenarios(styles, sizes, mapdir, tiled=False):
+    import mazegen, maze
+    if not os.path.isdir(mapdir):
+        os.makedirs(mapdir)
+    scalingScenarios = []
+    for style in styles:
+        for size in sizes:
+            # map.txt is 101 by 102 cells
+            width = int(round(101 * math.sqrt(size)))
+            height = int(round(102 * math.sqrt(size)))
+            filename = os.path.join(mapdir, style + "-" + str(width) + "x" + str(height) + ".txt")
+            if not os.path.exists(filename):
+                print "making " + filename
+                mazegen.saveMap(mazegen.generateMap(style, width, height, seed=size), filename)
+            if tiled:
+                tiledFilename = os.path.splitext(filename)[0] + ".tiles"
+                if not os.path.exists(tiledFilename):
+                    maze.convertMap(filename, tiledFilename)
+                scalingScenarios.append(MazeScenario(tiledFilename, style + "-" + str(size) + "-tiled", style + " tiled"))
+            else:
+                scalingScenarios.append(MazeScenario(filename, style + "-" + str(size), style))
+    return scalingScenarios
+
+SCALING_COLUMNS = ["group", "cells", "mapWidth", "mapHeight", "walls", "loadTime", "frame p50", "frame p95",
+                   "update p50", "draw3D p50", "draw2D p50"]
+
+# plots the frame and load times of a --scaling run against the number of map cells,
+#  or writes them to a CSV file when matplotlib is not installed
+def plotScaling(results, filename):
+    rows = []
+    for scenarioResults in results.values():
+        if scenarioResults.get('group') is None:
+            continue
+        rows.append([scenarioResults['group'], scenarioResults['mapWidth'] * scenarioResults['mapHeight'],
+                     scenarioResults['mapWidth'], scenarioResults['mapHeight'], scenarioResults['walls'],
+                     scenarioResults['loadTime'], scenarioResults['frameTime']['p50'], scenarioResults['frameTime']['p95'],
+                     scenarioResults['phases']['update']['p50'], scenarioResults['phases']['draw3D']['p50'],
+                     scenarioResults['phases']['draw2D']['p50']])
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as pyplot
+    except ImportError:
+        filename = os.path.splitext(filename)[0] + ".csv"
+        print "matplotlib is not installed, writing " + filename + " instead"
+        outputFile = open(filename, "wb")
+        writer = csv.writer(outputFile)
+        writer.writerow(SCALING_COLUMNS)
+        writer.writerows(rows)
+        outputFile.close()
+        return
+    (figure, (frameAxes, loadAxes)) = pyplot.subplots(1, 2, figsize=(12, 5))
+    for group in sorted(set([row[0] for row in rows])):
+        groupRows = sorted([row for row in rows if row[0] == group])
+        cells = [row[1] for row in groupRows]
+        for (column, style) in (("frame p50", "-o"), ("frame p95", "--o"), ("update p50", ":x"), ("draw3D p50", "-.x")):
+            index = SCALING_COLUMNS.index(column)
+            frameAxes.plot(cells, [row[index] for row in groupRows], style, label=group + " " + column)
+        loadAxes.plot(cells, [row[5] for row in groupRows], "-o", label=group)
+    for (axes, label) in ((frameAxes, "milliseconds per frame"), (loadAxes, "load time (seconds)")):
+        axes.set_xscale("log")
+        axes.set_xlabel("map cells")
+        axes.set_ylabel(label)
+        axes.legend(fontsize="small")
+    figure.tight_layout()
+    figure.savefig(filename)
+
+def getSystemInfo():
+    return {'platform': sys.platform, 'python': sys.version.split()[0], 'opengl': getOpenGLVersion(),
+            'headless': arguments.headless, 'time': time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+if arguments.scaling is not None:
+    scenarios = makeScalingScenarios(arguments.scaling.split(","), [int(size) for size in arguments.sizes.split(",")],
+                                     arguments.mapdir, arguments.tiled)
+elif arguments.scenarios is None:
+    scenarios = [scenario() for scenario in SCENARIOS]
+else:
+    names = arguments.scenarios.split(",")
+    scenarios = [scenario() for scenario in SCENARIOS if scenario.name in names]
+    if len(scenarios) != len(names):
+        parser.error("the scenarios are " + ", ".join([scenario.name for scenario in SCENARIOS]))
+
+makeGraphicsWindow(1024, 600, headless=arguments.headless)
+system = getSystemInfo()
+runGraphics(startBenchmark, updateBenchmark, drawBenchmark)
+
+# ru_maxrss is the peak of the whole process, so it is only reported once for the whole run
+report = {'system': system, 'peakMemory': getPeakMemory(), 'scenarios': results}
+if arguments.output is None:
+    print json.dumps(report, indent=1)
+else:
+    outputFile = open(arguments.output, "w")
+    json.dump(report, outputFile, indent=1)
+    outputFile.close()
+if arguments.plot is not None:
+    plotScaling(results, arguments.plot)
+
+if arguments.baseline is not None:
+    baselineFile = open(arguments.baseline, "r")
+    baseline = json.load(baselineFile)
+    baselineFile.close()
+    regressions = compareResults(results, baseline['scenarios'], arguments.tolerance)
+    for regression in regressions:
+        print "REGRESSION: " + regression
+    if len(regressions) > 0:
+        sys.exit(1)
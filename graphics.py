@@ -15,6 +15,7 @@ This has been tested with Python 2.7.10 and Pygame 1.9.1/2.
 print "using graphics.py library version 3.8"
 
 import pygame, sys, os, math
+from textcache import RenderedTextCache
 
 class World:
     pass
@@ -32,6 +33,7 @@ class GameLibInfo:
         self.world = None
         self.graphicsInited = False
         self.fonts = dict()
+        self.textCache = RenderedTextCache()
         self.eventListeners = dict()
         self.frameRate = 60
         self.windowWidth = 0
@@ -235,25 +237,28 @@ def drawPolygon(pointlist, color=_GLI.foreground, thickness=1):
 def fillPolygon(pointlist, color=_GLI.foreground):
     drawPolygon(pointlist, color, 0)
 
-def sizeString(text, size=30, bold=False, italic=False, font=None):
+def getFont(size=30, bold=False, italic=False, font=None):
     fontSignature = (font,size,bold,italic)
     if fontSignature not in _GLI.fonts:
-        font = pygame.font.SysFont(font, size, bold, italic)
-        _GLI.fonts[fontSignature] = font
-    else:
-        font = _GLI.fonts[fontSignature]
-    textimage = font.render(str(text), False, (1,1,1))
-    return (textimage.get_width(), textimage.get_height())
+        _GLI.fonts[fontSignature] = pygame.font.SysFont(font, size, bold, italic)
+    return _GLI.fonts[fontSignature]
+
+def setTextCacheSize(maxBytes):
+    _GLI.textCache.maxBytes = maxBytes
+
+def getTextCacheStats():
+    return _GLI.textCache.getStats()
+
+def sizeString(text, size=30, bold=False, italic=False, font=None):
+    fontSignature = (font,size,bold,italic)
+    font = getFont(size, bold, italic, font)
+    return _GLI.textCache.getSize(font, fontSignature, str(text))
 
 def drawString(text, x, y, size=30, color=_GLI.foreground, bold=False, italic=False, font=None):
     fontSignature = (font,size,bold,italic)
-    if fontSignature not in _GLI.fonts:
-        font = pygame.font.SysFont(font, size, bold, italic)
-        _GLI.fonts[fontSignature] = font
-    else:
-        font = _GLI.fonts[fontSignature]
+    font = getFont(size, bold, italic, font)
     color = lookupColor(color)
-    textimage = font.render(str(text), False, color)
+    textimage = _GLI.textCache.getSurface(font, fontSignature, str(text), color)
     _GLI.screen.blit(textimage, (int(x), int(y)))
     return (textimage.get_width(), textimage.get_height())
 
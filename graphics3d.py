@@ -13,16 +13,24 @@ Note: You must have the Pygame and PyOpenGL libraries installed for this to work
 This has been tested with Python 2.7.10, Pygame 1.9.2, and PyOpenGL 3.1.0.
 """
 
-import sys, math, re, os, os.path, random, struct
+import sys, math, re, os, os.path, random, struct, collections, array, cPickle, marshal, ctypes, timeit, json, csv
 import zipfile, cStringIO, xml.etree.ElementTree
 import pygame
 
+# GRAPHICS3D_HEADLESS=osmesa or egl draws without a display with software (or EGL) OpenGL,
+#  and GRAPHICS3D_HEADLESS=hidden draws into a framebuffer object of a hidden window.
+# PyOpenGL chooses its platform when it is first imported, so this is read here.
+_HEADLESS_MODE = os.environ.get("GRAPHICS3D_HEADLESS", "").lower()
+if _HEADLESS_MODE in ("osmesa", "egl"):
+    os.environ["PYOPENGL_PLATFORM"] = _HEADLESS_MODE
+
 import OpenGL
 OpenGL.ERROR_CHECKING = True
 
 from OpenGL.GL import *
 from OpenGL.GLU import *
 import OpenGL.arrays.lists
+from textcache import RenderedTextCache
 
 class World:
     pass
@@ -58,8 +66,17 @@ class GameLibInfo:
         self.version = "0.90"
         self.world = None
         self.fonts = dict()
+        self.textCache = RenderedTextCache()
+        self.glyphAtlases = dict()  # key = font signature, value = GlyphAtlas
+        self.textOverlay = []  # text queued by drawText3DOverlay for the end of the frame
         self.eventListeners = dict()
         self.frameRate = 60
+        self.updatesPerSecond = 0  # 0 calls updateFunction once per frame, otherwise at this fixed rate
+        self.maxCatchUpSteps = 5
+        self.updateAccumulator = 0.0  # milliseconds of game time that have not been simulated yet
+        self.lastUpdateTime = 0
+        self.interpolationAlpha = 1.0
+        self.frameCamera = None  # ((x, y, z), (heading, pitch, roll)) the camera goes back to after a frame drawn with setFrameCamera
         self.windowWidth = 0
         self.windowHeight = 0
         self.viewportWidth = 0
@@ -78,9 +95,34 @@ class GameLibInfo:
         self.cameraAngles = Angles3D(0,0,0)
         self.keysPressedNow = dict()
         self.polygonCount = 0
+        self.drawnCount = 0
+        self.culledCount = 0
+        # GL work in the last frame, for the profiler
+        self.drawCallCount = 0
+        self.textureBindCount = 0
+        self.bufferBindCount = 0
+        self.textureUploadCount = 0
+        self.textureUploadBytes = 0
+        self.profiler = None  # FrameProfiler when enableProfiler is on
+        self.headless = None  # None for a normal window, or "osmesa", "egl" or "hidden"
+        self.headlessContext = None  # keeps the offscreen context and its buffers alive
+        self.framebufferID = 0
+        self.mainDrawBuffer = GL_BACK  # the buffer that frames are drawn into
+        self.screenShots = []  # file names to save after the frame being drawn
+        self.inputRecording = None  # InputRecording that records or replays the input of runGraphics
+        self.frustumCulling = True
+        self.frustumPlanes = None
+        self.depthPlane = None  # (a, b, c, d), a*x + b*y + c*z + d is the depth of (x, y, z) in front of the camera
+        self.modelTransform = None
+        self.drawDepth = 0
         self.fieldOfView=45
         self.nearClip=0.1
         self.farClip=1000.0
+        self.fogCulling = False
+        self.fogVisibility = 0.005
+        self.fogCullDistance = None  # getFogRange of the current fog when fog culling is on
+        self.fogFarClip = None  # the far clip used instead of farClip when fog culling is on
+        self.frameFogRange = 0  # the largest fog range that models were drawn with in this frame
         self.textureMapsEnabled = False
         self.lightingEnabled = False
         self.numLights = 0
@@ -93,6 +135,21 @@ class GameLibInfo:
         self.selectColorIDDict = {} # key = ID, value = color
         self.selectionDrawingOn = False
         self.useInterleavedArrays = True
+        self.useCanvasTextures = False
+        self.hasInstancing = False
+        self.instancingProgram = None  # (program ID, attribute locations of the matrix columns, uniform locations)
+        self.instanceSets = dict()  # key = model, value = InstanceSet3D used by drawInstanced3D
+        # what is bound now, so binding the same thing again can be skipped (None means unknown)
+        self.boundTexture = None
+        self.boundArrayBuffer = None
+        self.interleavedArrays = None  # (format, buffer ID) of the last glInterleavedArrays call
+        self.enabledCaps = dict()  # key = capability, value = True or False
+        self.drawQueueEnabled = False
+        self.drawQueue = []  # list of (sort key, submission number, model, transform)
+        self.scenes = dict()  # key = label, value = RecordedScene
+        self.recordingScene = None
+        self.useDisplayLists = True
+        self.frameNumber = 0  # counts calls to _render, so LevelOfDetail can tell frames apart
         self.START_MODE = 1
         self.EVENT_MODE = 2
         self.UPDATE_MODE = 3
@@ -184,7 +241,7 @@ class GameLibInfo:
 
     def startAnimation(self):
         self.clock = pygame.time.Clock()
-        self.startTime = pygame.time.get_ticks()
+        self.startTime = _getTicks()
         self.keepRunning = True
         self.FPScount = 0
         if self.FPSinterval > 0:
@@ -195,7 +252,7 @@ class GameLibInfo:
         if self.FPSinterval > 0:
             time = pygame.time.get_ticks()
             if time > self.FPStime + self.FPSinterval:
-                print getActualFrameRate(), " (" + str(_GLI.polygonCount) + " polygons)"
+                print getActualFrameRate(), " (" + str(_GLI.polygonCount) + " polygons, " + str(_GLI.drawnCount) + " objects drawn, " + str(_GLI.culledCount) + " culled)"
                 sys.stdout.flush()
                 self.FPStime = time
                 self.FPScount = 0
@@ -250,18 +307,95 @@ class GameLibInfo:
             glMultTransposeMatrixf = ARBTransposeMatrix.glMultTransposeMatrixfARB
         if openglVersion < "1.2":
             print "Your Open GL Version ("+openglVersion+") is too old"
+        # canvases are kept in textures of any size, which needs OpenGL 2.0
+        self.useCanvasTextures = (openglVersion >= "2.0")
+        # InstanceSet3D draws with glDrawArraysInstanced and glVertexAttribDivisor from OpenGL 3.3,
+        #  otherwise it falls back to a StaticBatch3D
+        self.hasInstancing = (openglVersion >= "3.3" and bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor))
+        # display lists are deprecated after OpenGL 3.0, so newer versions record scenes as command arrays
+        self.useDisplayLists = (openglVersion < "3.0")
 
         
 _GLI = GameLibInfo()
 
-def makeGraphicsWindow(width, height, fullscreen=False):
+# headless is None (or the GRAPHICS3D_HEADLESS environment variable) for a normal window,
+#  "osmesa" or "egl" to draw without any display, or "hidden" to draw offscreen with a hidden window
+#  osmesa and egl also need GRAPHICS3D_HEADLESS to be set before graphics3d is imported
+def makeGraphicsWindow(width, height, fullscreen=False, headless=None):
+    if headless is None and _HEADLESS_MODE != "":
+        headless = _HEADLESS_MODE
+    if headless in ("osmesa", "egl") and os.environ.get("PYOPENGL_PLATFORM") != headless:
+        raise ValueError("set GRAPHICS3D_HEADLESS=" + headless + " before importing graphics3d")
+    if headless not in (None, "osmesa", "egl", "hidden"):
+        raise ValueError("unknown headless mode: " + str(headless))
+    if headless in ("osmesa", "egl"):
+        # pygame still handles events and sounds, but there is no screen or sound card
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
     initGraphics()
+    _GLI.headless = headless
     setGraphicsMode(width, height, fullscreen)
     print getOpenGLVersion()
     _GLI.handleOldOpenGLVersions()
     _GLI.handleNumPy()
     enable_vsync()
 
+# makes an OpenGL context that draws into memory, with no window
+def _createHeadlessContext(headless, width, height):
+    if headless == "osmesa":
+        from OpenGL import osmesa
+        context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not context:
+            raise RuntimeError("could not create an OSMesa context")
+        pixels = OpenGL.arrays.GLubyteArray.zeros((height, width, 4))
+        if not osmesa.OSMesaMakeCurrent(context, pixels, GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError("could not use the OSMesa context")
+        _GLI.headlessContext = (context, pixels)
+        # OSMesa contexts are single buffered
+        _GLI.mainDrawBuffer = GL_FRONT
+    else:
+        from OpenGL import EGL
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        (major, minor) = (EGL.EGLint(), EGL.EGLint())
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("could not initialize EGL")
+        configAttributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8,
+                            EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8, EGL.EGL_DEPTH_SIZE, 24,
+                            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        numConfigs = EGL.EGLint()
+        if (not EGL.eglChooseConfig(display, (EGL.EGLint * len(configAttributes))(*configAttributes),
+                                    ctypes.pointer(config), 1, ctypes.pointer(numConfigs)) or numConfigs.value == 0):
+            raise RuntimeError("no EGL configuration can draw offscreen")
+        surfaceAttributes = [EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE]
+        surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * len(surfaceAttributes))(*surfaceAttributes))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        if not context or not EGL.eglMakeCurrent(display, surface, surface, context):
+            raise RuntimeError("could not create an EGL context")
+        _GLI.headlessContext = (display, surface, context)
+        _GLI.mainDrawBuffer = GL_BACK
+
+# makes a framebuffer object the size of the window and draws into it instead of the window
+def _createFramebuffer(width, height):
+    _GLI.framebufferID = glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, _GLI.framebufferID)
+    colorBufferID = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, colorBufferID)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, colorBufferID)
+    depthBufferID = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, depthBufferID)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, depthBufferID)
+    glBindRenderbuffer(GL_RENDERBUFFER, 0)
+    if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+        raise RuntimeError("could not make a framebuffer object for hidden drawing")
+    _GLI.headlessContext = (colorBufferID, depthBufferID)
+    _GLI.mainDrawBuffer = GL_COLOR_ATTACHMENT0
+    glDrawBuffer(GL_COLOR_ATTACHMENT0)
+    glReadBuffer(GL_COLOR_ATTACHMENT0)
+
 def initGraphics():
     os.environ['SDL_VIDEO_CENTERED'] = '1'
     pygame.init()
@@ -278,11 +412,20 @@ def setGraphicsMode(width, height, fullscreen=False):
     _GLI.windowHeight = height
     _GLI.viewportWidth = width
     _GLI.viewportHeight = height
-    flags = 0
-    if fullscreen == True:
-        flags = flags | pygame.FULLSCREEN
-    flags = flags | pygame.OPENGL | pygame.HWSURFACE | pygame.DOUBLEBUF
-    _GLI.screen = pygame.display.set_mode((width, height), flags)
+    if _GLI.headless in ("osmesa", "egl"):
+        _GLI.screen = pygame.display.set_mode((width, height))
+        _createHeadlessContext(_GLI.headless, width, height)
+    elif _GLI.headless == "hidden":
+        # pygame 2 can hide the window, older versions show it but nothing is drawn in it
+        flags = pygame.OPENGL | pygame.DOUBLEBUF | getattr(pygame, 'HIDDEN', 0)
+        _GLI.screen = pygame.display.set_mode((width, height), flags)
+        _createFramebuffer(width, height)
+    else:
+        flags = 0
+        if fullscreen == True:
+            flags = flags | pygame.FULLSCREEN
+        flags = flags | pygame.OPENGL | pygame.HWSURFACE | pygame.DOUBLEBUF
+        _GLI.screen = pygame.display.set_mode((width, height), flags)
     glViewport(0, 0, width, height)
     createViewport("mainwindow", 0, 0, width, height)
     setProjection()
@@ -331,12 +474,29 @@ def _applyProjection():
     glMatrixMode(GL_PROJECTION)
     glLoadIdentity()
     aspect = float(_GLI.viewportWidth) / float(_GLI.viewportHeight)
-    gluPerspective(_GLI.fieldOfView, aspect, _GLI.nearClip, _GLI.farClip)
+    gluPerspective(_GLI.fieldOfView, aspect, _GLI.nearClip, _getFarClip())
     glMatrixMode(GL_MODELVIEW)
 
 def enableInterleavedArrays(isEnabled):
     _GLI.useInterleavedArrays = isEnabled
 
+# when enabled, draw2D keeps each canvas in a texture and only uploads the parts that changed
+#  otherwise the whole canvas is sent with glDrawPixels every frame
+def enableCanvasTextures(isEnabled):
+    _GLI.useCanvasTextures = isEnabled
+
+# chooses whether recordScene compiles a display list (True) or keeps a sorted command array (False)
+def enableDisplayLists(isEnabled):
+    _GLI.useDisplayLists = isEnabled
+
+# when enabled (and OpenGL 3.3 is available), InstanceSet3D draws all copies of its model with one draw call
+def enableInstancing(isEnabled):
+    _GLI.hasInstancing = isEnabled and bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor)
+
+# when enabled, draw3D skips models (and chunks of a StaticBatch3D) that are outside the camera's view
+def enableFrustumCulling(isEnabled):
+    _GLI.frustumCulling = isEnabled
+
 def setBackground(background):
     if isinstance(background, str):
         _GLI.background = lookupColor3D(background)
@@ -448,25 +608,27 @@ def useViewport(label):
 def stopOffscreenViewport():
     if _GLI.currentViewport == None: return
     if _GLI.currentViewport.offscreen == False: return
-    glDrawBuffer(GL_BACK)
+    glDrawBuffer(_GLI.mainDrawBuffer)
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
     useViewport("mainwindow")
 
 def updateTextureFromOffscreenViewport(model, viewportlabel):
     glReadBuffer(GL_AUX2)
     textureID = model.textureID
-    glBindTexture(GL_TEXTURE_2D, textureID)
+    _bindTexture(textureID)
     width = _GLI.viewports[viewportlabel].width
     height = _GLI.viewports[viewportlabel].height
     glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
     glCopyTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, 0, 0, width, height)    
     #glCopyTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, 0, 0, width, height, 0)    
-    glReadBuffer(GL_BACK)
+    glReadBuffer(_GLI.mainDrawBuffer)
 
 
 # this should normally not be called from outside the library
 #  provided for backwards compatibility
 def setViewport(x, y, width, height):
+    _flushDrawQueue()
+    _drawTextOverlay()
     _GLI.viewportWidth = width
     _GLI.viewportHeight = height
     if not _GLI.currentViewport.offscreen:
@@ -474,6 +636,7 @@ def setViewport(x, y, width, height):
     _applyProjection()
     glLoadIdentity()
     setupCamera()
+    _updateFrustum()
     _drawLights()
 
 
@@ -507,7 +670,7 @@ def loadTexture(texture, alias=None, scale=None, tiles=None):
         (width, height, textureFileName, textureData) = _getTextureData(texture)
     _GLI.enableTextureMaps()
     textureID = glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, textureID)
+    _bindTexture(textureID)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
     #glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
@@ -515,6 +678,7 @@ def loadTexture(texture, alias=None, scale=None, tiles=None):
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
     glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
     glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+    _countTextureUpload(len(textureData))
     #gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGBA, width, height, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
     if textureFileName is not None:
         _GLI.textureIDs[textureFileName] = textureID
@@ -529,9 +693,10 @@ def setTexture(model, textureName):
 def updateTexture(model, texture):
     (width, height, textureFileName, textureData) = _getTextureData(texture)
     textureID = model.textureID
-    glBindTexture(GL_TEXTURE_2D, textureID)
+    _bindTexture(textureID)
     #glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
     glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+    _countTextureUpload(len(textureData))
     #gluBuild2DMipmaps(GL_TEXTURE_2D, GL_RGBA, width, height, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
 
 def _getTextureData(texture):
@@ -565,6 +730,7 @@ def _getTextureData(texture):
 #########################################################################
 
 def makeFog(density=0.05, color=(1,1,1), mode=1):
+    _flushDrawQueue()
     glEnable(GL_FOG)
     if mode == 1:
         glFogi(GL_FOG_MODE, GL_EXP)
@@ -577,10 +743,49 @@ def makeFog(density=0.05, color=(1,1,1), mode=1):
     _GLI.fogDensity = density
     _GLI.fogMode = mode
     _GLI.fogColor = color
+    _updateFogCulling()
 
 def removeFog():
+    _flushDrawQueue()
     glDisable(GL_FOG)
     _GLI.fogMode = 0
+    _updateFogCulling()
+
+# When enabled, draw3D skips models (and chunks of a StaticBatch3D) that are farther away than
+# getFogRange(visibility) for the fog they are drawn with, and the far clip is moved in to the
+# largest fog range of the previous frame, which gives the depth buffer more precision.
+# Anything past the far clip shows the background, so this looks best when it matches the fog color.
+def enableFogCulling(isEnabled, visibility=0.005):
+    _GLI.fogCulling = isEnabled
+    _GLI.fogVisibility = visibility
+    _updateFogCulling()
+    if not isEnabled and _GLI.fogFarClip is not None:
+        _GLI.fogFarClip = None
+        _applyProjection()
+
+def _updateFogCulling():
+    if _GLI.fogCulling:
+        _GLI.fogCullDistance = getFogRange(_GLI.fogVisibility)
+    else:
+        _GLI.fogCullDistance = None
+
+# moves the far clip to the fog range of the last frame, called before each frame is drawn
+def _updateFogFarClip():
+    if not _GLI.fogCulling:
+        return
+    farClip = None
+    if 0 < _GLI.frameFogRange < _GLI.farClip:
+        farClip = _GLI.frameFogRange
+    _GLI.frameFogRange = 0
+    if farClip != _GLI.fogFarClip:
+        _GLI.fogFarClip = farClip
+        _applyProjection()
+
+# the far clip of the projection, which fog culling can bring closer than farClip
+def _getFarClip():
+    if _GLI.fogFarClip is not None:
+        return _GLI.fogFarClip
+    return _GLI.farClip
 
 
 # returns the distance at which the fraction of visible color has dropped to the given value
@@ -716,9 +921,13 @@ def removeAllTimerListeners():
 #########################################################
 
 def getMousePosition():
+    if _GLI.inputRecording is not None:
+        return _GLI.inputRecording.mousePosition
     return pygame.mouse.get_pos()
 
 def getMouseButton(button):
+    if _GLI.inputRecording is not None:
+        return _GLI.inputRecording.mouseButtons[button-1]
     return pygame.mouse.get_pressed()[button-1]
 
 def hideMouse():
@@ -728,6 +937,10 @@ def showMouse():
     pygame.mouse.set_visible(True)
 
 def moveMouse(x, y):
+    if _GLI.inputRecording is not None:
+        _GLI.inputRecording.mousePosition = (int(x), int(y))
+        if _GLI.inputRecording.replaying:
+            return
     pygame.mouse.set_pos((int(x), int(y)))
 
 def isKeyPressed(key):
@@ -854,15 +1067,21 @@ def gameControllerDPadY(dpad=0, device=0):
 # use run for interactive programs like games
 def runGraphics(startFunction, updateFunction, drawFunction):
     try:
+        _startInputRecording()
         _GLI.startAnimation()
         _GLI.world = World()
         _GLI.startFunction = startFunction
         _GLI.updateFunction = updateFunction
         _GLI.drawFunction = drawFunction
         startFunction(_GLI.world)
+        _resetFixedTimestep()
         while _GLI.keepRunning:
             _GLI.currentMode = _GLI.EVENT_MODE
-            eventlist = pygame.event.get()
+            _profileBegin("events")
+            if _GLI.inputRecording is not None:
+                eventlist = _GLI.inputRecording.nextFrame()
+            else:
+                eventlist = pygame.event.get()
             _GLI.world.guiEventList = eventlist
             for event in eventlist:
                 if event.type == pygame.QUIT:
@@ -919,28 +1138,90 @@ def runGraphics(startFunction, updateFunction, drawFunction):
 
                 elif event.type >= pygame.USEREVENT:   # timer event
                     _GLI.eventListeners["timer"+str(event.type)](_GLI.world)
+            _profileEnd()
             _GLI.currentMode = _GLI.UPDATE_MODE
-            updateFunction(_GLI.world)
+            _profileBegin("update")
+            if _GLI.updatesPerSecond > 0:
+                _runFixedUpdates(updateFunction)
+            else:
+                updateFunction(_GLI.world)
+            _profileEnd()
             _render()
+            if len(_GLI.screenShots) > 0:
+                _saveScreenShots()
+            _profileBegin("flip")
             pygame.display.flip()
+            _profileEnd()
             _GLI.maybePrintFPS()
-            _GLI.clock.tick(_GLI.frameRate)
+            _profileBegin("tick")
+            if _GLI.inputRecording is not None and _GLI.inputRecording.uncapped:
+                _GLI.clock.tick()
+            else:
+                _GLI.clock.tick(_GLI.frameRate)
+            _profileEnd()
+            if _GLI.profiler is not None:
+                _GLI.profiler.endFrame()
     finally:
+        if _GLI.inputRecording is not None:
+            _GLI.inputRecording.close()
         pygame.quit()
 
 
+# calls updateFunction as many times as needed to catch up with the clock, but at most
+#  maxCatchUpSteps times, after that the simulation falls behind instead of taking ever longer frames
+def _runFixedUpdates(updateFunction):
+    step = 1000.0 / _GLI.updatesPerSecond
+    now = _getTicks()
+    _GLI.updateAccumulator += now - _GLI.lastUpdateTime
+    _GLI.lastUpdateTime = now
+    steps = 0
+    while _GLI.updateAccumulator >= step and steps < _GLI.maxCatchUpSteps:
+        updateFunction(_GLI.world)
+        _GLI.updateAccumulator -= step
+        steps += 1
+    if _GLI.updateAccumulator >= step:
+        _GLI.updateAccumulator %= step
+    _GLI.interpolationAlpha = _GLI.updateAccumulator / step
+
+# the next frame starts with one update, so the world is updated before it is first drawn
+def _resetFixedTimestep():
+    _GLI.lastUpdateTime = _getTicks()
+    if _GLI.updatesPerSecond > 0:
+        _GLI.updateAccumulator = 1000.0 / _GLI.updatesPerSecond
+    _GLI.interpolationAlpha = 1.0
+
 def _render():
     _GLI.currentMode = _GLI.DRAW_MODE
+    _GLI.frameNumber += 1
+    _profileBegin("draw")
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    resetStateCache()
+    _updateFogFarClip()
     glLoadIdentity()
     setupCamera()
+    _updateFrustum()
     _drawLights()
     _GLI.polygonCount = 0
+    _GLI.drawnCount = 0
+    _GLI.culledCount = 0
+    _GLI.drawCallCount = 0
+    _GLI.textureBindCount = 0
+    _GLI.bufferBindCount = 0
+    _GLI.textureUploadCount = 0
+    _GLI.textureUploadBytes = 0
     _GLI.numPushedMatrices = 0
     _GLI.drawFunction(_GLI.world)
     while _GLI.numPushedMatrices > 0:
         glPopMatrix()
         _GLI.numPushedMatrices -= 1
+    _flushDrawQueue()
+    _drawTextOverlay()
+    if _GLI.frameCamera is not None:
+        ((x, y, z), (heading, pitch, roll)) = _GLI.frameCamera
+        setCameraPosition(x, y, z)
+        setCameraRotation(heading, pitch, roll)
+        _GLI.frameCamera = None
+    _profileEnd()
     
 
 
@@ -948,14 +1229,257 @@ def getWorld():
     return _GLI.world
 
 def getElapsedTime():
-    return pygame.time.get_ticks() - _GLI.startTime
+    return _getTicks() - _GLI.startTime
 
 def resetTime():
-    _GLI.startTime = pygame.time.get_ticks()
+    _GLI.startTime = _getTicks()
+
+# the time in milliseconds, while input is recorded or replayed this is the time at the start of the frame
+def _getTicks():
+    if _GLI.inputRecording is not None:
+        return _GLI.inputRecording.ticks
+    return pygame.time.get_ticks()
 
 def setFrameRate(frameRate):
     _GLI.frameRate = frameRate
 
+# Runs updateFunction at a fixed number of updatesPerSecond, no matter how fast frames are drawn,
+# so game logic that moves a fixed amount per update keeps the same speed when drawing is slow.
+# A slow frame is followed by up to maxCatchUpSteps updates. updatesPerSecond=0 goes back to one
+# update per frame. Use setFrameRate(0) as well to draw frames as fast as the computer can.
+def setFixedTimestep(updatesPerSecond, maxCatchUpSteps=5):
+    _GLI.updatesPerSecond = updatesPerSecond
+    _GLI.maxCatchUpSteps = maxCatchUpSteps
+    _resetFixedTimestep()
+
+# how far the time of the frame being drawn is between the last update and the next one (0 to 1),
+#  so draw functions can draw moving things at previous + (current - previous) * alpha
+#  without a fixed timestep this is always 1
+def getInterpolationAlpha():
+    return _GLI.interpolationAlpha
+
+# returns (number of objects drawn, number of objects culled) during the last frame
+def getCullingStats():
+    return (_GLI.drawnCount, _GLI.culledCount)
+
+#########################################################
+
+# Records the input of runGraphics to a file, or plays a recorded file back, so that the
+# same session can be run again frame by frame (for example to time it before and after a change).
+# Each frame stores the time, the mouse position and buttons, and the pygame events,
+# and the random module is seeded with the same seed, so a program that only uses these
+# (and getElapsedTime or a fixed timestep for time) does exactly the same thing again.
+# The file is a header followed by one marshal record per frame:
+#   (ticks, (mouseX, mouseY), mouseButtons, [(event type, event attributes), ...])
+# While replaying, live events are ignored except for closing the window or pressing escape,
+# and uncapped replays draw frames as fast as possible, since the recorded time is used anyway.
+class InputRecording:
+    version = 1
+    magic = "graphics3d input\n"
+
+    def __init__(self, filename, replaying, seed=None, uncapped=False):
+        self.filename = filename
+        self.replaying = replaying
+        self.seed = seed
+        self.uncapped = uncapped and replaying
+        self.inputFile = None
+        self.numFrames = 0
+        self.ticks = 0
+        self.mousePosition = (0, 0)
+        self.mouseButtons = (0, 0, 0)
+
+    def start(self):
+        if self.replaying:
+            self.inputFile = open(self.filename, 'rb')
+            if self.inputFile.read(len(self.magic)) != self.magic:
+                raise ValueError(self.filename + " is not an input recording")
+            header = marshal.load(self.inputFile)
+            if header.get('version') != self.version:
+                raise ValueError(self.filename + " was recorded by a different version")
+            self.seed = header['seed']
+            self.ticks = header['ticks']
+            self.mousePosition = header['mousePosition']
+        else:
+            if self.seed is None:
+                self.seed = random.randint(0, 2**31 - 1)
+            self.ticks = pygame.time.get_ticks()
+            self.mousePosition = pygame.mouse.get_pos()
+            self.inputFile = open(self.filename, 'wb')
+            self.inputFile.write(self.magic)
+            marshal.dump({'version': self.version, 'seed': self.seed, 'ticks': self.ticks,
+                          'mousePosition': self.mousePosition}, self.inputFile)
+        random.seed(self.seed)
+
+    # returns the events of the next frame
+    def nextFrame(self):
+        liveEvents = pygame.event.get()
+        if self.replaying:
+            for event in liveEvents:
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    _GLI.keepRunning = False
+            try:
+                (self.ticks, self.mousePosition, self.mouseButtons, events) = marshal.load(self.inputFile)
+            except EOFError:
+                _GLI.keepRunning = False
+                return []
+            self.numFrames += 1
+            return [pygame.event.Event(eventType, attributes) for (eventType, attributes) in events]
+        self.ticks = pygame.time.get_ticks()
+        self.mousePosition = pygame.mouse.get_pos()
+        self.mouseButtons = tuple([int(button) for button in pygame.mouse.get_pressed()])
+        events = [(event.type, self.eventAttributes(event)) for event in liveEvents]
+        marshal.dump((self.ticks, self.mousePosition, self.mouseButtons, events), self.inputFile)
+        self.numFrames += 1
+        return liveEvents
+
+    # the attributes of an event that marshal can store
+    def eventAttributes(self, event):
+        attributes = dict()
+        for (name, value) in event.dict.items():
+            if isinstance(value, (int, long, float, str, unicode, bool, tuple)) or value is None:
+                attributes[name] = value
+        return attributes
+
+    def close(self):
+        if self.inputFile is not None:
+            self.inputFile.close()
+            self.inputFile = None
+
+# records the input of the next runGraphics to filename, seed is for the random module
+def recordInput(filename, seed=None):
+    _GLI.inputRecording = InputRecording(filename, False, seed)
+
+# replays the input recorded in filename during the next runGraphics, which ends with the recording
+#  uncapped=True draws the frames as fast as possible instead of at the frame rate
+def replayInput(filename, uncapped=False):
+    _GLI.inputRecording = InputRecording(filename, True, uncapped=uncapped)
+
+# GRAPHICS3D_RECORD_INPUT or GRAPHICS3D_REPLAY_INPUT can name the file, so any program can be
+#  recorded or replayed without changing it (GRAPHICS3D_REPLAY_UNCAPPED=1 replays uncapped)
+def _startInputRecording():
+    if _GLI.inputRecording is None:
+        if os.environ.get("GRAPHICS3D_REPLAY_INPUT"):
+            replayInput(os.environ["GRAPHICS3D_REPLAY_INPUT"], os.environ.get("GRAPHICS3D_REPLAY_UNCAPPED") == "1")
+        elif os.environ.get("GRAPHICS3D_RECORD_INPUT"):
+            recordInput(os.environ["GRAPHICS3D_RECORD_INPUT"])
+    if _GLI.inputRecording is not None:
+        _GLI.inputRecording.start()
+
+#########################################################
+
+# Records where the time of each frame goes, for the last numFrames frames.
+# The phases are timed exclusively: while a phase runs inside another one (like draw3D inside draw),
+# the outer phase is paused, so the phases of a frame add up to the whole frame.
+#   events    handling pygame events and calling the event listeners
+#   update    the update function (all of its steps with a fixed timestep)
+#   draw      the rest of drawing a frame, including the draw function's own code
+#   draw3D    drawing models with draw3D and replayScene
+#   draw2D    drawing canvases and text overlays
+#   textures  preparing and uploading canvas images
+#   flip      pygame.display.flip, which also waits for OpenGL to finish the frame
+#   tick      the time clock.tick sleeps to keep to the frame rate
+# The GL work of each frame is counted too (polygons, models drawn and culled, draw calls,
+# texture and buffer bindings, texture uploads and uploaded bytes).
+# OpenGL runs in parallel with Python, so the time of a GL call shows up where the driver
+# waits for it, which is often flip.
+class FrameProfiler:
+    phases = ("events", "update", "draw", "draw3D", "draw2D", "textures", "flip", "tick")
+    counters = ("polygons", "drawn", "culled", "drawCalls", "textureBinds", "bufferBinds", "textureUploads", "uploadBytes")
+
+    def __init__(self, numFrames=600):
+        self.samples = collections.deque(maxlen=numFrames)  # tuples with the values of getColumns
+        self.startFrame()
+
+    def startFrame(self):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.stack = []  # list of (phase, time that phase was last started or resumed)
+        self.frameStart = timeit.default_timer()
+
+    def begin(self, phase):
+        now = timeit.default_timer()
+        if len(self.stack) > 0:
+            (outerPhase, start) = self.stack[-1]
+            self.times[outerPhase] += now - start
+        self.stack.append((phase, now))
+
+    def end(self):
+        # the profiler can be turned on in the middle of a phase
+        if len(self.stack) == 0:
+            return
+        now = timeit.default_timer()
+        (phase, start) = self.stack.pop()
+        self.times[phase] += now - start
+        if len(self.stack) > 0:
+            self.stack[-1] = (self.stack[-1][0], now)
+
+    def endFrame(self):
+        frameTime = timeit.default_timer() - self.frameStart
+        sample = [1000.0 * frameTime] + [1000.0 * self.times[phase] for phase in self.phases]
+        sample.extend([_GLI.polygonCount, _GLI.drawnCount, _GLI.culledCount, _GLI.drawCallCount,
+                       _GLI.textureBindCount, _GLI.bufferBindCount, _GLI.textureUploadCount, _GLI.textureUploadBytes])
+        self.samples.append(tuple(sample))
+        self.startFrame()
+
+    # the times are in milliseconds
+    def getColumns(self):
+        return ("frame",) + self.phases + self.counters
+
+    # returns a dict with the mean, p50, p95, p99 and max of each column over the recorded frames
+    def getStats(self):
+        stats = dict()
+        numSamples = len(self.samples)
+        if numSamples == 0:
+            return stats
+        for (column, values) in zip(self.getColumns(), zip(*self.samples)):
+            values = sorted(values)
+            columnStats = {'mean': sum(values) / float(numSamples), 'max': values[-1]}
+            for percentile in (50, 95, 99):
+                rank = int(math.ceil(percentile / 100.0 * numSamples)) - 1
+                columnStats['p' + str(percentile)] = values[max(rank, 0)]
+            stats[column] = columnStats
+        return stats
+
+    # writes the samples as JSON if the file name ends with .json, and as CSV otherwise
+    def save(self, filename):
+        outputFile = open(filename, 'wb')
+        if filename.lower().endswith(".json"):
+            json.dump({'columns': self.getColumns(), 'samples': list(self.samples), 'stats': self.getStats()},
+                      outputFile, indent=1)
+        else:
+            writer = csv.writer(outputFile)
+            writer.writerow(self.getColumns())
+            writer.writerows(self.samples)
+        outputFile.close()
+
+def enableProfiler(isEnabled, numFrames=600):
+    if isEnabled:
+        _GLI.profiler = FrameProfiler(numFrames)
+    else:
+        _GLI.profiler = None
+
+# returns the FrameProfiler stats of the recorded frames, for example
+#  getProfilerStats()['draw3D']['p95'] is the 95th percentile of the draw3D time in milliseconds
+def getProfilerStats():
+    if _GLI.profiler is None:
+        return dict()
+    return _GLI.profiler.getStats()
+
+def saveProfilerData(filename):
+    if _GLI.profiler is not None:
+        _GLI.profiler.save(filename)
+
+def _profileBegin(phase):
+    if _GLI.profiler is not None:
+        _GLI.profiler.begin(phase)
+
+def _profileEnd():
+    if _GLI.profiler is not None:
+        _GLI.profiler.end()
+
+def _countTextureUpload(numBytes):
+    _GLI.textureUploadCount += 1
+    _GLI.textureUploadBytes += numBytes
+
 
 #########################################################
 
@@ -967,7 +1491,7 @@ def getPixelColor(x,y):
 def getPixelDistance(x,y):
     [[depth]] = glReadPixels(x, _GLI.windowHeight - y, 1, 1, GL_DEPTH_COMPONENT, GL_FLOAT)
     depth = (depth - 0.5) * 2.0
-    far = _GLI.farClip
+    far = _getFarClip()
     near = _GLI.nearClip
     z = (-2.0 * far * near) / (depth * (far-near) - (far+near))
     return z
@@ -989,6 +1513,163 @@ def setupCamera():
         glRotate(-_GLI.cameraAngles.roll, 0, 0, 1)
         glTranslate(-_GLI.cameraPosition.x, -_GLI.cameraPosition.y, -_GLI.cameraPosition.z)
 
+# the same transformation that setupCamera applies, as a matrix
+def _cameraMatrix():
+    if _GLI.useNewCamera:
+        matrix = _rotationMatrix(-_GLI.cameraAngles.roll, 0, 0, 1)
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(-_GLI.cameraAngles.pitch, 1, 0, 0))
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(-_GLI.cameraAngles.heading, 0, 1, 0))
+    else:
+        matrix = _rotationMatrix(-_GLI.cameraAngles.heading, 1, 0, 0)
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(-_GLI.cameraAngles.pitch, 0, 1, 0))
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(-_GLI.cameraAngles.roll, 0, 0, 1))
+    translation = _translationMatrix(-_GLI.cameraPosition.x, -_GLI.cameraPosition.y, -_GLI.cameraPosition.z)
+    return _multiplyMatrices(matrix, translation)
+
+# the same matrix that gluPerspective builds in _applyProjection
+def _projectionMatrix():
+    aspect = float(_GLI.viewportWidth) / float(_GLI.viewportHeight)
+    f = 1.0 / math.tan(math.radians(_GLI.fieldOfView) / 2.0)
+    near = float(_GLI.nearClip)
+    far = float(_getFarClip())
+    return [[f/aspect, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far+near)/(near-far), (2*far*near)/(near-far)],
+            [0, 0, -1, 0]]
+
+# finds the six planes (left, right, bottom, top, near, far) of the camera's view volume in world coordinates
+# each plane is (a, b, c, d) with a unit normal pointing into the view volume
+def _updateFrustum():
+    camera = _cameraMatrix()
+    clip = _multiplyMatrices(_projectionMatrix(), camera)
+    planes = []
+    for (row, sign) in [(0,1), (0,-1), (1,1), (1,-1), (2,1), (2,-1)]:
+        (a, b, c, d) = [clip[3][i] + sign*clip[row][i] for i in range(4)]
+        length = math.sqrt(a*a + b*b + c*c)
+        planes.append((a/length, b/length, c/length, d/length))
+    _GLI.frustumPlanes = planes
+    # the camera looks down its -z axis
+    _GLI.depthPlane = tuple([-value for value in camera[2]])
+
+def _sphereInFrustum((x,y,z), radius):
+    for (a, b, c, d) in _GLI.frustumPlanes:
+        if a*x + b*y + c*z + d < -radius:
+            return False
+    return True
+
+def _boxInFrustum(minCorner, maxCorner):
+    (minx, miny, minz) = minCorner
+    (maxx, maxy, maxz) = maxCorner
+    for (a, b, c, d) in _GLI.frustumPlanes:
+        # test the corner of the box that is farthest along the plane's normal
+        x = maxx if a >= 0 else minx
+        y = maxy if b >= 0 else miny
+        z = maxz if c >= 0 else minz
+        if a*x + b*y + c*z + d < 0:
+            return False
+    return True
+
+# decides if a model drawn by draw3D with the given transformation could be seen by the camera
+def _modelInFrustum(model, transform):
+    getBoundingSphere = getattr(model, 'getBoundingSphere', None)
+    if getBoundingSphere is None:
+        return True
+    sphere = getBoundingSphere()
+    if sphere is None:
+        return True
+    (center, radius) = _worldSphere(sphere, transform)
+    return _sphereInFrustum(center, radius)
+
+# decides if a model drawn by draw3D with the given transformation is completely inside the fog
+# Fog culling measures the depth in front of the camera, like the far clip and like OpenGL's fog
+#  (which may also use the straight distance to the camera, but that is never less than the depth,
+#  so the fog is at least as thick as the culling assumes).
+def _modelBeyondFog(model, transform):
+    getBoundingSphere = getattr(model, 'getBoundingSphere', None)
+    if getBoundingSphere is None or _GLI.depthPlane is None:
+        return False
+    sphere = getBoundingSphere()
+    if sphere is None:
+        return False
+    ((x, y, z), radius) = _worldSphere(sphere, transform)
+    (a, b, c, d) = _GLI.depthPlane
+    return a*x + b*y + c*z + d - radius > _GLI.fogCullDistance
+
+def _boxBeyondFog(minCorner, maxCorner):
+    if _GLI.depthPlane is None:
+        return False
+    (minx, miny, minz) = minCorner
+    (maxx, maxy, maxz) = maxCorner
+    (a, b, c, d) = _GLI.depthPlane
+    # the corner of the box that is nearest to the camera along the view direction
+    x = minx if a >= 0 else maxx
+    y = miny if b >= 0 else maxy
+    z = minz if c >= 0 else maxz
+    return a*x + b*y + c*z + d > _GLI.fogCullDistance
+
+# decides if draw3D can skip a model with the given world transformation
+def _modelCulled(model, transform):
+    if _GLI.frustumCulling and _GLI.frustumPlanes is not None and not _modelInFrustum(model, transform):
+        return True
+    return _GLI.fogCullDistance is not None and _modelBeyondFog(model, transform)
+
+# returns (center, radius) of a sphere that holds the model's bounding sphere after the draw3D transformation
+def _worldSphere((cx, cy, cz, radius), (x, y, z, anglex, angley, anglez, scale)):
+    if anglex == 0 and angley == 0 and anglez == 0:
+        return ((x + cx*scale, y + cy*scale, z + cz*scale), radius * abs(scale))
+    # rotating the model can move the sphere's center anywhere at the same distance from the origin
+    return ((x, y, z), (math.sqrt(cx*cx + cy*cy + cz*cz) + radius) * abs(scale))
+
+# the height in pixels that the bounding sphere covers on the screen after the draw3D transformation
+def _projectedSize(sphere, transform):
+    ((x, y, z), radius) = _worldSphere(sphere, transform)
+    camera = _GLI.cameraPosition
+    distance = math.sqrt((x - camera.x)**2 + (y - camera.y)**2 + (z - camera.z)**2)
+    if distance <= radius:
+        return float('inf')
+    f = 1.0 / math.tan(math.radians(_GLI.fieldOfView) / 2.0)
+    return radius / distance * f * _GLI.viewportHeight
+
+# Chooses which level of detail a model draws, from the size of the model on the screen.
+# screenSizes[k] is the size in pixels below which level k+1 is used, so the sizes get smaller.
+# A level only changes once the size is past the threshold by the hysteresis fraction,
+# so a model that sits near a threshold does not flicker between two levels.
+# The level of each draw of the model is remembered for the next frame by the order of the draws,
+# which stays the same as long as the program draws its objects in the same order.
+class LevelOfDetail:
+    def __init__(self, screenSizes, hysteresis=0.2):
+        self.screenSizes = list(screenSizes)
+        self.hysteresis = hysteresis
+        self.levels = []  # the level of each draw in the last frame
+        self.frameNumber = -1
+        self.drawNumber = 0
+
+    # returns the level for the model being drawn, 0 is the full model
+    def chooseLevel(self, boundingSphere):
+        transform = _GLI.modelTransform
+        if (transform is None or boundingSphere is None or _GLI.selectionDrawingOn or
+            _GLI.recordingScene is not None or len(self.screenSizes) == 0):
+            return 0
+        if self.frameNumber != _GLI.frameNumber:
+            self.frameNumber = _GLI.frameNumber
+            self.drawNumber = 0
+        size = _projectedSize(boundingSphere, transform)
+        sizes = self.screenSizes
+        if self.drawNumber < len(self.levels):
+            level = self.levels[self.drawNumber]
+            hysteresis = self.hysteresis
+        else:
+            level = 0
+            hysteresis = 0
+            self.levels.append(0)
+        while level > 0 and size > sizes[level - 1] * (1 + hysteresis):
+            level -= 1
+        while level < len(sizes) and size < sizes[level] * (1 - hysteresis):
+            level += 1
+        self.levels[self.drawNumber] = level
+        self.drawNumber += 1
+        return level
+
 def getCameraPosition():
     return (_GLI.cameraPosition.x, _GLI.cameraPosition.y, _GLI.cameraPosition.z)
 
@@ -1072,6 +1753,19 @@ def adjustCameraRotation(heading, pitch, roll):
 def getCameraRotation():
     return (_GLI.cameraAngles.heading, _GLI.cameraAngles.pitch, _GLI.cameraAngles.roll)
 
+# Draws the current frame from another camera position and rotation, for example between the
+#  camera's last two updates with getInterpolationAlpha().  Call it at the start of the draw function,
+#  after the frame the camera goes back to where the update function left it.
+def setFrameCamera(x, y, z, heading, pitch, roll):
+    if _GLI.frameCamera is None:
+        _GLI.frameCamera = (getCameraPosition(), getCameraRotation())
+    setCameraPosition(x, y, z)
+    setCameraRotation(heading, pitch, roll)
+    glLoadIdentity()
+    setupCamera()
+    _updateFrustum()
+    _drawLights()
+
 #########################################################
 #########################################################
 #########################################################
@@ -1087,7 +1781,15 @@ class Canvas2D:
         if self.transparent:
             surfaceflags |= pygame.SRCALPHA
         self.image = pygame.Surface((width,height), surfaceflags)
+        # setting dirty to True means the whole image changed (the drawing functions use markDirty instead)
         self.dirty = True
+        self.imageData = None
+        self.imageBuffer = None  # bytearray holding imageData, so changed parts can be replaced
+        self.imageDataRects = []  # parts of the image changed since imageData was made
+        self.textureID = 0
+        self.textureRects = []  # parts of the image changed since the texture was updated
+        self.uploadedData = {}  # key = (x,y,width,height), value = pixels last copied there in the texture
+        self.maxDirtyRects = 32
         self.frameRate = frameRate
         if self.frameRate > 0:
             self.framesToWait = _GLI.frameRate / float(self.frameRate)
@@ -1095,14 +1797,94 @@ class Canvas2D:
             self.framesToWait = 0
         self.frameCount = self.framesToWait
 
+    # turns the dirty flag into a rectangle that covers everything
+    def checkDirtyFlag(self):
+        if self.dirty:
+            self.dirty = False
+            self.markDirty()
+
     def getImageData(self):
         self.frameCount += 1
-        if self.dirty and self.frameCount >= self.framesToWait:
-            self.imageData = pygame.image.tostring(self.image, "RGBA", True)
-            self.dirty = False
+        self.checkDirtyFlag()
+        if len(self.imageDataRects) > 0 and self.frameCount >= self.framesToWait:
             self.frameCount = 0
+            fullRect = self.image.get_rect()
+            if self.imageBuffer is None or self.imageDataRects == [fullRect]:
+                self.imageBuffer = bytearray(pygame.image.tostring(self.image, "RGBA", True))
+                changed = True
+            else:
+                changed = False
+                for rect in self.imageDataRects:
+                    if self.copyIntoImageBuffer(rect):
+                        changed = True
+            self.imageDataRects = []
+            if changed or self.imageData is None:
+                self.imageData = str(self.imageBuffer)
         return self.imageData
 
+    # copies one rectangle of the image into the flipped imageBuffer, returns True if any pixels changed
+    def copyIntoImageBuffer(self, rect):
+        data = pygame.image.tostring(self.image.subsurface(rect), "RGBA", True)
+        rowLength = rect.width * 4
+        changed = False
+        # the subsurface is flipped too, so its first row is the lowest row of the rectangle
+        for row in range(rect.height):
+            start = ((self.height - rect.bottom + row) * self.width + rect.x) * 4
+            rowData = data[row*rowLength : (row+1)*rowLength]
+            if self.imageBuffer[start : start+rowLength] != rowData:
+                self.imageBuffer[start : start+rowLength] = rowData
+                changed = True
+        return changed
+
+    # called by the drawing functions with the pygame Rect that they changed (None means everything)
+    def markDirty(self, rect=None):
+        if rect is None:
+            rect = self.image.get_rect()
+        else:
+            rect = rect.clip(self.image.get_rect())
+            if rect.width == 0 or rect.height == 0:
+                return
+        _addDirtyRect(self.imageDataRects, rect, self.maxDirtyRects)
+        _addDirtyRect(self.textureRects, rect, self.maxDirtyRects)
+
+    # creates the canvas texture or copies the changed parts of the image into it, and binds it
+    def updateTexture(self):
+        _profileBegin("textures")
+        self.uploadTexture()
+        _profileEnd()
+
+    def uploadTexture(self):
+        self.frameCount += 1
+        self.checkDirtyFlag()
+        if self.textureID == 0:
+            self.textureID = glGenTextures(1)
+            _bindTexture(self.textureID)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            # the rows are not flipped, so texture row 0 is the top of the canvas
+            textureData = pygame.image.tostring(self.image, "RGBA", False)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+            _countTextureUpload(len(textureData))
+            self.textureRects = []
+            self.frameCount = 0
+            return
+        _bindTexture(self.textureID)
+        if len(self.textureRects) > 0 and self.frameCount >= self.framesToWait:
+            # the rectangles never overlap, so a rectangle redrawn with the same pixels as last time can be skipped
+            uploadedData = {}
+            for rect in self.textureRects:
+                key = (rect.x, rect.y, rect.width, rect.height)
+                textureData = pygame.image.tostring(self.image.subsurface(rect), "RGBA", False)
+                if self.uploadedData.get(key) != textureData:
+                    glTexSubImage2D(GL_TEXTURE_2D, 0, rect.x, rect.y, rect.width, rect.height, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+                    _countTextureUpload(len(textureData))
+                uploadedData[key] = textureData
+            self.uploadedData = uploadedData
+            self.textureRects = []
+            self.frameCount = 0
+
     def lookupColor(self, color):
         if self.transparent:
             a = self.opacity
@@ -1122,71 +1904,89 @@ class Canvas2D:
         b = int(b*255)
         return (r,g,b,a)
 
+# adds rect to a list of rectangles that never overlap, merging it with any rectangle that it touches
+def _addDirtyRect(rects, rect, maxRects):
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            if rects[i].inflate(2, 2).colliderect(rect):
+                rect = rect.union(rects.pop(i))
+                merged = True
+                break
+    rects.append(rect)
+    if len(rects) > maxRects:
+        rects[:] = [rects[0].unionall(rects[1:])]
+
 def clearCanvas2D(canvas, color='clear'):
     canvas.image.fill(canvas.lookupColor(color))
-    canvas.dirty = True
+    canvas.markDirty()
 
 def drawPoint2D(canvas, x, y, color=None):
     canvas.image.set_at((int(x),int(y)), canvas.lookupColor(color))
-    canvas.dirty = True
+    canvas.markDirty(pygame.Rect(int(x), int(y), 1, 1))
 
 def drawLine2D(canvas, x1, y1, x2, y2, color=None, thickness=1):
-    pygame.draw.line(canvas.image, canvas.lookupColor(color), (int(x1),int(y1)), (int(x2),int(y2)), int(thickness))
-    canvas.dirty = True
+    rect = pygame.draw.line(canvas.image, canvas.lookupColor(color), (int(x1),int(y1)), (int(x2),int(y2)), int(thickness))
+    canvas.markDirty(rect)
 
 def drawCircle2D(canvas, x, y, radius, color=None, thickness=1):
-    pygame.draw.circle(canvas.image, canvas.lookupColor(color), (int(x),int(y)), int(radius), int(thickness))
-    canvas.dirty = True
+    rect = pygame.draw.circle(canvas.image, canvas.lookupColor(color), (int(x),int(y)), int(radius), int(thickness))
+    canvas.markDirty(rect)
 
 def fillCircle2D(canvas, x, y, radius, color=None):
     drawCircle2D(canvas, x, y, radius, color, 0)
 
 def drawEllipse2D(canvas, x, y, width, height, color=None, thickness=1):
-    pygame.draw.ellipse(canvas.image, canvas.lookupColor(color), pygame.Rect(int(x-width/2), int(y-height/2), int(width), int(height)), int(thickness))
-    canvas.dirty = True
+    rect = pygame.draw.ellipse(canvas.image, canvas.lookupColor(color), pygame.Rect(int(x-width/2), int(y-height/2), int(width), int(height)), int(thickness))
+    canvas.markDirty(rect)
 
 def fillEllipse2D(canvas, x, y, width, height, color=None):
     drawEllipse2D(canvas, x, y, width, height, color, 0)
 
 def drawRectangle2D(canvas, x, y, width, height, color=None, thickness=1):
-    pygame.draw.rect(canvas.image, canvas.lookupColor(color), pygame.Rect(int(x),int(y),int(width),int(height)), int(thickness))
-    canvas.dirty = True
+    rect = pygame.draw.rect(canvas.image, canvas.lookupColor(color), pygame.Rect(int(x),int(y),int(width),int(height)), int(thickness))
+    canvas.markDirty(rect)
 
 def fillRectangle2D(canvas, x, y, width, height, color=None):
     drawRectangle2D(canvas, x, y, width, height, color, 0)
 
 def drawPolygon2D(canvas, pointlist, color=None, thickness=1):
-    pygame.draw.polygon(canvas.image, canvas.lookupColor(color), pointlist, int(thickness))
-    canvas.dirty = True
+    rect = pygame.draw.polygon(canvas.image, canvas.lookupColor(color), pointlist, int(thickness))
+    canvas.markDirty(rect)
     
 def fillPolygon2D(canvas, pointlist, color=None):
     drawPolygon2D(canvas, pointlist, color, 0)
 
 
-def drawString2D(canvas, text, x, y, size=30, color=None, bold=False, italic=False, font=None):
+def getFont(size=30, bold=False, italic=False, font=None):
     fontSignature = (font,size,bold,italic)
     if fontSignature not in _GLI.fonts:
-        font = pygame.font.SysFont(font, size, bold, italic)
-        _GLI.fonts[fontSignature] = font
-    else:
-        font = _GLI.fonts[fontSignature]
+        _GLI.fonts[fontSignature] = pygame.font.SysFont(font, size, bold, italic)
+    return _GLI.fonts[fontSignature]
+
+def setTextCacheSize(maxBytes):
+    _GLI.textCache.maxBytes = maxBytes
+
+def getTextCacheStats():
+    return _GLI.textCache.getStats()
+
+def drawString2D(canvas, text, x, y, size=30, color=None, bold=False, italic=False, font=None):
+    fontSignature = (font,size,bold,italic)
+    font = getFont(size, bold, italic, font)
     color = canvas.lookupColor(color)
-    textimage = font.render(str(text), False, color)
     if canvas.transparent:
-        textimage.set_alpha(canvas.opacity)
-    canvas.image.blit(textimage, (int(x), int(y)))
-    canvas.dirty = True
+        textimage = _GLI.textCache.getSurface(font, fontSignature, str(text), color, canvas.opacity)
+    else:
+        textimage = _GLI.textCache.getSurface(font, fontSignature, str(text), color)
+    rect = canvas.image.blit(textimage, (int(x), int(y)))
+    canvas.markDirty(rect)
     return (textimage.get_width(), textimage.get_height())
 
 def sizeString(text, size=30, bold=False, italic=False, font=None):
     fontSignature = (font,size,bold,italic)
-    if fontSignature not in _GLI.fonts:
-        font = pygame.font.SysFont(font, size, bold, italic)
-        _GLI.fonts[fontSignature] = font
-    else:
-        font = _GLI.fonts[fontSignature]
-    textimage = font.render(str(text), False, (1,1,1))
-    return (textimage.get_width(), textimage.get_height())
+    font = getFont(size, bold, italic, font)
+    return _GLI.textCache.getSize(font, fontSignature, str(text))
  
 def getFontList():
     return pygame.font.get_fonts()
@@ -1208,8 +2008,8 @@ def drawImage2D(canvas, image, x, y, rotate=0, scale=1, flipHorizontal=False, fl
         image = pygame.transform.rotozoom(image, rotate, scale)
     if canvas.transparent:
         image.set_alpha(canvas.opacity)
-    canvas.image.blit(image, (int(x-image.get_width()/2),int(y-image.get_height()/2)))
-    canvas.dirty = True
+    rect = canvas.image.blit(image, (int(x-image.get_width()/2),int(y-image.get_height()/2)))
+    canvas.markDirty(rect)
 
 def getImageWidth(image):
     return image.get_width()
@@ -1223,6 +2023,9 @@ def getImagePixel(image, x, y):
 def resizeImage(image, width, height):
     return pygame.transform.scale(image, (int(width), int(height)))
 
+def getImageRegion(image, x, y, width, height):
+    return image.subsurface(pygame.Rect(int(x),int(y),int(width),int(height)))
+
 def tileImage(image, horizontalRepeat, verticalRepeat):
     if isinstance(image, str):
         image = loadImage(image)
@@ -1240,13 +2043,133 @@ def tileImage(image, horizontalRepeat, verticalRepeat):
 def saveImage(image, filename):
     pygame.image.save(image, filename)
 
+# saves the window's image, when called while runGraphics is running, this is the frame
+#  drawn after the call (so from the update function it is the frame of that update)
 def saveScreenShot(filename):
-    pygame.image.save(_GLI.screen, filename)
+    if _GLI.currentMode in (_GLI.EVENT_MODE, _GLI.UPDATE_MODE, _GLI.DRAW_MODE):
+        _GLI.screenShots.append(filename)
+    else:
+        _saveFrame(filename)
+
+# the window's surface has no pixels with OpenGL, so the frame is read back from OpenGL
+def _saveFrame(filename):
+    glReadBuffer(_GLI.mainDrawBuffer)
+    data = glReadPixels(0, 0, _GLI.windowWidth, _GLI.windowHeight, GL_RGBA, GL_UNSIGNED_BYTE)
+    if not isinstance(data, str):
+        data = data.tostring()
+    image = pygame.image.fromstring(data, (_GLI.windowWidth, _GLI.windowHeight), "RGBA", True)
+    pygame.image.save(image, filename)
+
+def _saveScreenShots():
+    for filename in _GLI.screenShots:
+        _saveFrame(filename)
+    _GLI.screenShots = []
 
 #########################################################
 #########################################################
 
+# These keep track of the texture, array buffer, interleaved arrays and capabilities that are set,
+# so setting them again to the same thing does not make a GL call.
+# Code that changes them with GL calls of its own should call resetStateCache afterwards.
+def _bindTexture(textureID):
+    if _GLI.boundTexture != textureID:
+        glBindTexture(GL_TEXTURE_2D, textureID)
+        _GLI.boundTexture = textureID
+        _GLI.textureBindCount += 1
+
+def _bindArrayBuffer(bufferID):
+    if _GLI.boundArrayBuffer != bufferID:
+        glBindBuffer(GL_ARRAY_BUFFER, bufferID)
+        _GLI.boundArrayBuffer = bufferID
+        _GLI.bufferBindCount += 1
+
+def _setInterleavedArrays(format, bufferID):
+    if _GLI.interleavedArrays != (format, bufferID):
+        _bindArrayBuffer(bufferID)
+        glInterleavedArrays(format, 0, None)
+        _GLI.interleavedArrays = (format, bufferID)
+
+def _setEnabled(capability, isEnabled):
+    if _GLI.enabledCaps.get(capability) != isEnabled:
+        if isEnabled:
+            glEnable(capability)
+        else:
+            glDisable(capability)
+        _GLI.enabledCaps[capability] = isEnabled
+
+# a deleted buffer's ID can be given out again, so it must not look bound anymore
+def _forgetArrayBuffer(bufferID):
+    if _GLI.boundArrayBuffer == bufferID:
+        _GLI.boundArrayBuffer = None
+    if _GLI.interleavedArrays is not None and _GLI.interleavedArrays[1] == bufferID:
+        _GLI.interleavedArrays = None
+
+def resetStateCache():
+    _GLI.boundTexture = None
+    _GLI.boundArrayBuffer = None
+    _GLI.interleavedArrays = None
+    _GLI.enabledCaps = dict()
+
+# When enabled, draw3D calls whose position in the world is known are queued and drawn
+# sorted by texture and vertex format at the end of the frame, so fewer bindings change.
+# The queue is also drawn before anything that changes how models look (fog, lights,
+# viewports and draw2D), so it is meant for opaque models, which can be drawn in any order.
+def enableDrawQueue(isEnabled):
+    _flushDrawQueue()
+    _GLI.drawQueueEnabled = isEnabled
+
+def _drawSortKey(model):
+    textureID = getattr(model, 'textureID', 0)
+    buffers = getattr(model, 'buffers', None)
+    format = getattr(buffers, 'format', 0)
+    return (textureID, format)
+
+def _flushDrawQueue():
+    if len(_GLI.drawQueue) == 0:
+        return
+    queue = _GLI.drawQueue
+    _GLI.drawQueue = []
+    queue.sort()
+    # the queued models were submitted with only the camera transformation active
+    if _GLI.numPushedMatrices > 0:
+        glPushMatrix()
+        glLoadIdentity()
+        setupCamera()
+    for (sortKey, number, model, transform) in queue:
+        _drawModel(model, transform, transform)
+    if _GLI.numPushedMatrices > 0:
+        glPopMatrix()
+
 def draw3D(model, x=0, y=0, z=0, anglex=0, angley=0, anglez=0, scale=1):
+    if _GLI.recordingScene is not None and _GLI.drawDepth == 0:
+        _GLI.recordingScene.record(model, (x, y, z, anglex, angley, anglez, scale))
+        return
+    # the model's position in world coordinates is only known when no other transformations are active
+    if _GLI.drawDepth == 0 and _GLI.numPushedMatrices == 0:
+        transform = (x, y, z, anglex, angley, anglez, scale)
+    else:
+        transform = None
+    if not getattr(model, 'cullsChunks', False):
+        if transform is not None and _modelCulled(model, transform):
+            _GLI.culledCount += 1
+            return
+        _GLI.drawnCount += 1
+    if _GLI.fogCullDistance is not None and _GLI.fogCullDistance > _GLI.frameFogRange:
+        _GLI.frameFogRange = _GLI.fogCullDistance
+    if transform is not None and _GLI.drawQueueEnabled and not _GLI.selectionDrawingOn:
+        _GLI.drawQueue.append((_drawSortKey(model), len(_GLI.drawQueue), model, transform))
+        return
+    _drawModel(model, (x, y, z, anglex, angley, anglez, scale), transform)
+
+# transform is the model's (x, y, z, anglex, angley, anglez, scale) in the current coordinates,
+#  worldTransform is the same thing in world coordinates, or None if that is not known
+def _drawModel(model, transform, worldTransform=None):
+    if worldTransform is None and _GLI.drawDepth == 0 and _GLI.numPushedMatrices == 0:
+        worldTransform = transform
+    (x, y, z, anglex, angley, anglez, scale) = transform
+    profiling = _GLI.profiler is not None and _GLI.drawDepth == 0
+    if profiling:
+        _GLI.profiler.begin("draw3D")
     glPushMatrix()
     if x != 0 or y != 0 or z != 0:
         glTranslate(x, y, z)
@@ -1256,17 +2179,124 @@ def draw3D(model, x=0, y=0, z=0, anglex=0, angley=0, anglez=0, scale=1):
         glRotate(anglex, 1, 0, 0)
     if anglez != 0:
         glRotate(anglez, 0, 0, 1)
+    # inside another model, only turn rescaling on, since the outer model may still need it
+    if scale != 1 or _GLI.drawDepth == 0:
+        _setEnabled(GL_RESCALE_NORMAL, scale != 1)
     if scale != 1:
-        glEnable(GL_RESCALE_NORMAL)
         glScale(scale, scale, scale)
+    _GLI.drawDepth += 1
+    _GLI.modelTransform = worldTransform
     model.draw()
-    if scale != 1:
-        glDisable(GL_RESCALE_NORMAL)
+    _GLI.modelTransform = None
+    _GLI.drawDepth -= 1
     glPopMatrix()
+    if profiling:
+        _GLI.profiler.end()
+
+# A sequence of draw3D calls that is recorded once and replayed every frame.
+# With display lists, the GL commands are compiled by the driver and replayed with glCallList.
+# Otherwise the calls are kept as a command array sorted by texture and vertex format,
+# which is replayed without going through draw3D and is still frustum culled.
+# The recorded models are drawn completely, so the culling and the visible chunks of a
+# StaticBatch3D are ignored while recording, and instanced sets use their batch.
+class RecordedScene:
+    def __init__(self, label, useDisplayList):
+        self.label = label
+        self.listID = 0
+        self.commands = []  # list of (sort key, submission number, model, transform)
+        self.polygonCount = 0
+        self.drawnCount = 0
+        if useDisplayList:
+            self.listID = glGenLists(1)
+
+    def record(self, model, transform):
+        self.drawnCount += 1
+        if self.listID != 0:
+            _drawModel(model, transform)
+        else:
+            if _GLI.numPushedMatrices > 0:
+                raise ValueError("a scene without display lists can only record draw3D calls outside of other transformations")
+            self.commands.append((_drawSortKey(model), len(self.commands), model, transform))
+
+    def replay(self):
+        if self.listID != 0:
+            _profileBegin("draw3D")
+            glCallList(self.listID)
+            _profileEnd()
+            _GLI.drawCallCount += 1
+            # the list changed bindings behind the state shadow's back
+            resetStateCache()
+            _GLI.polygonCount += self.polygonCount
+            _GLI.drawnCount += self.drawnCount
+            return
+        for (sortKey, number, model, transform) in self.commands:
+            if not getattr(model, 'cullsChunks', False) and _modelCulled(model, transform):
+                _GLI.culledCount += 1
+                continue
+            _GLI.drawnCount += 1
+            _drawModel(model, transform, transform)
+
+    def delete(self):
+        if self.listID != 0:
+            glDeleteLists(self.listID, 1)
+            self.listID = 0
+        self.commands = []
+
+# starts recording the following draw3D calls as the scene with this label, until endScene
+#  the calls are recorded but not drawn, call replayScene to draw them
+def recordScene(label):
+    if _GLI.recordingScene is not None:
+        raise ValueError("already recording scene " + str(_GLI.recordingScene.label))
+    _flushDrawQueue()
+    invalidateScene(label)
+    scene = RecordedScene(label, _GLI.useDisplayLists)
+    _GLI.recordingScene = scene
+    scene.savedPolygonCount = _GLI.polygonCount
+    if scene.listID != 0:
+        resetStateCache()
+        glNewList(scene.listID, GL_COMPILE)
+
+def endScene():
+    scene = _GLI.recordingScene
+    if scene is None:
+        raise ValueError("endScene called without recordScene")
+    if scene.listID != 0:
+        glEndList()
+        resetStateCache()
+        scene.polygonCount = _GLI.polygonCount - scene.savedPolygonCount
+        _GLI.polygonCount = scene.savedPolygonCount
+    else:
+        scene.commands.sort()
+    _GLI.recordingScene = None
+    _GLI.scenes[scene.label] = scene
+
+def replayScene(label):
+    if label not in _GLI.scenes:
+        raise ValueError("no recorded scene: " + str(label))
+    _GLI.scenes[label].replay()
+
+def hasScene(label):
+    return label in _GLI.scenes
+
+# deletes the recorded scene, it must be recorded again after the models in it change
+def invalidateScene(label):
+    if label in _GLI.scenes:
+        _GLI.scenes[label].delete()
+        del _GLI.scenes[label]
 
 def draw2D(canvas, x, y):
     if _GLI.selectionDrawingOn:
         return
+    _flushDrawQueue()
+    _profileBegin("draw2D")
+    if _GLI.useCanvasTextures:
+        _drawCanvasTexture(canvas, x, y)
+    else:
+        _drawCanvasPixels(canvas, x, y)
+    _profileEnd()
+
+# sends the canvas image with glDrawPixels
+def _drawCanvasPixels(canvas, x, y):
     # _GLI.hasWindowPos = False # TESTING!
     if _GLI.textureMapsEnabled:
         glDisable(GL_TEXTURE_2D)
@@ -1290,7 +2320,12 @@ def draw2D(canvas, x, y):
         glPushMatrix()
         glLoadIdentity()
         glRasterPos2d(x,y)
-    glDrawPixels(canvas.width, canvas.height, GL_RGBA, GL_UNSIGNED_BYTE, canvas.getImageData())
+    _profileBegin("textures")
+    imageData = canvas.getImageData()
+    _profileEnd()
+    glDrawPixels(canvas.width, canvas.height, GL_RGBA, GL_UNSIGNED_BYTE, imageData)
+    _GLI.drawCallCount += 1
+    _countTextureUpload(len(imageData))
     if not _GLI.hasWindowPos:
         glMatrixMode(GL_PROJECTION)
         glPopMatrix()
@@ -1302,6 +2337,188 @@ def draw2D(canvas, x, y):
         glEnable(GL_LIGHTING)
     glEnable(GL_DEPTH_TEST)
 
+# draws the canvas texture as one rectangle in the viewport's pixel coordinates
+def _drawCanvasTexture(canvas, x, y):
+    canvas.updateTexture()
+    glEnable(GL_TEXTURE_2D)
+    if _GLI.lightingEnabled:
+        glDisable(GL_LIGHTING)
+    if _GLI.fogMode != 0:
+        glDisable(GL_FOG)
+    glDisable(GL_DEPTH_TEST)
+    glMatrixMode(GL_PROJECTION)
+    glPushMatrix()
+    glLoadIdentity()
+    gluOrtho2D(0, _GLI.viewportWidth, _GLI.viewportHeight, 0)
+    glMatrixMode(GL_MODELVIEW)
+    glPushMatrix()
+    glLoadIdentity()
+    glColor4f(1, 1, 1, 1)
+    glBegin(GL_QUADS)
+    glTexCoord2f(0, 0)
+    glVertex2f(x, y)
+    glTexCoord2f(0, 1)
+    glVertex2f(x, y + canvas.height)
+    glTexCoord2f(1, 1)
+    glVertex2f(x + canvas.width, y + canvas.height)
+    glTexCoord2f(1, 0)
+    glVertex2f(x + canvas.width, y)
+    glEnd()
+    _GLI.drawCallCount += 1
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    glPopMatrix()
+    if not _GLI.textureMapsEnabled:
+        glDisable(GL_TEXTURE_2D)
+    if _GLI.lightingEnabled:
+        glEnable(GL_LIGHTING)
+    if _GLI.fogMode != 0:
+        glEnable(GL_FOG)
+    glEnable(GL_DEPTH_TEST)
+
+
+# A bitmap font: every character of one font is rendered once into a single texture,
+# so drawing text is just a list of textured rectangles and never touches a pygame surface.
+class GlyphAtlas:
+    def __init__(self, font, characters=None, atlasWidth=512):
+        if characters is None:
+            characters = [chr(code) for code in range(32, 127)]
+        self.lineHeight = font.get_height()
+        self.glyphs = dict()  # key = character, value = (x, y, width, height) in the atlas image
+        images = []
+        x = 0
+        y = 0
+        for character in characters:
+            image = font.render(character, True, (255,255,255))
+            if x + image.get_width() > atlasWidth:
+                x = 0
+                y += self.lineHeight + 1
+            self.glyphs[character] = (x, y, image.get_width(), image.get_height())
+            images.append((image, x, y))
+            x += image.get_width() + 1
+        self.width = atlasWidth
+        self.height = 1
+        while self.height < y + self.lineHeight:
+            self.height *= 2
+        # white with zero alpha, so the edges of the antialiased glyphs blend to white
+        self.image = pygame.Surface((self.width, self.height), pygame.SRCALPHA, 32)
+        self.image.fill((255,255,255,0))
+        for (image, x, y) in images:
+            self.image.blit(image, (x, y))
+        self.textureID = 0
+
+    # the texture is made the first time it is drawn, since that needs an OpenGL context
+    def getTextureID(self):
+        if self.textureID == 0:
+            self.textureID = glGenTextures(1)
+            _bindTexture(self.textureID)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            textureData = pygame.image.tostring(self.image, "RGBA", False)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, textureData)
+            _countTextureUpload(len(textureData))
+        return self.textureID
+
+    def getGlyph(self, character):
+        if character in self.glyphs:
+            return self.glyphs[character]
+        return self.glyphs.get('?', (0, 0, 0, 0))
+
+    def sizeText(self, text):
+        width = 0
+        for character in text:
+            width += self.getGlyph(character)[2]
+        return (width, self.lineHeight)
+
+    # adds the rectangles for text, must be called between glBegin(GL_QUADS) and glEnd()
+    def addQuads(self, text, x, y):
+        for character in text:
+            (glyphx, glyphy, width, height) = self.getGlyph(character)
+            u1 = glyphx / float(self.width)
+            v1 = glyphy / float(self.height)
+            u2 = (glyphx + width) / float(self.width)
+            v2 = (glyphy + height) / float(self.height)
+            glTexCoord2f(u1, v1)
+            glVertex2f(x, y)
+            glTexCoord2f(u1, v2)
+            glVertex2f(x, y + height)
+            glTexCoord2f(u2, v2)
+            glVertex2f(x + width, y + height)
+            glTexCoord2f(u2, v1)
+            glVertex2f(x + width, y)
+            x += width
+
+def _getGlyphAtlas(size, bold, italic, font):
+    fontSignature = (font,size,bold,italic)
+    if fontSignature not in _GLI.glyphAtlases:
+        _GLI.glyphAtlases[fontSignature] = GlyphAtlas(getFont(size, bold, italic, font))
+    return _GLI.glyphAtlases[fontSignature]
+
+# Queues text to be drawn on top of the current viewport at the end of the frame, (x, y) is the top left corner.
+# All of the overlay text in a frame is drawn with one batch of rectangles per font,
+# so text that changes every frame costs no more than text that stays the same.
+def drawText3DOverlay(text, x, y, size=30, color=None, bold=False, italic=False, font=None):
+    atlas = _getGlyphAtlas(size, bold, italic, font)
+    text = str(text)
+    if not _GLI.selectionDrawingOn:
+        if color is None:
+            color = _GLI.foreground
+        color = lookupColor3D(color)
+        if len(color) == 3:
+            color = (color[0], color[1], color[2], 1)
+        _GLI.textOverlay.append((atlas, text, int(x), int(y), color))
+    return atlas.sizeText(text)
+
+def sizeText3DOverlay(text, size=30, bold=False, italic=False, font=None):
+    return _getGlyphAtlas(size, bold, italic, font).sizeText(str(text))
+
+def _drawTextOverlay():
+    if len(_GLI.textOverlay) == 0:
+        return
+    batches = dict()  # key = GlyphAtlas, value = list of (text, x, y, color)
+    for (atlas, text, x, y, color) in _GLI.textOverlay:
+        if atlas not in batches:
+            batches[atlas] = []
+        batches[atlas].append((text, x, y, color))
+    _GLI.textOverlay = []
+    _profileBegin("draw2D")
+    glEnable(GL_TEXTURE_2D)
+    if _GLI.lightingEnabled:
+        glDisable(GL_LIGHTING)
+    if _GLI.fogMode != 0:
+        glDisable(GL_FOG)
+    glDisable(GL_DEPTH_TEST)
+    glMatrixMode(GL_PROJECTION)
+    glPushMatrix()
+    glLoadIdentity()
+    gluOrtho2D(0, _GLI.viewportWidth, _GLI.viewportHeight, 0)
+    glMatrixMode(GL_MODELVIEW)
+    glPushMatrix()
+    glLoadIdentity()
+    for atlas in batches:
+        _bindTexture(atlas.getTextureID())
+        glBegin(GL_QUADS)
+        for (text, x, y, color) in batches[atlas]:
+            glColor4f(*color)
+            atlas.addQuads(text, x, y)
+        glEnd()
+        _GLI.drawCallCount += 1
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    glPopMatrix()
+    if not _GLI.textureMapsEnabled:
+        glDisable(GL_TEXTURE_2D)
+    if _GLI.lightingEnabled:
+        glEnable(GL_LIGHTING)
+    if _GLI.fogMode != 0:
+        glEnable(GL_FOG)
+    glEnable(GL_DEPTH_TEST)
+    _profileEnd()
+
 #################################################################    
 
 def rotateXAxis(angle):
@@ -1334,11 +2551,86 @@ def endTransformation():
     glPopMatrix()
     _GLI.numPushedMatrices -= 1
 
+#################################################################
+# 4x4 matrices (lists of rows) that mirror what the OpenGL transformation calls do,
+#  for code that needs to transform points on the CPU
+
+def _identityMatrix():
+    return [[1,0,0,0], [0,1,0,0], [0,0,1,0], [0,0,0,1]]
+
+def _multiplyMatrices(a, b):
+    return [[a[r][0]*b[0][c] + a[r][1]*b[1][c] + a[r][2]*b[2][c] + a[r][3]*b[3][c] for c in range(4)]
+            for r in range(4)]
+
+def _translationMatrix(x, y, z):
+    return [[1,0,0,x], [0,1,0,y], [0,0,1,z], [0,0,0,1]]
+
+def _scaleMatrix(scale):
+    return [[scale,0,0,0], [0,scale,0,0], [0,0,scale,0], [0,0,0,1]]
+
+# same as glRotate: angle in degrees around the unit vector (x,y,z)
+def _rotationMatrix(angle, x, y, z):
+    radians = math.radians(angle)
+    c = math.cos(radians)
+    s = math.sin(radians)
+    t = 1 - c
+    return [[t*x*x + c,   t*x*y - s*z, t*x*z + s*y, 0],
+            [t*x*y + s*z, t*y*y + c,   t*y*z - s*x, 0],
+            [t*x*z - s*y, t*y*z + s*x, t*z*z + c,   0],
+            [0, 0, 0, 1]]
+
+# the transformation that draw3D applies to a model with the same arguments
+def _transformMatrix(x=0, y=0, z=0, anglex=0, angley=0, anglez=0, scale=1):
+    matrix = _translationMatrix(x, y, z)
+    if angley != 0:
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(angley, 0, 1, 0))
+    if anglex != 0:
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(anglex, 1, 0, 0))
+    if anglez != 0:
+        matrix = _multiplyMatrices(matrix, _rotationMatrix(anglez, 0, 0, 1))
+    if scale != 1:
+        matrix = _multiplyMatrices(matrix, _scaleMatrix(scale))
+    return matrix
+
+def _transformPoint(m, (x,y,z)):
+    return (m[0][0]*x + m[0][1]*y + m[0][2]*z + m[0][3],
+            m[1][0]*x + m[1][1]*y + m[1][2]*z + m[1][3],
+            m[2][0]*x + m[2][1]*y + m[2][2]*z + m[2][3])
+
+# like _transformPoint but ignores the translation (for normal vectors)
+def _transformDirection(m, (x,y,z)):
+    return (m[0][0]*x + m[0][1]*y + m[0][2]*z,
+            m[1][0]*x + m[1][1]*y + m[1][2]*z,
+            m[2][0]*x + m[2][1]*y + m[2][2]*z)
+
+# returns (minCorner, maxCorner) of an axis-aligned box that holds the transformed box
+def _transformBox(m, (minx,miny,minz), (maxx,maxy,maxz)):
+    corners = [_transformPoint(m, (x,y,z)) for x in (minx,maxx) for y in (miny,maxy) for z in (minz,maxz)]
+    minCorner = tuple([min([corner[i] for corner in corners]) for i in range(3)])
+    maxCorner = tuple([max([corner[i] for corner in corners]) for i in range(3)])
+    return (minCorner, maxCorner)
+
+# returns (centerX, centerY, centerZ, radius) of a sphere around all of the vertices, or None if there are none
+def _boundingSphere(vertices):
+    if vertices is None or len(vertices) == 0:
+        return None
+    if _GLI.hasNumPy and isinstance(vertices, numpy.ndarray):
+        points = vertices.reshape(len(vertices), -1)[:, :3]
+        center = (points.min(axis=0) + points.max(axis=0)) / 2.0
+        radius = math.sqrt(((points - center) ** 2).sum(axis=1).max())
+        return (float(center[0]), float(center[1]), float(center[2]), radius)
+    minCorner = [min([vertex[i] for vertex in vertices]) for i in range(3)]
+    maxCorner = [max([vertex[i] for vertex in vertices]) for i in range(3)]
+    (cx, cy, cz) = [(minCorner[i] + maxCorner[i]) / 2.0 for i in range(3)]
+    radius = math.sqrt(max([(x-cx)**2 + (y-cy)**2 + (z-cz)**2 for (x,y,z) in vertices]))
+    return (cx, cy, cz, radius)
+
 
 
 ##########################################################################
 
 def addLight(x=0, y=0, z=0, intensity=1.0):
+    _flushDrawQueue()
     if not _GLI.lightingEnabled:
         _GLI.lightingEnabled = True
         glEnable(GL_LIGHTING)
@@ -2350,63 +3642,177 @@ class Collada:
 #############################################################################
 #############################################################################
 
+def _hasItems(values):
+    return values is not None and len(values) > 0
+
+# returns (format, dataList) with the vertex attributes in the order that glInterleavedArrays expects
+# if vertexList is a NumPy array, the other attributes can be arrays too (one row per vertex),
+#  and dataList is a float32 array with one row per vertex
+def _interleaveArrays(vertexList, normalList, colorList, texCoordList):
+    colors = False
+    textures = False
+    normals = False
+    colorParts = 3
+    if _hasItems(normalList):
+        normals = True
+    if _hasItems(texCoordList):
+        textures = True
+    elif _hasItems(colorList):
+        colors = True
+    if normals:
+        if textures:
+            format = GL_T2F_N3F_V3F
+        elif colors:
+            format = GL_C4F_N3F_V3F
+            colorParts = 4
+        else:
+            format = GL_N3F_V3F
+    else:
+        if textures:
+            format = GL_T2F_V3F
+        elif colors:
+            format = GL_C3F_V3F
+        else:
+            format = GL_V3F
+    if _GLI.hasNumPy and isinstance(vertexList, numpy.ndarray):
+        numVertexes = len(vertexList)
+        parts = []
+        if textures:
+            parts.append(numpy.asarray(texCoordList, dtype=numpy.float32).reshape(numVertexes, -1))
+        elif colors:
+            colorArray = numpy.asarray(colorList, dtype=numpy.float32).reshape(numVertexes, -1)
+            if colorArray.shape[1] < colorParts:
+                colorArray = numpy.column_stack((colorArray, numpy.ones(numVertexes, dtype=numpy.float32)))
+            parts.append(colorArray[:, :colorParts])
+        if normals:
+            parts.append(numpy.asarray(normalList, dtype=numpy.float32).reshape(numVertexes, -1))
+        parts.append(numpy.asarray(vertexList, dtype=numpy.float32).reshape(numVertexes, -1))
+        # each part is copied into its columns of one contiguous array
+        dataArray = numpy.empty((numVertexes, sum([part.shape[1] for part in parts])), dtype=numpy.float32)
+        column = 0
+        for part in parts:
+            dataArray[:, column:column+part.shape[1]] = part
+            column += part.shape[1]
+        return (format, dataArray)
+    dataList = []
+    for i in range(len(vertexList)):
+        if textures:
+            dataList.extend(texCoordList[i])
+        elif colors:
+            if colorParts == len(colorList[i]):
+                dataList.extend(colorList[i])
+            elif colorParts == 4 and len(colorList[i]) == 3:
+                dataList.extend(colorList[i])
+                dataList.append(1.0)
+            elif colorParts == 3 and len(colorList[i]) == 4:
+                dataList.extend(colorList[i][:3])
+        if normals:
+            dataList.extend(normalList[i])
+        dataList.extend(vertexList[i])
+    return (format, dataList)
+
+# Finds the different vertexes in interleaved data with numVertexes vertexes,
+# and returns (data with each vertex once, index data, index type) in the order they are first used.
+def _indexVertices(dataList, numVertexes):
+    if _GLI.hasNumPy:
+        rows = numpy.asarray(dataList, dtype=numpy.float32).reshape(numVertexes, -1)
+        rows = numpy.ascontiguousarray(rows)
+        keys = rows.view(numpy.dtype((numpy.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+        (unused, first, inverse) = numpy.unique(keys, return_index=True, return_inverse=True)
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        uniqueData = rows[first[order]]
+        indexes = rank[inverse]
+        if len(order) <= 65536:
+            return (uniqueData, indexes.astype(numpy.uint16), GL_UNSIGNED_SHORT)
+        return (uniqueData, indexes.astype(numpy.uint32), GL_UNSIGNED_INT)
+    stride = len(dataList) / numVertexes
+    vertexIndex = dict()  # key = tuple of vertex data, value = index
+    uniqueData = []
+    indexes = []
+    for i in range(numVertexes):
+        vertex = tuple(dataList[i*stride : (i+1)*stride])
+        if vertex not in vertexIndex:
+            vertexIndex[vertex] = len(vertexIndex)
+            uniqueData.extend(vertex)
+        indexes.append(vertexIndex[vertex])
+    if len(vertexIndex) <= 65536:
+        return (uniqueData, array.array('H', indexes).tostring(), GL_UNSIGNED_SHORT)
+    return (uniqueData, array.array('I', indexes).tostring(), GL_UNSIGNED_INT)
+
+# Simplifies a triangle mesh by vertex clustering: the vertices are grouped into cubes of
+# cellSize, every vertex is replaced by the vertex of its cube that is closest to the cube's mean,
+# and the triangles that collapse (or end up the same as another triangle) are dropped.
+# positions is the (vertexes, 3) array, triangles is the (triangles, 3) array of vertex indexes,
+# and the result uses the same vertex indexes, so it can share the vertex buffer.
+def _clusterTriangles(positions, triangles, cellSize):
+    cells = numpy.floor((positions - positions.min(axis=0)) / cellSize).astype(numpy.int64)
+    size = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * size[1] + cells[:, 1]) * size[2] + cells[:, 2]
+    (unused, cluster) = numpy.unique(keys, return_inverse=True)
+    numClusters = int(cluster.max()) + 1
+    counts = numpy.bincount(cluster, minlength=numClusters).astype(numpy.float64)
+    means = numpy.column_stack([numpy.bincount(cluster, positions[:, axis], numClusters) for axis in range(3)])
+    means /= counts[:, numpy.newaxis]
+    distances = ((positions - means[cluster]) ** 2).sum(axis=1)
+    order = numpy.lexsort((distances, cluster))
+    (unused, first) = numpy.unique(cluster[order], return_index=True)
+    representative = order[first]  # indexed by cluster
+    clustered = representative[cluster[triangles]]
+    keep = ((clustered[:, 0] != clustered[:, 1]) & (clustered[:, 1] != clustered[:, 2]) &
+            (clustered[:, 0] != clustered[:, 2]))
+    clustered = clustered[keep]
+    if len(clustered) == 0:
+        return clustered
+    corners = numpy.ascontiguousarray(numpy.sort(clustered, axis=1))
+    keys = corners.view(numpy.dtype((numpy.void, corners.dtype.itemsize * 3))).ravel()
+    (unused, first) = numpy.unique(keys, return_index=True)
+    return clustered[numpy.sort(first)]
+
 class Shape3D:
 
     def __init__(self):
         self.selectionID = None
         self.bufferIDDict = {} # key = selection ID, value = Color Buffer ID
+        # (primitive, vertices, normals, colors, texCoords) for shapes that can be batched
+        self.geometry = None
 
     class Buffers:
-        def __init__(self, vertexList, normalList, colorList, texCoordList):
-            self.numVertexes = len(vertexList)
+        # interleaved is (format, data, numVertexes, boundingSphere, indexes) for data that is already interleaved,
+        #  data is a float32 array (or a string of float32 values) that is copied straight into the buffer,
+        #  and indexes is None or (index data, index type, number of indexes) for an element buffer
+        # indexed=True stores each different vertex once and draws them with an element buffer,
+        #  this only works with interleaved arrays and without selection
+        def __init__(self, vertexList, normalList, colorList, texCoordList, interleaved=None, indexed=False, keepArrays=False):
             self.selectionColorBufferID = 0
+            self.indexBufferID = 0
+            self.levels = []  # (index buffer ID, index type, number of indexes) of each reduced level of detail
+            self.arrays = None  # (vertex data, index data) when keepArrays is True
+            if interleaved is not None:
+                (self.format, data, self.numVertexes, self.boundingSphere, indexes) = interleaved
+                self.bufferID = self.configureDataBuffer(GL_ARRAY_BUFFER, data)
+                if indexes is not None:
+                    (indexData, self.indexType, self.numIndexes) = indexes
+                    self.indexBufferID = self.configureDataBuffer(GL_ELEMENT_ARRAY_BUFFER, indexData)
+                return
+            self.numVertexes = len(vertexList)
+            self.boundingSphere = _boundingSphere(vertexList)
             if not _GLI.useInterleavedArrays:
                 self.vertexBufferID   = self.configureVBOBuffer(vertexList)
                 self.normalBufferID   = self.configureVBOBuffer(normalList)
                 self.colorBufferID    = self.configureVBOBuffer(colorList)
                 self.texCoordBufferID = self.configureVBOBuffer(texCoordList)
             else: 
-                colors = False
-                textures = False
-                normals = False
-                colorParts = 3
-                if normalList is not None and normalList != []:
-                    normals = True
-                if texCoordList is not None and texCoordList != []:
-                    textures = True
-                elif colorList is not None and colorList != []:
-                    colors = True
-                if normals:
-                    if textures:
-                        self.format = GL_T2F_N3F_V3F
-                    elif colors:
-                        self.format = GL_C4F_N3F_V3F
-                        colorParts = 4
-                    else:
-                        self.format = GL_N3F_V3F
-                else:
-                    if textures:
-                        self.format = GL_T2F_V3F
-                    elif colors:
-                        self.format = GL_C3F_V3F
-                    else:
-                        self.format = GL_V3F
-                dataList = []
-                for i in range(len(vertexList)):
-                    if textures:
-                        dataList.extend(texCoordList[i])
-                    elif colors:
-                        if colorParts == len(colorList[i]):
-                            dataList.extend(colorList[i])
-                        elif colorParts == 4 and len(colorList[i]) == 3:
-                            dataList.extend(colorList[i])
-                            dataList.append(1.0)
-                        elif colorParts == 3 and len(colorList[i]) == 4:
-                            dataList.extend(colorList[i][:3])
-                    if normals:
-                        dataList.extend(normalList[i])
-                    dataList.extend(vertexList[i])
+                (self.format, dataList) = _interleaveArrays(vertexList, normalList, colorList, texCoordList)
+                indexData = None
+                if indexed and not _GLI.enableSelection and self.numVertexes > 0:
+                    (dataList, indexData, self.indexType) = _indexVertices(dataList, self.numVertexes)
+                    self.numIndexes = self.numVertexes
+                    self.indexBufferID = self.configureDataBuffer(GL_ELEMENT_ARRAY_BUFFER, indexData)
                 self.bufferID = self.configureVBOBuffer(dataList)
+                if keepArrays:
+                    self.arrays = (dataList, indexData)
 
                 if _GLI.enableSelection:
                     self.vertexBufferID = self.configureVBOBuffer(vertexList)
@@ -2416,24 +3822,77 @@ class Shape3D:
             if dataList is None or len(dataList)==0:
                 return 0
             bufferID = glGenBuffers(1)
-            glBindBuffer(GL_ARRAY_BUFFER, bufferID)
+            _bindArrayBuffer(bufferID)
             if _GLI.hasNumPy:
-                dataArray = numpy.array(dataList, dtype=numpy.float32)
+                dataArray = numpy.asarray(dataList, dtype=numpy.float32)
             else:
                 dataArray = _GLI.arrayHandler.asArray(dataList, GL_FLOAT)
             glBufferData(GL_ARRAY_BUFFER, dataArray, GL_STATIC_DRAW)
             return bufferID
 
+        # data is an array or a string that already has the buffer's layout
+        def configureDataBuffer(self, target, data):
+            bufferID = glGenBuffers(1)
+            # array buffers go through the binding cache, so it still knows which one is bound,
+            #  element buffers are not cached and are unbound again, like after drawing with them
+            if target == GL_ARRAY_BUFFER:
+                _bindArrayBuffer(bufferID)
+            else:
+                glBindBuffer(target, bufferID)
+            if isinstance(data, str):
+                glBufferData(target, len(data), data, GL_STATIC_DRAW)
+            else:
+                glBufferData(target, data, GL_STATIC_DRAW)
+            if target != GL_ARRAY_BUFFER:
+                glBindBuffer(target, 0)
+            return bufferID
+
         def delete(self):
+            _forgetArrayBuffer(self.bufferID)
             glDeleteBuffers(1, GLuint(self.bufferID))
+            if self.indexBufferID != 0:
+                glDeleteBuffers(1, GLuint(self.indexBufferID))
+            for (indexBufferID, indexType, numIndexes) in self.levels:
+                glDeleteBuffers(1, GLuint(indexBufferID))
+            self.levels = []
+
+        # adds an element buffer that draws a reduced version of the same vertexes
+        def addLevel(self, indexes):
+            if len(indexes) == 0 or int(indexes.max()) < 65536:
+                (indexes, indexType) = (indexes.astype(numpy.uint16), GL_UNSIGNED_SHORT)
+            else:
+                (indexes, indexType) = (indexes.astype(numpy.uint32), GL_UNSIGNED_INT)
+            self.levels.append((self.configureDataBuffer(GL_ELEMENT_ARRAY_BUFFER, indexes), indexType, len(indexes)))
+
+        # draws the selected buffers, count is the number of vertexes for buffers without an element buffer
+        #  level is 0 for the full buffers, or the number of a level added with addLevel
+        def draw(self, primitive, count=None, level=0):
+            if level > 0:
+                (indexBufferID, indexType, numIndexes) = self.levels[level - 1]
+                if numIndexes > 0:
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, indexBufferID)
+                    glDrawElements(primitive, numIndexes, indexType, None)
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+                    _GLI.drawCallCount += 1
+            elif self.indexBufferID != 0:
+                glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexBufferID)
+                glDrawElements(primitive, self.numIndexes, self.indexType, None)
+                glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+                _GLI.drawCallCount += 1
+            else:
+                if count is None:
+                    count = self.numVertexes
+                glDrawArrays(primitive, 0, count)
+                _GLI.drawCallCount += 1
 
         def select(self):
             if _GLI.enableSelection and _GLI.selectionDrawingOn:
-                glBindBuffer(GL_ARRAY_BUFFER, self.vertexBufferID)
+                _GLI.interleavedArrays = None
+                _bindArrayBuffer(self.vertexBufferID)
                 glVertexPointer(3, GL_FLOAT, 0, None)
 
                 if self.selectionColorBufferID != 0:
-                    glBindBuffer(GL_ARRAY_BUFFER, self.selectionColorBufferID)
+                    _bindArrayBuffer(self.selectionColorBufferID)
                     glEnableClientState(GL_COLOR_ARRAY)
                     glColorPointer(3, GL_FLOAT, 0, None)
                 else:
@@ -2441,29 +3900,29 @@ class Shape3D:
                 glDisableClientState(GL_TEXTURE_COORD_ARRAY)
                     
             elif _GLI.useInterleavedArrays:
-                glBindBuffer(GL_ARRAY_BUFFER, self.bufferID)
-                glInterleavedArrays(self.format, 0, None)
+                _setInterleavedArrays(self.format, self.bufferID)
                 
             else:
                 # if interleaved arrays is broken (like some versions of windows)
-                glBindBuffer(GL_ARRAY_BUFFER, self.vertexBufferID)
+                _GLI.interleavedArrays = None
+                _bindArrayBuffer(self.vertexBufferID)
                 glVertexPointer(3, GL_FLOAT, 0, None)
                 
-                glBindBuffer(GL_ARRAY_BUFFER, self.normalBufferID)
+                _bindArrayBuffer(self.normalBufferID)
                 if self.normalBufferID == 0:
                     glDisableClientState(GL_NORMAL_ARRAY)
                 else:
                     glEnableClientState(GL_NORMAL_ARRAY)
                     glNormalPointer(GL_FLOAT, 0, None)
                     
-                glBindBuffer(GL_ARRAY_BUFFER, self.colorBufferID)
+                _bindArrayBuffer(self.colorBufferID)
                 if self.colorBufferID == 0:
                     glDisableClientState(GL_COLOR_ARRAY)
                 else:
                     glEnableClientState(GL_COLOR_ARRAY)
                     glColorPointer(3, GL_FLOAT, 0, None)
                     
-                glBindBuffer(GL_ARRAY_BUFFER, self.texCoordBufferID)
+                _bindArrayBuffer(self.texCoordBufferID)
                 if self.texCoordBufferID == 0:
                     glDisableClientState(GL_TEXTURE_COORD_ARRAY)
                 else:
@@ -2474,6 +3933,13 @@ class Shape3D:
     def delete(self):
         self.buffers.delete()
 
+    # returns (centerX, centerY, centerZ, radius) in the model's own coordinates, or None if unknown
+    def getBoundingSphere(self):
+        buffers = getattr(self, 'buffers', None)
+        if buffers is None:
+            return None
+        return buffers.boundingSphere
+
     def setTexture(self, texture):
         if isinstance(texture, int) or isinstance(texture,long):
             self.textureID = texture
@@ -2485,9 +3951,9 @@ class Shape3D:
         if textureID is None:
             textureID = self.textureID
         if _GLI.enableSelection and _GLI.selectionDrawingOn:
-            glBindTexture(GL_TEXTURE_2D, 0)
+            _bindTexture(0)
         else:
-            glBindTexture(GL_TEXTURE_2D, textureID)
+            _bindTexture(textureID)
     
     def countPolygons(self, numPolygons):
         _GLI.polygonCount += numPolygons
@@ -2551,15 +4017,27 @@ def getSelectedObject(x, y):
 #############################################################################
 #############################################################################
 
+# lod is the number of reduced levels of detail, each one uses every other row and column
+#  of the level before it, lodSizes are the LevelOfDetail screen sizes of the reduced levels
 class GridShape3D(Shape3D):
   
-    def __init__(self, rows, cols, colors, texture, textureTiles=False):
+    def __init__(self, rows, cols, colors, texture, textureTiles=False, lod=0, lodSizes=None):
         Shape3D.__init__(self)
         self.rows = rows
         self.cols = cols
         self.colors = colors
         self.setTexture(texture)
         self.textureTiles = textureTiles
+        # stop before a level would have less than two rows or columns
+        while lod > 0 and min(rows, cols) / 2**lod < 2:
+            lod -= 1
+        self.lod = lod
+        if lodSizes is None:
+            # switch when a row of the next level would be about 8 pixels high
+            lodSizes = [8.0 * rows / 2**level for level in range(1, lod + 1)]
+        self.levelOfDetail = None
+        if lod > 0:
+            self.levelOfDetail = LevelOfDetail(lodSizes[:lod])
         self.vertices = []
         self.normals = []
         self.textures = []
@@ -2569,18 +4047,35 @@ class GridShape3D(Shape3D):
             self.textures.append([0]*(cols+1))
 
     def save(self):
+        self.levelBuffers = []  # (buffers, number of quads) of each reduced level
+        # the full grid is saved last, so the lists below keep its vertexes
+        for level in range(self.lod, -1, -1):
+            step = 2**level
+            rowList = range(0, self.rows, step) + [self.rows]
+            colList = range(0, self.cols, step) + [self.cols]
+            self.saveGrid(rowList, colList)
+            buffers = self.Buffers(self.vertexList, self.normalList, self.colorList, self.texCoordList)
+            if level > 0:
+                self.levelBuffers.insert(0, (buffers, (len(rowList) - 1) * (len(colList) - 1)))
+        self.buffers = buffers
+        self.geometry = (GL_QUADS, self.vertexList, self.normalList, self.colorList, self.texCoordList)
+
+    # saves the quads between the given rows and columns of the grid
+    def saveGrid(self, rowList, colList):
         self.vertexList = []
         self.colorList = []
         self.normalList = []
         self.texCoordList = []
         colorIndex = 0
-        for row in xrange(self.rows):
-            colorIndex = row % len(self.colors)
-            for col in xrange(self.cols):
-                self.saveVertex(row, col,     1,1)
-                self.saveVertex(row, col+1,   0,1)
-                self.saveVertex(row+1, col+1, 0,0)
-                self.saveVertex(row+1, col,   1,0)
+        for i in xrange(len(rowList) - 1):
+            (row, nextRow) = (rowList[i], rowList[i+1])
+            colorIndex = i % len(self.colors)
+            for j in xrange(len(colList) - 1):
+                (col, nextCol) = (colList[j], colList[j+1])
+                self.saveVertex(row, col,         1,1)
+                self.saveVertex(row, nextCol,     0,1)
+                self.saveVertex(nextRow, nextCol, 0,0)
+                self.saveVertex(nextRow, col,     1,0)
                 color = self.colors[colorIndex]
                 self.colorList.extend([lookupColor3D(color)] * 4)
                 colorIndex = (colorIndex+1) % len(self.colors)
@@ -2588,7 +4083,6 @@ class GridShape3D(Shape3D):
             self.texCoordList = None
         else:
             self.colorList = None
-        self.buffers = self.Buffers(self.vertexList, self.normalList, self.colorList, self.texCoordList)  
 
     def saveVertex(self, r, c, u, v):
         vertex = self.vertices[r][c]
@@ -2603,17 +4097,31 @@ class GridShape3D(Shape3D):
 
     def draw(self):
         self.useTexture()
-        self.buffers.select()
-        glDrawArrays(GL_QUADS, 0, self.rows*self.cols*4)
-        self.countPolygons(self.rows*self.cols)
+        level = 0
+        if self.levelOfDetail is not None:
+            level = self.levelOfDetail.chooseLevel(self.getBoundingSphere())
+        if level == 0:
+            self.buffers.select()
+            self.buffers.draw(GL_QUADS, self.rows*self.cols*4)
+            self.countPolygons(self.rows*self.cols)
+        else:
+            (buffers, numQuads) = self.levelBuffers[level - 1]
+            buffers.select()
+            buffers.draw(GL_QUADS, numQuads*4)
+            self.countPolygons(numQuads)
+
+    def delete(self):
+        self.buffers.delete()
+        for (buffers, numQuads) in self.levelBuffers:
+            buffers.delete()
     
 #############################################################################
 
 class Sphere3D(GridShape3D):
-    def __init__(self, radius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False):
+    def __init__(self, radius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False, lod=0, lodSizes=None):
         rows = detailLevel
         cols = detailLevel*2
-        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles)
+        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles, lod, lodSizes)
         self.radius = float(radius)
         for row in xrange(rows+1):
             for col in xrange(cols+1):
@@ -2631,10 +4139,10 @@ class Sphere3D(GridShape3D):
 #######################################################################################
 
 class Hemisphere3D(GridShape3D):
-    def __init__(self, radius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False):
+    def __init__(self, radius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False, lod=0, lodSizes=None):
         rows = detailLevel/2
         cols = detailLevel*2
-        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles)
+        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles, lod, lodSizes)
         self.radius = float(radius)
         for row in xrange(rows+1):
             for col in xrange(cols+1):
@@ -2652,10 +4160,10 @@ class Hemisphere3D(GridShape3D):
 #######################################################################################
 
 class Ellipsoid3D(GridShape3D):
-    def __init__(self, xradius, yradius, zradius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False):
+    def __init__(self, xradius, yradius, zradius, detailLevel=12, colors=[(0,0,0),(1,1,1)], texture=None, textureTiles=False, lod=0, lodSizes=None):
         rows = detailLevel
         cols = detailLevel*2
-        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles)
+        GridShape3D.__init__(self, rows, cols, colors, texture, textureTiles, lod, lodSizes)
         self.xradius = float(xradius)
         self.yradius = float(yradius)
         self.zradius = float(zradius)
@@ -2810,11 +4318,12 @@ class Box3D(Shape3D):
         else:
             texCoords = [ (0,1), (0,0), (1,0), (1,1) ] * 6
         self.buffers = self.Buffers(vertices, normals, colorList, texCoords)
+        self.geometry = (GL_QUADS, vertices, normals, colorList, texCoords)
         
     def draw(self):
         self.useTexture()
         self.buffers.select()
-        glDrawArrays(GL_QUADS, 0, 24)
+        self.buffers.draw(GL_QUADS, 24)
         self.countPolygons(6)
 
 #############################################################################
@@ -2839,11 +4348,416 @@ class Lines3D(Shape3D):
         #self.useTexture()
         glLineWidth(self.width)
         self.buffers.select()
-        glDrawArrays(GL_LINES, 0, self.numVertices)
+        self.buffers.draw(GL_LINES, self.numVertices)
         self.countPolygons(self.numVertices/2)
 
 #############################################################################
 
+# A StaticBatch3D bakes many copies of one shape into a few large vertex buffers,
+#  so that all of the copies can be drawn with a handful of draw calls.
+# model must be a simple shape like Box3D, Sphere3D, Triangles3D or Terrain3D
+# instances is a list of tuples with the same meaning as the arguments of draw3D:
+#   (x, y, z)  or  (x, y, z, anglex, angley, anglez, scale)
+# The copies are grouped into square chunks of chunkSize units in the XZ plane,
+#  and each chunk gets its own vertex buffer.
+# If removeHiddenFaces is True, two faces of different copies that exactly overlap and face
+#  opposite ways (like the shared side of two boxes that touch) are left out of the batch,
+#  and of faces that exactly overlap and face the same way (copies in the same place) one is kept.
+class StaticBatch3D(Shape3D):
+    def __init__(self, model, instances, chunkSize=16, removeHiddenFaces=True):
+        Shape3D.__init__(self)
+        if model.geometry is None:
+            raise ValueError("this kind of shape cannot be batched")
+        (self.primitive, vertices, normals, colors, texCoords) = model.geometry
+        if self.primitive == GL_QUADS:
+            verticesPerFace = 4
+        elif self.primitive == GL_TRIANGLES:
+            verticesPerFace = 3
+        else:
+            raise ValueError("only shapes made of quads or triangles can be batched")
+        if normals == []:
+            normals = None
+        if colors == []:
+            colors = None
+        if texCoords == []:
+            texCoords = None
+        self.textureID = model.textureID
+        self.chunkSize = chunkSize
+        self.cullsChunks = True  # draw3D leaves the culling to draw()
+        self.visibleChunks = None
+        numFaces = len(vertices) / verticesPerFace
+
+        # transform every copy and remember where each face ended up
+        faces = []      # list of (chunkKey, faceKey, first vertex, transformed vertices, transformed normals)
+        spots = {}      # key = faceKey, value = list of (index into faces, instance number, facing)
+        for instanceNumber in range(len(instances)):
+            instance = instances[instanceNumber]
+            matrix = _transformMatrix(*instance)
+            (x, y, z) = instance[:3]
+            chunkKey = (int(math.floor(x / float(chunkSize))), int(math.floor(z / float(chunkSize))))
+            instanceVertices = [_transformPoint(matrix, vertex) for vertex in vertices]
+            if normals is None:
+                instanceNormals = None
+            else:
+                instanceNormals = [unitVector(_transformDirection(matrix, normal)) for normal in normals]
+            for face in range(numFaces):
+                first = face * verticesPerFace
+                faceVertices = instanceVertices[first:first+verticesPerFace]
+                faceKey = tuple(sorted([(round(vx,4), round(vy,4), round(vz,4)) for (vx,vy,vz) in faceVertices]))
+                if removeHiddenFaces:
+                    # which way the face points, from its winding
+                    facing = tuple([round(c, 3) for c in normalVector(*faceVertices[:3])])
+                    spots.setdefault(faceKey, []).append((len(faces), instanceNumber, facing))
+                faces.append((chunkKey, faceKey, first, instanceVertices, instanceNormals))
+
+        hidden = set()  # indexes into faces of the faces that are left out
+        for spot in spots.values():
+            if len(spot) < 2:
+                continue
+            facings = {}    # key = facing, value = (index of the face that is kept, set of instance numbers)
+            for (index, instanceNumber, facing) in spot:
+                if facing in facings:
+                    hidden.add(index)
+                    facings[facing][1].add(instanceNumber)
+                else:
+                    facings[facing] = (index, set([instanceNumber]))
+            for facing in facings:
+                opposite = tuple([-c for c in facing])
+                if facing == (0, 0, 0) or opposite not in facings:
+                    continue
+                # only faces of different copies hide each other, a copy with a two sided face there keeps it
+                (index, instanceNumbers) = facings[facing]
+                if not (instanceNumbers & facings[opposite][1]):
+                    hidden.add(index)
+
+        # gather the faces that are still visible into their chunks
+        chunkData = {}  # key = chunkKey, value = (vertices, normals, colors, texCoords, numFaces)
+        for faceIndex in range(len(faces)):
+            if faceIndex in hidden:
+                continue
+            (chunkKey, faceKey, first, instanceVertices, instanceNormals) = faces[faceIndex]
+            if chunkKey not in chunkData:
+                chunkData[chunkKey] = ([], [], [], [], [0])
+            (chunkVertices, chunkNormals, chunkColors, chunkTexCoords, chunkFaces) = chunkData[chunkKey]
+            last = first + verticesPerFace
+            chunkVertices.extend(instanceVertices[first:last])
+            if instanceNormals is not None:
+                chunkNormals.extend(instanceNormals[first:last])
+            if colors is not None:
+                chunkColors.extend(colors[first:last])
+            if texCoords is not None:
+                chunkTexCoords.extend(texCoords[first:last])
+            chunkFaces[0] += 1
+
+        self.chunks = dict()  # key is (chunkX, chunkZ), value is Chunk object
+        for chunkKey in chunkData:
+            (chunkVertices, chunkNormals, chunkColors, chunkTexCoords, chunkFaces) = chunkData[chunkKey]
+            buffers = self.Buffers(chunkVertices, chunkNormals, chunkColors, chunkTexCoords)
+            self.chunks[chunkKey] = StaticBatch3D.Chunk(chunkKey, buffers, chunkVertices, chunkFaces[0])
+        self.chunkList = [self.chunks[chunkKey] for chunkKey in sorted(self.chunks)]
+        self.numPolygons = sum([chunk.numPolygons for chunk in self.chunkList])
+
+    class Chunk:
+        def __init__(self, key, buffers, vertices, numPolygons):
+            self.key = key
+            self.buffers = buffers
+            self.numVertices = len(vertices)
+            self.numPolygons = numPolygons
+            self.minCorner = tuple([min([vertex[i] for vertex in vertices]) for i in range(3)])
+            self.maxCorner = tuple([max([vertex[i] for vertex in vertices]) for i in range(3)])
+
+    def delete(self):
+        for chunk in self.chunkList:
+            chunk.buffers.delete()
+
+    # limits drawing to the chunks with the given keys (like a potentially visible set), None draws all chunks
+    def setVisibleChunks(self, chunkKeys):
+        if chunkKeys is None:
+            self.visibleChunks = None
+        else:
+            self.visibleChunks = [self.chunks[key] for key in chunkKeys if key in self.chunks]
+
+    def draw(self):
+        self.useTexture()
+        transform = _GLI.modelTransform
+        recording = _GLI.recordingScene is not None
+        culling = _GLI.frustumCulling and _GLI.frustumPlanes is not None and transform is not None and not recording
+        fogCulling = _GLI.fogCullDistance is not None and transform is not None and not recording
+        matrix = None
+        if (culling or fogCulling) and transform != (0, 0, 0, 0, 0, 0, 1):
+            matrix = _transformMatrix(*transform)
+        if self.visibleChunks is None or recording:
+            chunks = self.chunkList
+        else:
+            chunks = self.visibleChunks
+        for chunk in chunks:
+            if culling or fogCulling:
+                if matrix is None:
+                    box = (chunk.minCorner, chunk.maxCorner)
+                else:
+                    box = _transformBox(matrix, chunk.minCorner, chunk.maxCorner)
+                if (culling and not _boxInFrustum(*box)) or (fogCulling and _boxBeyondFog(*box)):
+                    _GLI.culledCount += 1
+                    continue
+            _GLI.drawnCount += 1
+            chunk.buffers.select()
+            chunk.buffers.draw(self.primitive, chunk.numVertices)
+            self.countPolygons(chunk.numPolygons)
+
+#######################################################################################
+
+# Draws many copies of one model, each with its own transformation.
+# With OpenGL 3.3 the model's buffers are drawn once with glDrawArraysInstanced, and a shader
+# reads each copy's matrix from an instance buffer, which only gets the slots that changed.
+# The shader does the same diffuse lighting, texturing and fog as the fixed pipeline.
+# Without instancing, the copies are baked into a StaticBatch3D, which is rebuilt after changes.
+# Like StaticBatch3D, each transform is (x, y, z, anglex, angley, anglez, scale), or any
+# shorter start of it, in the same order as draw3D's arguments.
+class InstanceSet3D(Shape3D):
+    def __init__(self, model, transforms, chunkSize=16):
+        Shape3D.__init__(self)
+        if model.geometry is None:
+            raise ValueError("this kind of shape cannot be instanced")
+        self.model = model
+        (self.primitive, vertices, normals, colors, texCoords) = model.geometry
+        self.numVertices = len(vertices)
+        if self.primitive == GL_QUADS:
+            self.polygonsPerInstance = self.numVertices / 4
+        else:
+            self.polygonsPerInstance = self.numVertices / 3
+        self.textured = texCoords is not None and len(texCoords) > 0
+        self.transforms = [tuple(transform) for transform in transforms]
+        self.chunkSize = chunkSize
+        self.instanceBufferID = 0
+        self.changedSlots = set()
+        self.batch = None
+        self.boundingSphere = None
+
+    def getNumInstances(self):
+        return len(self.transforms)
+
+    def getInstance(self, index):
+        return self.transforms[index]
+
+    def setInstance(self, index, transform):
+        transform = tuple(transform)
+        if self.transforms[index] == transform:
+            return
+        self.transforms[index] = transform
+        self.changedSlots.add(index)
+        self.boundingSphere = None
+        if self.batch is not None:
+            self.batch.delete()
+            self.batch = None
+
+    # transforms must have one transform for each instance, only the ones that changed are updated
+    def setInstances(self, transforms):
+        if len(transforms) != len(self.transforms):
+            raise ValueError("InstanceSet3D has " + str(len(self.transforms)) + " instances, not " + str(len(transforms)))
+        for index in range(len(transforms)):
+            self.setInstance(index, transforms[index])
+
+    # the column-major matrices of instances first..last-1, as a string of float32 values
+    def getInstanceData(self, first, last):
+        values = []
+        for transform in self.transforms[first:last]:
+            matrix = _transformMatrix(*transform)
+            for column in range(4):
+                values.extend([matrix[row][column] for row in range(4)])
+        return array.array('f', values).tostring()
+
+    def updateInstanceBuffer(self):
+        if self.instanceBufferID == 0:
+            self.instanceBufferID = glGenBuffers(1)
+            _bindArrayBuffer(self.instanceBufferID)
+            data = self.getInstanceData(0, len(self.transforms))
+            glBufferData(GL_ARRAY_BUFFER, len(data), data, GL_DYNAMIC_DRAW)
+            self.changedSlots = set()
+            return
+        if len(self.changedSlots) == 0:
+            return
+        _bindArrayBuffer(self.instanceBufferID)
+        # each run of neighboring slots is copied with one call
+        slots = sorted(self.changedSlots)
+        first = slots[0]
+        for i in range(1, len(slots) + 1):
+            if i == len(slots) or slots[i] != slots[i-1] + 1:
+                last = slots[i-1] + 1
+                glBufferSubData(GL_ARRAY_BUFFER, first * 64, (last - first) * 64, self.getInstanceData(first, last))
+                if i < len(slots):
+                    first = slots[i]
+        self.changedSlots = set()
+
+    # a sphere holding the model's bounding sphere at every instance
+    def getBoundingSphere(self):
+        if self.boundingSphere is None:
+            sphere = self.model.getBoundingSphere()
+            if sphere is None or len(self.transforms) == 0:
+                return None
+            (cx, cy, cz, radius) = sphere
+            spheres = []
+            for transform in self.transforms:
+                scale = 1
+                if len(transform) > 6:
+                    scale = abs(transform[6])
+                spheres.append(_transformPoint(_transformMatrix(*transform), (cx, cy, cz)) + (radius * scale,))
+            minCorner = [min([s[i] - s[3] for s in spheres]) for i in range(3)]
+            maxCorner = [max([s[i] + s[3] for s in spheres]) for i in range(3)]
+            center = [(minCorner[i] + maxCorner[i]) / 2.0 for i in range(3)]
+            outerRadius = max([math.sqrt(sum([(s[i] - center[i])**2 for i in range(3)])) + s[3] for s in spheres])
+            self.boundingSphere = (center[0], center[1], center[2], outerRadius)
+        return self.boundingSphere
+
+    def delete(self):
+        if self.instanceBufferID != 0:
+            _forgetArrayBuffer(self.instanceBufferID)
+            glDeleteBuffers(1, GLuint(self.instanceBufferID))
+            self.instanceBufferID = 0
+        if self.batch is not None:
+            self.batch.delete()
+            self.batch = None
+
+    def draw(self):
+        if len(self.transforms) == 0:
+            return
+        if (_GLI.hasInstancing and not _GLI.selectionDrawingOn and _GLI.recordingScene is None and
+            _GLI.fogMode in _INSTANCING_FOG_MODES and _getInstancingProgram() is not None):
+            self.drawInstanced()
+        else:
+            if self.batch is None:
+                self.batch = StaticBatch3D(self.model, self.transforms, self.chunkSize)
+            self.batch.draw()
+
+    def drawInstanced(self):
+        (programID, columns, uniforms) = _GLI.instancingProgram
+        glUseProgram(programID)
+        glUniform1i(uniforms['lighting'], int(_GLI.lightingEnabled))
+        glUniform1i(uniforms['numLights'], _GLI.numLights)
+        glUniform1i(uniforms['textured'], int(self.textured and _GLI.textureMapsEnabled))
+        glUniform1i(uniforms['fogMode'], _GLI.fogMode)
+        glUniform1i(uniforms['texture'], 0)
+        self.model.useTexture()
+        self.updateInstanceBuffer()
+        self.model.buffers.select()
+        _bindArrayBuffer(self.instanceBufferID)
+        for column in range(4):
+            glEnableVertexAttribArray(columns[column])
+            glVertexAttribPointer(columns[column], 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * column))
+            glVertexAttribDivisor(columns[column], 1)
+        glDrawArraysInstanced(self.primitive, 0, self.numVertices, len(self.transforms))
+        _GLI.drawCallCount += 1
+        for column in range(4):
+            glVertexAttribDivisor(columns[column], 0)
+            glDisableVertexAttribArray(columns[column])
+        glUseProgram(0)
+        self.countPolygons(self.polygonsPerInstance * len(self.transforms))
+
+# the fog modes of makeFog that the instancing shader draws, with any other fog the copies are drawn
+#  with the fixed function pipeline (as a StaticBatch3D)
+_INSTANCING_FOG_MODES = (0, 1, 2)
+
+_INSTANCING_VERTEX_SHADER = """
+#version 120
+attribute vec4 instanceColumn0;
+attribute vec4 instanceColumn1;
+attribute vec4 instanceColumn2;
+attribute vec4 instanceColumn3;
+uniform bool lighting;
+uniform int numLights;
+varying vec4 color;
+varying float fogDistance;
+void main() {
+    mat4 instanceMatrix = mat4(instanceColumn0, instanceColumn1, instanceColumn2, instanceColumn3);
+    vec4 eyePosition = gl_ModelViewMatrix * (instanceMatrix * gl_Vertex);
+    color = gl_Color;
+    if (lighting) {
+        vec3 normal = normalize(gl_NormalMatrix * (mat3(instanceMatrix) * gl_Normal));
+        // addLight turns on two sided lighting, so the side facing the camera is lit
+        if (dot(normal, eyePosition.xyz) > 0.0) {
+            normal = -normal;
+        }
+        vec4 light = gl_LightModel.ambient;
+        for (int i = 0; i < numLights; i++) {
+            vec3 toLight = normalize(gl_LightSource[i].position.xyz - eyePosition.xyz);
+            light += gl_LightSource[i].diffuse * max(dot(normal, toLight), 0.0);
+        }
+        color = vec4(min(gl_Color.rgb * light.rgb, 1.0), gl_Color.a);
+    }
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+    fogDistance = abs(eyePosition.z);
+    gl_Position = gl_ProjectionMatrix * eyePosition;
+}
+"""
+
+_INSTANCING_FRAGMENT_SHADER = """
+#version 120
+uniform bool textured;
+uniform int fogMode;
+uniform sampler2D texture;
+varying vec4 color;
+varying float fogDistance;
+void main() {
+    vec4 fragmentColor = color;
+    if (textured) {
+        fragmentColor *= texture2D(texture, gl_TexCoord[0].st);
+    }
+    if (fogMode == 1) {
+        float fog = exp(-gl_Fog.density * fogDistance);
+        fragmentColor.rgb = mix(gl_Fog.color.rgb, fragmentColor.rgb, clamp(fog, 0.0, 1.0));
+    } else if (fogMode == 2) {
+        float fog = exp(-pow(gl_Fog.density * fogDistance, 2.0));
+        fragmentColor.rgb = mix(gl_Fog.color.rgb, fragmentColor.rgb, clamp(fog, 0.0, 1.0));
+    }
+    gl_FragColor = fragmentColor;
+}
+"""
+
+# compiles the shader for InstanceSet3D the first time it is needed,
+#  returns None (and turns instancing off) if it does not compile
+# The matrix columns are bound to attributes 1 to 4 before linking, since many drivers
+#  share attribute 0 with gl_Vertex in the compatibility profile.
+def _getInstancingProgram():
+    if _GLI.instancingProgram is None:
+        columns = [1 + column for column in range(4)]
+        try:
+            import OpenGL.GL.shaders as shaders
+            vertexShader = shaders.compileShader(_INSTANCING_VERTEX_SHADER, GL_VERTEX_SHADER)
+            fragmentShader = shaders.compileShader(_INSTANCING_FRAGMENT_SHADER, GL_FRAGMENT_SHADER)
+            programID = glCreateProgram()
+            glAttachShader(programID, vertexShader)
+            glAttachShader(programID, fragmentShader)
+            for column in range(4):
+                glBindAttribLocation(programID, columns[column], "instanceColumn" + str(column))
+            glLinkProgram(programID)
+            if glGetProgramiv(programID, GL_LINK_STATUS) != GL_TRUE:
+                raise RuntimeError(glGetProgramInfoLog(programID))
+            glDeleteShader(vertexShader)
+            glDeleteShader(fragmentShader)
+        except Exception, error:
+            print "WARNING: instancing is turned off, the shader did not compile:", error
+            _GLI.hasInstancing = False
+            return None
+        uniforms = dict()
+        for name in ['lighting', 'numLights', 'textured', 'fogMode', 'texture']:
+            uniforms[name] = glGetUniformLocation(programID, name)
+        _GLI.instancingProgram = (programID, columns, uniforms)
+    return _GLI.instancingProgram
+
+# Draws copies of model with the given transforms (see InstanceSet3D).
+# The InstanceSet3D for the model is kept between calls, so only the transforms that changed
+# since the last call are uploaded again.
+def drawInstanced3D(model, transforms):
+    instanceSet = _GLI.instanceSets.get(model)
+    if instanceSet is not None and instanceSet.getNumInstances() != len(transforms):
+        instanceSet.delete()
+        instanceSet = None
+    if instanceSet is None:
+        instanceSet = InstanceSet3D(model, transforms)
+        _GLI.instanceSets[model] = instanceSet
+    else:
+        instanceSet.setInstances(transforms)
+    draw3D(instanceSet)
+
 #######################################################################################
 
 def vectorCrossProduct((ax,ay,az), (bx,by,bz)):
@@ -2941,11 +4855,12 @@ class CustomPolygons3D(Shape3D):
             texCoords = rescaleTexCoords(texCoords)
         self.numVertices = len(glvertices)
         self.buffers = self.Buffers(glvertices, normals, colorList, texCoords)
+        self.geometry = (GL_TRIANGLES, glvertices, normals, colorList, texCoords)
 
     def draw(self):
         self.useTexture()
         self.buffers.select()
-        glDrawArrays(GL_TRIANGLES, 0, self.numVertices)
+        self.buffers.draw(GL_TRIANGLES, self.numVertices)
         self.countPolygons(self.numPolygons)
 
 
@@ -2987,11 +4902,12 @@ class Triangles3D(Shape3D):
         if self.textureID != 0:
             texCoords = rescaleTexCoords(texCoords)
         self.buffers = self.Buffers(vertices, normals, colorList, texCoords)
+        self.geometry = (GL_TRIANGLES, vertices, normals, colorList, texCoords)
         
     def draw(self):
         self.useTexture()
         self.buffers.select()
-        glDrawArrays(GL_TRIANGLES, 0, self.numVertices)
+        self.buffers.draw(GL_TRIANGLES, self.numVertices)
         self.countPolygons(self.numPolygons)
             
 
@@ -3028,11 +4944,12 @@ class Terrain3D(Shape3D):
             colors3 += [color,color,color]
         colorList = colors3 * (self.numVertices/len(colors3) + 1)
         self.buffers = self.Buffers(vertices, normals, colorList, texCoords)
+        self.geometry = (GL_TRIANGLES, vertices, normals, colorList, texCoords)
 
     def draw(self):
         self.useTexture()
         self.buffers.select()
-        glDrawArrays(GL_TRIANGLES, 0, self.numVertices)
+        self.buffers.draw(GL_TRIANGLES, self.numVertices)
         self.countPolygons(self.numVertices/3)
 
     def shift(self, coord):
@@ -3053,14 +4970,99 @@ class Terrain3D(Shape3D):
  
 #############################################################################
 
+# returns an array with the first size numbers of each line of OBJ records,
+#  or None if the lines do not all have the same number of values
+def _readFloatRows(lines, size):
+    if len(lines) == 0:
+        return numpy.zeros((0, size))
+    valuesPerLine = len(lines[0].split())
+    values = numpy.fromstring(' '.join(lines), dtype=numpy.float64, sep=' ')
+    if valuesPerLine < size or len(values) != valuesPerLine * len(lines):
+        return None
+    return values.reshape(len(lines), valuesPerLine)[:, :size]
+
+# Reads the corners of a list of OBJ face records that all use the same v, v/t, v//n or v/t/n format
+# and fan triangulates them, so triangle i of a face uses corners 0, i+1 and i+2.
+# Returns (vertex indexes, texture coordinate indexes, normal indexes, triangles in each face) with
+# three indexes per triangle (None for missing parts), or None if the faces cannot be read this way.
+def _readFaceIndices(faceLines):
+    corners = []
+    sizes = []
+    for faceLine in faceLines:
+        faceCorners = faceLine.split()
+        sizes.append(len(faceCorners))
+        corners.extend(faceCorners)
+    if len(corners) == 0 or min(sizes) < 3:
+        return None
+    text = ' '.join(corners)
+    numCorners = len(corners)
+    slashes = text.count('/')
+    doubleSlashes = text.count('//')
+    firstSlashes = corners[0].count('/')
+    if doubleSlashes > 0:
+        (fields, hasTex, hasNormal) = (2, False, True)
+        valid = doubleSlashes == numCorners and slashes == 2 * numCorners
+        text = text.replace('//', ' ')
+    elif firstSlashes == 2:
+        (fields, hasTex, hasNormal) = (3, True, True)
+        valid = slashes == 2 * numCorners
+    elif firstSlashes == 1:
+        (fields, hasTex, hasNormal) = (2, True, False)
+        valid = slashes == numCorners
+    else:
+        (fields, hasTex, hasNormal) = (1, False, False)
+        valid = slashes == 0
+    if not valid:
+        return None
+    numbers = numpy.fromstring(text.replace('/', ' '), dtype=numpy.int64, sep=' ')
+    if len(numbers) != fields * numCorners or numbers.min() < 1:
+        return None
+    numbers = numbers.reshape(numCorners, fields) - 1
+
+    sizes = numpy.array(sizes)
+    trianglesPerFace = sizes - 2
+    numTriangles = int(trianglesPerFace.sum())
+    faceStarts = numpy.cumsum(sizes) - sizes
+    triangleFaces = numpy.repeat(numpy.arange(len(sizes)), trianglesPerFace)
+    firstTriangles = numpy.cumsum(trianglesPerFace) - trianglesPerFace
+    triangleNumbers = numpy.arange(numTriangles) - firstTriangles[triangleFaces]
+    firstCorners = faceStarts[triangleFaces]
+    order = numpy.column_stack((firstCorners, firstCorners + triangleNumbers + 1, firstCorners + triangleNumbers + 2)).ravel()
+    vertexIndices = numbers[order, 0]
+    texIndices = None
+    normalIndices = None
+    if hasTex:
+        texIndices = numbers[order, 1]
+    if hasNormal:
+        normalIndices = numbers[order, fields - 1]
+    return (vertexIndices, texIndices, normalIndices, trianglesPerFace)
+
+# unit normal vectors for an array of triangle vertices (three rows per triangle), like normalVector
+def _triangleNormals(vertices):
+    first = vertices[0::3]
+    normals = numpy.cross(vertices[1::3] - first, vertices[2::3] - first)
+    lengths = numpy.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, numpy.newaxis]
+
+# Parsing an OBJ file is slow, so the interleaved vertex arrays are saved in a binary cache
+# file next to it (filename + ".cache") and read back on later runs.
+# The cache is only used with interleaved arrays and without selection, since
+# otherwise the buffers need the separate vertex lists.
 class ObjModel3D(Shape3D):
-    def __init__(self, filename, color=(0.5,0.5,0.5), translate=(0,0,0), stats=True):
+    cacheVersion = 2
+    cacheMagic = "graphics3d OBJ cache\n"
+
+    # lod is the number of reduced levels of detail made by vertex clustering (at most 5, needs NumPy),
+    #  lodSizes are the LevelOfDetail screen sizes of the reduced levels
+    def __init__(self, filename, color=(0.5,0.5,0.5), translate=(0,0,0), stats=True, cache=True, lod=0, lodSizes=None):
         Shape3D.__init__(self)
-        if stats:
-            print "reading OBJ file:", filename
         (self.translateX, self.translateY, self.translateZ) = translate
         self.defaultColor = lookupColor3D(color)
         self.stats = stats
+        self.lod = min(lod, 5)
+        self.levelOfDetail = None
+        self.sourceFiles = [filename]  # the OBJ file and its material libraries
         objVertices = []
         objVertexNormals = []
         objVertexTexes = []
@@ -3103,9 +5105,10 @@ class ObjModel3D(Shape3D):
             
             def finish(self):
                 self.numVertices = len(self.vertices)
-                if self.material.texture is None or None in self.texCoords:
+                if self.material.texture is None or (isinstance(self.texCoords, list) and None in self.texCoords):
                     self.texCoords = []
-                self.buffers = self.objmodel.Buffers(self.vertices, self.normals, self.colors, self.texCoords)
+                self.buffers = self.objmodel.Buffers(self.vertices, self.normals, self.colors, self.texCoords,
+                                                     indexed=True, keepArrays=self.objmodel.cache or self.objmodel.lod > 0)
                 
                 # create normal vectors for drawing
                 #self.normalvectors = []
@@ -3116,33 +5119,77 @@ class ObjModel3D(Shape3D):
                 #    self.normalvectors.append((v[0]+n[0], v[1]+n[1], v[2]+n[2]))
                 #self.lines = Lines3D(self.normalvectors, "green", 1)
             
-            def draw(self):
+            # data is the interleaved float32 vertex array read from the cache file, indexes is
+            #  None or (index data, index type, number of indexes)
+            def finishFromCache(self, format, data, numVertices, numPolygons, boundingSphere, indexes):
+                self.numVertices = numVertices
+                self.numPolygons = numPolygons
+                self.buffers = self.objmodel.Buffers(None, None, None, None, (format, data, numVertices, boundingSphere, indexes))
+                if self.objmodel.lod > 0:
+                    if indexes is None:
+                        self.buffers.arrays = (data, None)
+                    else:
+                        self.buffers.arrays = (data, indexes[0])
+
+            # adds a reduced level to the buffers for each cell size, the buffers must still have their arrays
+            def buildLevels(self, cellSizes):
+                (data, indexData) = self.buffers.arrays
+                self.levelPolygons = []
+                # a usemtl without faces leaves an empty component, which still needs every level
+                if self.numVertices == 0:
+                    for cellSize in cellSizes:
+                        self.buffers.levels.append((0, GL_UNSIGNED_SHORT, 0))
+                        self.levelPolygons.append(0)
+                    return
+                if indexData is None:
+                    triangles = numpy.arange(self.numVertices).reshape(-1, 3)
+                else:
+                    triangles = numpy.asarray(indexData).astype(numpy.int64).reshape(-1, 3)
+                rows = numpy.asarray(data, dtype=numpy.float32).reshape(int(triangles.max()) + 1, -1)
+                positions = rows[:, -3:].astype(numpy.float64)
+                for cellSize in cellSizes:
+                    clustered = _clusterTriangles(positions, triangles, cellSize)
+                    self.buffers.addLevel(clustered.ravel())
+                    self.levelPolygons.append(len(clustered))
+
+            def draw(self, level=0):
                 self.objmodel.useTexture(self.material.textureID)
                 self.buffers.select()
-                glDrawArrays(GL_TRIANGLES, 0, self.numVertices)
-                self.objmodel.countPolygons(self.numPolygons)
+                self.buffers.draw(GL_TRIANGLES, self.numVertices, level)
+                if level == 0:
+                    self.objmodel.countPolygons(self.numPolygons)
+                else:
+                    self.objmodel.countPolygons(self.levelPolygons[level - 1])
                 #if self.objmodel.showNormals:
                 #    self.lines.draw()
                         
-        def getComponent(material):                
+        # components and materials can be other dicts than the model's (parseWithNumPy uses its own)
+        def getComponent(material, components=None):
+            if components is None:
+                components = self.components
             if material.texture is None:
                 componentName = 'color'
             else:
                 componentName = material.texture
-            if componentName in self.components:
-                return self.components[componentName]
+            if componentName in components:
+                return components[componentName]
             else:
                 newComponent = Component(material)
-                self.components[componentName] = newComponent
+                components[componentName] = newComponent
                 return newComponent
 
 
-        def readMaterialLibrary(materialFilename):
+        def readMaterialLibrary(materialFilename, materials=None, sourceFiles=None):
             #for materialFilename in materialFilenames:
+                if materials is None:
+                    materials = self.materials
+                if sourceFiles is None:
+                    sourceFiles = self.sourceFiles
                 materialPath = os.path.join(os.path.dirname(filename), materialFilename)
                 if not os.path.exists(materialPath):
                     print 'ERROR: missing material library:', materialPath
                     return
+                sourceFiles.append(materialPath)
                 materialFile = open(materialPath, 'r')
                 material = None
                 for line in materialFile:
@@ -3153,7 +5200,7 @@ class ObjModel3D(Shape3D):
                     if keyword == 'newmtl':
                         name = fields[1]
                         material = Material(name, self)
-                        self.materials[name] = material
+                        materials[name] = material
                     elif keyword == 'Kd':
                         material.setColor([float(c) for c in fields[1:4]])                      
                     elif keyword == 'map_Kd':
@@ -3196,68 +5243,393 @@ class ObjModel3D(Shape3D):
                     currentComponent.normals.extend([vface[0][2], vface[i-1][2], vface[i][2]])
                 currentComponent.texCoords.extend([vface[0][1], vface[i-1][1], vface[i][1]])
 
-        # init
-        mysteryKeywords = {}        
-        objfile = file(filename, 'r')
-        for line in objfile:
-            line = line.strip()
-            if line == '' or line[0] == '#': continue
-            fields = line.split()
-            keyword = fields[0]
-            try:
+        # Reads the whole file into NumPy arrays and fan triangulates each run of faces at once.
+        # Returns False if the file uses something that only the line by line parser handles
+        # (negative indices, faces that mix formats, odd vertex records). The materials,
+        # components and material libraries only become the model's once the parse has worked,
+        # so the line by line parser starts from scratch.
+        def parseWithNumPy():
+            materials = dict()
+            components = dict()
+            sourceFiles = []
+            objfile = open(filename, 'r')
+            lines = objfile.read().splitlines()
+            objfile.close()
+            vertexLines = []
+            texLines = []
+            normalLines = []
+            # key = component, value = list of face lines, and list of (material, number of faces) runs
+            componentFaces = dict()
+            componentNames = []  # components in the order they were first used
+            material = defaultMaterial
+            run = None
+            simpleKeywords = set(['v', 'vt', 'vn', 'f'])
+            for line in lines:
+                # most lines are "keyword values" records, so only the other lines are stripped and split
+                (keyword, space, rest) = line.partition(' ')
+                if keyword not in simpleKeywords:
+                    line = line.strip()
+                    if line == '' or line[0] == '#': continue
+                    fields = line.split(None, 1)
+                    keyword = fields[0]
+                    if len(fields) > 1:
+                        rest = fields[1]
+                    else:
+                        rest = ''
                 if keyword == 'v':
-                    objVertices.append([float(n) for n in fields[1:]])
+                    vertexLines.append(rest)
                 elif keyword == 'vt':
-                    objVertexTexes.append([float(n) for n in fields[1:3]])
+                    texLines.append(rest)
                 elif keyword == 'vn':
-                    objVertexNormals.append([float(n) for n in fields[1:]])
+                    normalLines.append(rest)
                 elif keyword == 'f':
-                    if currentComponent is None:
-                        #print 'using default color material'
-                        currentComponent = getComponent(currentMaterial)
-                    addFace(fields[1:])
+                    if run is None:
+                        component = getComponent(material, components)
+                        if component not in componentFaces:
+                            componentFaces[component] = ([], [])
+                            componentNames.append(component)
+                        (faceLines, runs) = componentFaces[component]
+                        run = [material, 0]
+                        runs.append(run)
+                    faceLines.append(rest)
+                    run[1] += 1
                 elif keyword == 'mtllib':
-                    readMaterialLibrary(line.split(' ',1)[1])
+                    readMaterialLibrary(line.split(' ',1)[1], materials, sourceFiles)
                 elif keyword == 'usemtl':
-                    materialName = fields[1]
-                    if materialName in self.materials:
-                        currentMaterial = self.materials[materialName]
-                        #print 'using material', materialName
-                        currentComponent = getComponent(currentMaterial)
+                    materialName = rest.split()[0]
+                    if materialName in materials:
+                        material = materials[materialName]
+                        getComponent(material, components)
+                        run = None
                     else:
                         print "ERROR: unknown material", materialName
-                elif keyword == 'g': # group
-                    if len(fields) > 1:
-                        groupname = fields[1]
-                elif keyword == 's': # smoothing
+                elif keyword == 'g' or keyword == 's':
                     pass
+                elif keyword not in mysteryKeywords:
+                    print "WARNING: skipped line: " + line
+                    mysteryKeywords[keyword] = True
+
+            vertexArray = _readFloatRows(vertexLines, 3)
+            texArray = _readFloatRows(texLines, 2)
+            normalArray = _readFloatRows(normalLines, 3)
+            if vertexArray is None or texArray is None or normalArray is None:
+                return False
+            # all of the faces of a component are read at once, so they must all use the same format
+            faces = []
+            for component in componentNames:
+                (faceLines, runs) = componentFaces[component]
+                indices = _readFaceIndices(faceLines)
+                if indices is None:
+                    return False
+                faces.append((component, runs, indices))
+
+            # the components get arrays, which Buffers interleaves without making a list
+            translate = numpy.array([self.translateX, self.translateY, self.translateZ])
+            for (component, runs, (vertexIndices, texIndices, normalIndices, trianglesPerFace)) in faces:
+                vertices = vertexArray[vertexIndices] + translate
+                component.numPolygons += int(trianglesPerFace.sum())
+                component.vertices = vertices
+                runColors = []
+                runVertices = []
+                firstFace = 0
+                for (material, numFaces) in runs:
+                    runColors.append(material.color)
+                    runVertices.append(3 * int(trianglesPerFace[firstFace:firstFace+numFaces].sum()))
+                    firstFace += numFaces
+                if None in runColors:
+                    component.colors = []
+                    for (color, count) in zip(runColors, runVertices):
+                        component.colors.extend([color] * count)
                 else:
-                    if keyword not in mysteryKeywords:
-                        print "WARNING: skipped line: " + line
-                        mysteryKeywords[keyword] = True
-            except ValueError:
-                print "ERROR: ValueError on line: " + line
-        objfile.close()
-        
+                    runColors = [tuple(color) + (1.0,) * (4 - len(color)) for color in runColors]
+                    component.colors = numpy.repeat(numpy.array(runColors), runVertices, axis=0)
+                if normalIndices is None:
+                    component.normals = numpy.repeat(_triangleNormals(vertices), 3, axis=0)
+                else:
+                    component.normals = normalArray[normalIndices]
+                if texIndices is None:
+                    component.texCoords = []
+                else:
+                    component.texCoords = texArray[texIndices]
+            self.materials.update(materials)
+            self.components.update(components)
+            self.sourceFiles.extend(sourceFiles)
+            return True
+
+        # init
+        cacheFilename = filename + ".cache"
+        cache = cache and _GLI.useInterleavedArrays and not _GLI.enableSelection
+        self.cache = cache
         self.componentsList = []
+        if cache and self.loadCache(cacheFilename, Material, Component):
+            if stats:
+                print "reading OBJ cache:", cacheFilename
+                self.printStats()
+            self.buildLevelsOfDetail(lodSizes)
+            for component in self.componentsList:
+                component.buffers.arrays = None
+            return
+        if stats:
+            print "reading OBJ file:", filename
+        mysteryKeywords = {}        
+        if not (_GLI.hasNumPy and parseWithNumPy()):
+            objfile = file(filename, 'r')
+            for line in objfile:
+                line = line.strip()
+                if line == '' or line[0] == '#': continue
+                fields = line.split()
+                keyword = fields[0]
+                try:
+                    if keyword == 'v':
+                        objVertices.append([float(n) for n in fields[1:]])
+                    elif keyword == 'vt':
+                        objVertexTexes.append([float(n) for n in fields[1:3]])
+                    elif keyword == 'vn':
+                        objVertexNormals.append([float(n) for n in fields[1:]])
+                    elif keyword == 'f':
+                        if currentComponent is None:
+                            #print 'using default color material'
+                            currentComponent = getComponent(currentMaterial)
+                        addFace(fields[1:])
+                    elif keyword == 'mtllib':
+                        readMaterialLibrary(line.split(' ',1)[1])
+                    elif keyword == 'usemtl':
+                        materialName = fields[1]
+                        if materialName in self.materials:
+                            currentMaterial = self.materials[materialName]
+                            #print 'using material', materialName
+                            currentComponent = getComponent(currentMaterial)
+                        else:
+                            print "ERROR: unknown material", materialName
+                    elif keyword == 'g': # group
+                        if len(fields) > 1:
+                            groupname = fields[1]
+                    elif keyword == 's': # smoothing
+                        pass
+                    else:
+                        if keyword not in mysteryKeywords:
+                            print "WARNING: skipped line: " + line
+                            mysteryKeywords[keyword] = True
+                except ValueError:
+                    print "ERROR: ValueError on line: " + line
+            objfile.close()
+        
         for componentName in self.components:
             component = self.components[componentName]
             component.finish()
             self.componentsList.append(component)
             self.numPolygons += component.numPolygons
-        
+        # (mean, min, max) of the x, y and z coordinates
+        self.coordinateStats = []
+        if _GLI.hasNumPy:
+            vertexArrays = [numpy.asarray(c.vertices, dtype=numpy.float64).reshape(-1, 3) for c in self.componentsList if len(c.vertices) > 0]
+            allVertices = numpy.zeros((0, 3))
+            if len(vertexArrays) > 0:
+                allVertices = numpy.concatenate(vertexArrays)
+            if len(allVertices) > 0:
+                for axis in range(3):
+                    coords = allVertices[:, axis]
+                    self.coordinateStats.append((float(coords.mean()), float(coords.min()), float(coords.max())))
+        else:
+            allVertices = [vertex for c in self.componentsList for vertex in c.vertices]
+            for axis in range(3):
+                coords = [vertex[axis] for vertex in allVertices]
+                if len(coords) > 0:
+                    self.coordinateStats.append((sum(coords)/len(coords), min(coords), max(coords)))
+        self.boundingSphere = _boundingSphere(allVertices)
+        if self.stats:
+            self.printStats()
+        self.buildLevelsOfDetail(lodSizes)
+        if cache:
+            self.saveCache(cacheFilename)
+        for component in self.componentsList:
+            component.buffers.arrays = None
+
+    # Each reduced level clusters the vertexes into a grid that is half as fine as the level before,
+    # starting at 128 cells across the model, and draws the clustered triangles from the same vertex buffer.
+    def buildLevelsOfDetail(self, lodSizes):
+        if self.lod <= 0 or self.boundingSphere is None:
+            return
+        if not _GLI.hasNumPy or None in [component.buffers.arrays for component in self.componentsList]:
+            print "WARNING: levels of detail need NumPy and interleaved arrays"
+            self.lod = 0
+            return
+        resolutions = [256 >> level for level in range(1, self.lod + 1)]
+        cellSizes = [2.0 * self.boundingSphere[3] / resolution for resolution in resolutions]
+        for component in self.componentsList:
+            component.buildLevels(cellSizes)
+        if lodSizes is None:
+            # switch when a cell of the next level would be about 4 pixels across
+            lodSizes = [4.0 * resolution for resolution in resolutions]
+        self.levelOfDetail = LevelOfDetail(lodSizes[:self.lod])
         if self.stats:
-            xcoords = [x for c in self.componentsList for (x,y,z) in c.vertices]
-            ycoords = [y for c in self.componentsList for (x,y,z) in c.vertices]
-            zcoords = [z for c in self.componentsList for (x,y,z) in c.vertices]
-            print "  contains", len(self.components), "components and", self.numPolygons, "polygons"
-            print "  mean x:", sum(xcoords)/len(xcoords), "min x:", min(xcoords), "max x", max(xcoords)
-            print "  mean y:", sum(ycoords)/len(ycoords), "min y:", min(ycoords), "max y", max(ycoords)
-            print "  mean z:", sum(zcoords)/len(zcoords), "min z:", min(zcoords), "max z", max(zcoords)
+            for level in range(1, self.lod + 1):
+                numPolygons = sum([component.levelPolygons[level - 1] for component in self.componentsList])
+                print "  level of detail", level, "has", numPolygons, "polygons"
+
+    def printStats(self):
+        print "  contains", len(self.components), "components and", self.numPolygons, "polygons"
+        for (axis, (mean, low, high)) in zip("xyz", self.coordinateStats):
+            print "  mean " + axis + ":", mean, "min " + axis + ":", low, "max " + axis, high
+
+    # (pathname, modification time, size) of each source file, so a cache is not used after they change
+    def getSourceSignatures(self, sourceFiles):
+        signatures = []
+        for pathname in sourceFiles:
+            if not os.path.exists(pathname):
+                return None
+            signatures.append((pathname, os.path.getmtime(pathname), os.path.getsize(pathname)))
+        return signatures
+
+    # The cache file is cacheMagic, the length of the header, the pickled header, and then
+    # the float32 interleaved array and the element buffer indexes of each component.
+    def saveCache(self, cacheFilename):
+        header = {'version': self.cacheVersion, 'byteorder': sys.byteorder,
+                  'sources': self.getSourceSignatures(self.sourceFiles),
+                  'translate': (self.translateX, self.translateY, self.translateZ),
+                  'color': tuple(self.defaultColor), 'numPolygons': self.numPolygons,
+                  'boundingSphere': self.boundingSphere, 'coordinateStats': self.coordinateStats,
+                  'components': []}
+        arrays = []
+        offset = 0
+        for component in self.componentsList:
+            buffers = component.buffers
+            (dataList, indexData) = buffers.arrays
+            buffers.arrays = None
+            if isinstance(dataList, list):
+                data = array.array('f', dataList).tostring()
+            else:
+                data = dataList.astype(numpy.float32).tostring()
+            componentHeader = {'texture': component.material.texture, 'color': component.material.color,
+                               'format': int(buffers.format), 'numVertices': component.numVertices,
+                               'numPolygons': component.numPolygons, 'boundingSphere': buffers.boundingSphere,
+                               'offset': offset, 'length': len(data) / 4, 'indexes': None}
+            arrays.append(data)
+            offset += len(data)
+            if indexData is not None:
+                if not isinstance(indexData, str):
+                    indexData = indexData.tostring()
+                if buffers.indexType == GL_UNSIGNED_SHORT:
+                    typecode = 'H'
+                else:
+                    typecode = 'I'
+                componentHeader['indexes'] = (offset, typecode, buffers.numIndexes)
+                arrays.append(indexData)
+                offset += len(indexData)
+            header['components'].append(componentHeader)
+        # the cache is written to a temporary file first, so a run that is stopped halfway
+        #  never leaves a cut off cache file behind
+        temporaryFilename = cacheFilename + ".tmp" + str(os.getpid())
+        try:
+            headerData = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL)
+            cacheFile = open(temporaryFilename, 'wb')
+            cacheFile.write(self.cacheMagic)
+            cacheFile.write(struct.pack("<I", len(headerData)))
+            cacheFile.write(headerData)
+            for data in arrays:
+                cacheFile.write(data)
+            cacheFile.close()
+            try:
+                os.rename(temporaryFilename, cacheFilename)
+            except OSError:
+                # Windows does not rename onto an existing file
+                os.remove(cacheFilename)
+                os.rename(temporaryFilename, cacheFilename)
+        except (IOError, OSError):
+            print "WARNING: could not write OBJ cache " + cacheFilename
+            if os.path.exists(temporaryFilename):
+                os.remove(temporaryFilename)
+
+    # returns True if the cache file was made from the same source files with the same arguments
+    #  a cache file that cannot be read, or whose arrays do not fit in it, returns False,
+    #  so the OBJ file is parsed again instead
+    def loadCache(self, cacheFilename, Material, Component):
+        if not os.path.exists(cacheFilename):
+            return False
+        cacheFile = None
+        components = []     # list of (name, component)
+        try:
+            cacheFile = open(cacheFilename, 'rb')
+            if cacheFile.read(len(self.cacheMagic)) != self.cacheMagic:
+                cacheFile.close()
+                return False
+            (headerLength,) = struct.unpack("<I", cacheFile.read(4))
+            header = cPickle.loads(cacheFile.read(headerLength))
+            dataStart = cacheFile.tell()
+            sources = header.get('sources')
+            if (header.get('version') != self.cacheVersion or header.get('byteorder') != sys.byteorder or
+                sources is None or self.getSourceSignatures([source[0] for source in sources]) != sources or
+                header.get('translate') != (self.translateX, self.translateY, self.translateZ) or
+                header.get('color') != tuple(self.defaultColor)):
+                cacheFile.close()
+                return False
+            # every array has to lie inside the file before any of them is used
+            fileSize = os.path.getsize(cacheFilename)
+            for componentHeader in header['components']:
+                arrays = [(componentHeader['offset'], 'f', componentHeader['length'])]
+                if componentHeader['indexes'] is not None:
+                    arrays.append(componentHeader['indexes'])
+                for (offset, typecode, length) in arrays:
+                    if offset < 0 or length < 0 or dataStart + offset + length * array.array(typecode).itemsize > fileSize:
+                        raise ValueError("array past the end of the file")
+            for componentHeader in header['components']:
+                material = Material(None, self)
+                if componentHeader['texture'] is not None:
+                    material.setTexture(componentHeader['texture'])
+                    componentName = componentHeader['texture']
+                else:
+                    componentName = 'color'
+                material.setColor(componentHeader['color'])
+                data = self.readCacheArray(cacheFile, cacheFilename, dataStart + componentHeader['offset'],
+                                           'f', componentHeader['length'])
+                indexes = None
+                if componentHeader['indexes'] is not None:
+                    (indexOffset, typecode, numIndexes) = componentHeader['indexes']
+                    indexData = self.readCacheArray(cacheFile, cacheFilename, dataStart + indexOffset, typecode, numIndexes)
+                    if typecode == 'H':
+                        indexes = (indexData, GL_UNSIGNED_SHORT, numIndexes)
+                    else:
+                        indexes = (indexData, GL_UNSIGNED_INT, numIndexes)
+                component = Component(material)
+                component.finishFromCache(componentHeader['format'], data, componentHeader['numVertices'],
+                                          componentHeader['numPolygons'], componentHeader['boundingSphere'], indexes)
+                components.append((componentName, component))
+            cacheFile.close()
+        except Exception:
+            print "WARNING: could not read OBJ cache " + cacheFilename
+            if cacheFile is not None:
+                cacheFile.close()
+            for (componentName, component) in components:
+                component.buffers.delete()
+            return False
+        for (componentName, component) in components:
+            self.components[componentName] = component
+            self.componentsList.append(component)
+        self.sourceFiles = [source[0] for source in sources]
+        self.numPolygons = header['numPolygons']
+        self.boundingSphere = header['boundingSphere']
+        self.coordinateStats = header['coordinateStats']
+        return True
+
+    # memory maps length values of the given array typecode ('f', 'H' or 'I') from the cache file,
+    #  or reads them as a string without NumPy
+    def readCacheArray(self, cacheFile, cacheFilename, offset, typecode, length):
+        itemSize = array.array(typecode).itemsize
+        if _GLI.hasNumPy:
+            dtype = {'f': numpy.float32, 'H': numpy.uint16, 'I': numpy.uint32}[typecode]
+            return numpy.memmap(cacheFilename, dtype=dtype, mode='r', offset=offset, shape=(length,))
+        cacheFile.seek(offset)
+        return cacheFile.read(length * itemSize)
                 
+    def getBoundingSphere(self):
+        return self.boundingSphere
+
     def draw(self):
+        level = 0
+        if self.levelOfDetail is not None:
+            level = self.levelOfDetail.chooseLevel(self.boundingSphere)
         for component in self.componentsList:
-            component.draw()
+            component.draw(level)
 
 #############################################################################
 
@@ -3275,14 +5647,17 @@ class ColladaModel3D(Shape3D):
                 material.textureID = self.setTexture(material.texture)
             elif material.diffuse is None:
                 print "WARNING: no diffuse color or texture"
-            component.buffers = self.Buffers(geometry.positions, geometry.normals, None, geometry.texcoords)
+            component.buffers = self.Buffers(geometry.positions, geometry.normals, None, geometry.texcoords, indexed=True)
             self.components.append(component)
         print "   contains " + str(len(self.components)) + " subcomponents"
         
+    # the components have their own transformations, so this model is never culled
+    def getBoundingSphere(self):
+        return None
     
     def draw(self):
-        glDisable(GL_COLOR_MATERIAL)
-        glEnable(GL_RESCALE_NORMAL)
+        _setEnabled(GL_COLOR_MATERIAL, False)
+        _setEnabled(GL_RESCALE_NORMAL, True)
         glPushMatrix()
         glRotate(-90,1,0,0)
         for component in self.components:
@@ -3298,13 +5673,13 @@ class ColladaModel3D(Shape3D):
                 for matrix in component.matrices:
                     glMultTransposeMatrixf(matrix)
             component.buffers.select()
-            glDrawArrays(geometry.openGLPrimitive, 0, geometry.getVertexCount())
+            component.buffers.draw(geometry.openGLPrimitive, geometry.getVertexCount())
             if component.matrices != []:
                 glPopMatrix()
             self.countPolygons(geometry.getPolygonCount())
         glPopMatrix()
-        glDisable(GL_RESCALE_NORMAL)
-        glEnable(GL_COLOR_MATERIAL)
+        _setEnabled(GL_RESCALE_NORMAL, False)
+        _setEnabled(GL_COLOR_MATERIAL, True)
 
 ###################################################################
 # Backward Compatibility
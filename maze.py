@@ -0,0 +1,368 @@
+# Map data structures for the maze: these only deal with map cells,
+# so they work without a graphics window.
+import collections, math, os, struct, sys, zlib, cPickle
+
+# A uniform grid of the wall cells in a map, used for collision tests.
+# Every wall sits on an integer map cell (x, z) and blocks a square box
+# that reaches halfWidth in each direction from the center of its cell.
+# Looking up a point only checks the few cells whose boxes could reach it,
+# so the cost does not depend on how many walls the map has.
+class WallGrid:
+    def __init__ (self, wallList, halfWidth=0.7):
+        self.halfWidth = halfWidth
+        self.cells = set()
+        for (cellx, cellz) in wallList:
+            self.cells.add((int(cellx), int(cellz)))
+
+    def isWall (self, cellx, cellz):
+        return (cellx, cellz) in self.cells
+
+    # returns True if the point (x, z) is strictly inside some wall's box
+    def inWall (self, x, z):
+        halfWidth = self.halfWidth
+        cells = self.cells
+        firstz = int(math.floor(z - halfWidth)) + 1
+        lastz = int(math.ceil(z + halfWidth))
+        for cellx in range(int(math.floor(x - halfWidth)) + 1, int(math.ceil(x + halfWidth))):
+            if x <= cellx - halfWidth or x >= cellx + halfWidth:
+                continue
+            for cellz in range(firstz, lastz):
+                if (cellx, cellz) in cells and z > cellz - halfWidth and z < cellz + halfWidth:
+                    return True
+        return False
+
+# A WallGrid that looks its cells up in a TiledMap, so only the tiles around the points
+# being tested have to be loaded.
+class TiledWallGrid(WallGrid):
+    def __init__ (self, tiledMap, halfWidth=0.7):
+        self.halfWidth = halfWidth
+        self.cells = tiledMap
+
+
+# multipliers that map the first octant onto each of the eight octants around a cell
+_OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+            (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+# Precomputed potentially visible sets for a tile map.
+# For every floor cell it stores the wall cells that can be seen from somewhere
+# inside that cell, out to the given radius.
+# Visibility is found by shadow casting from the center of each floor cell,
+# and then each cell also gets everything visible from the floor cells around it,
+# since the camera can stand anywhere inside its cell.
+# Computing the table takes a few seconds, so build() keeps it in a cache file.
+class VisibilityTable:
+    version = 1
+
+    def __init__ (self, wallGrid, width, height, radius=30):
+        self.wallGrid = wallGrid
+        self.width = width
+        self.height = height
+        self.radius = radius
+        self.walls = sorted(wallGrid.cells)
+        self.cells = dict()         # key = floor cell, value = tuple of indexes into self.walls
+        self.chunkCache = dict()    # key = (chunkSize, cell), value = list of chunk keys
+
+    # loads the table from cacheFilename if it was made for the same map, otherwise computes and saves it
+    def build (self, cacheFilename=None, mapHash=None):
+        if cacheFilename is not None and self.load(cacheFilename, mapHash):
+            return
+        self.compute()
+        if cacheFilename is not None:
+            self.save(cacheFilename, mapHash)
+
+    def isFloor (self, cellx, cellz):
+        return 1 <= cellx <= self.width and 1 <= cellz <= self.height and not self.wallGrid.isWall(cellx, cellz)
+
+    def compute (self):
+        wallIndex = dict()
+        for index in range(len(self.walls)):
+            wallIndex[self.walls[index]] = index
+        seen = dict()
+        for cellz in range(1, self.height + 1):
+            for cellx in range(1, self.width + 1):
+                if self.isFloor(cellx, cellz):
+                    seen[(cellx, cellz)] = self.wallsSeenFrom(cellx, cellz)
+        self.cells = dict()
+        self.chunkCache = dict()
+        for (cellx, cellz) in seen:
+            visible = set()
+            for dx in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    neighbor = (cellx + dx, cellz + dz)
+                    if neighbor in seen:
+                        visible.update(seen[neighbor])
+            self.cells[(cellx, cellz)] = tuple(sorted([wallIndex[wall] for wall in visible]))
+
+    # returns the set of wall cells that can be seen from the center of a cell
+    def wallsSeenFrom (self, cellx, cellz):
+        visible = set()
+        for (xx, xz, zx, zz) in _OCTANTS:
+            self.castLight(cellx, cellz, 1, 1.0, 0.0, xx, xz, zx, zz, visible)
+        return visible
+
+    # recursive shadow casting over one octant, rows are scanned outward from the center
+    def castLight (self, cellx, cellz, row, startSlope, endSlope, xx, xz, zx, zz, visible):
+        if startSlope < endSlope:
+            return
+        radius = self.radius
+        newStart = startSlope
+        for distance in range(row, radius + 1):
+            dz = -distance
+            blocked = False
+            for dx in range(-distance, 1):
+                leftSlope = (dx - 0.5) / (dz + 0.5)
+                rightSlope = (dx + 0.5) / (dz - 0.5)
+                if startSlope < rightSlope:
+                    continue
+                if endSlope > leftSlope:
+                    break
+                x = cellx + dx * xx + dz * xz
+                z = cellz + dx * zx + dz * zz
+                opaque = not self.isFloor(x, z)
+                if opaque and dx * dx + dz * dz <= radius * radius and self.wallGrid.isWall(x, z):
+                    visible.add((x, z))
+                if blocked:
+                    if opaque:
+                        newStart = rightSlope
+                    else:
+                        blocked = False
+                        startSlope = newStart
+                elif opaque and distance < radius:
+                    blocked = True
+                    self.castLight(cellx, cellz, distance + 1, startSlope, leftSlope, xx, xz, zx, zz, visible)
+                    newStart = rightSlope
+            if blocked:
+                break
+
+    # returns the wall cells visible from the point (x, z), or None if the point is not on a floor cell
+    def visibleWalls (self, x, z):
+        cell = (int(round(x)), int(round(z)))
+        if cell not in self.cells:
+            return None
+        return [self.walls[index] for index in self.cells[cell]]
+
+    # returns the keys of the StaticBatch3D chunks that hold the walls visible from (x, z),
+    #  or None if the point is not on a floor cell
+    def visibleChunks (self, x, z, chunkSize):
+        cell = (int(round(x)), int(round(z)))
+        if cell not in self.cells:
+            return None
+        key = (chunkSize, cell)
+        if key not in self.chunkCache:
+            chunkSize = float(chunkSize)
+            chunks = set()
+            for index in self.cells[cell]:
+                (wallx, wallz) = self.walls[index]
+                chunks.add((int(math.floor(wallx / chunkSize)), int(math.floor(wallz / chunkSize))))
+            self.chunkCache[key] = sorted(chunks)
+        return self.chunkCache[key]
+
+    def save (self, filename, mapHash):
+        data = {'version': self.version, 'mapHash': mapHash, 'radius': self.radius,
+                'walls': self.walls, 'cells': self.cells}
+        cacheFile = open(filename, 'wb')
+        cPickle.dump(data, cacheFile, cPickle.HIGHEST_PROTOCOL)
+        cacheFile.close()
+
+    # returns True if the cache file was made for this map, radius and version
+    def load (self, filename, mapHash):
+        if not os.path.exists(filename):
+            return False
+        try:
+            cacheFile = open(filename, 'rb')
+            data = cPickle.load(cacheFile)
+            cacheFile.close()
+        except Exception:
+            print "WARNING: could not read visibility cache " + filename
+            return False
+        if data.get('version') != self.version or data.get('mapHash') != mapHash or data.get('radius') != self.radius:
+            return False
+        if data['walls'] != self.walls:
+            return False
+        self.cells = data['cells']
+        self.chunkCache = dict()
+        return True
+
+
+# A map stored as square tiles of tileSize by tileSize cells in one binary file, so that a large
+# map can be used without reading all of it.  Only the header and the tile index are read when the
+# file is opened, tiles are read when they are first needed, and at most maxTiles of them are kept
+# (the ones that were used longest ago are dropped first).
+# The file is made from a text map by convertMap and holds:
+#   the header (HEADER_FORMAT): magic, version, map width and height, tileSize, number of tiles,
+#     where the index starts, and the cells of S, M and W
+#   the tiles, each the zlib compressed rows of the tile (tileSize by tileSize 'X' and '.' characters)
+#   the index (INDEX_FORMAT for each tile): the tile's key, where its data starts and how long it is
+# Tiles without any walls are left out of the file.
+# Cells are numbered like the text map, starting from 1 at the top left character, and the tile
+# (tilex, tilez) holds the cells from tilex*tileSize to (tilex+1)*tileSize - 1 across.
+class TiledMap:
+    magic = "MAZETILE"
+    version = 1
+    HEADER_FORMAT = "<8sIIIIIQiiiiii"
+    INDEX_FORMAT = "<iiQI"
+
+    def __init__ (self, filename, maxTiles=256):
+        self.filename = filename
+        self.maxTiles = maxTiles
+        self.mapFile = open(filename, 'rb')
+        header = self.mapFile.read(struct.calcsize(self.HEADER_FORMAT))
+        if len(header) < struct.calcsize(self.HEADER_FORMAT) or header[:len(self.magic)] != self.magic:
+            raise ValueError(filename + " is not a tiled map")
+        (magic, version, self.width, self.height, self.tileSize, numTiles, indexStart,
+         startx, startz, monsterx, monsterz, goalx, goalz) = struct.unpack(self.HEADER_FORMAT, header)
+        if version != self.version:
+            raise ValueError(filename + " is a tiled map of version " + str(version) + ", not " + str(self.version))
+        self.start = (startx, startz)
+        self.monster = (monsterx, monsterz)
+        self.goal = (goalx, goalz)
+        self.index = dict()     # key = (tilex, tilez), value = (where the data starts, length)
+        self.mapFile.seek(indexStart)
+        entrySize = struct.calcsize(self.INDEX_FORMAT)
+        indexData = self.mapFile.read(numTiles * entrySize)
+        for entry in range(numTiles):
+            (tilex, tilez, offset, length) = struct.unpack_from(self.INDEX_FORMAT, indexData, entry * entrySize)
+            self.index[(tilex, tilez)] = (offset, length)
+        self.tiles = collections.OrderedDict()  # key = (tilex, tilez), value = frozenset of wall cells, oldest first
+        self.lastKey = None
+        self.lastTile = None
+        self.loadCount = 0
+
+    # returns the wall cells of a tile, as a frozenset of (x, z)
+    def getTile (self, tilex, tilez):
+        key = (tilex, tilez)
+        # collision tests look at the same tile many times in a row
+        if key == self.lastKey:
+            return self.lastTile
+        if key in self.tiles:
+            tile = self.tiles.pop(key)
+        elif key in self.index:
+            tile = self.readTile(tilex, tilez)
+            while len(self.tiles) >= self.maxTiles:
+                self.tiles.popitem(False)
+        else:
+            tile = frozenset()
+        if key in self.index:
+            self.tiles[key] = tile
+        self.lastKey = key
+        self.lastTile = tile
+        return tile
+
+    def readTile (self, tilex, tilez):
+        (offset, length) = self.index[(tilex, tilez)]
+        self.mapFile.seek(offset)
+        rows = zlib.decompress(self.mapFile.read(length))
+        tileSize = self.tileSize
+        left = tilex * tileSize
+        top = tilez * tileSize
+        walls = []
+        position = rows.find('X')
+        while position >= 0:
+            walls.append((left + position % tileSize, top + position // tileSize))
+            position = rows.find('X', position + 1)
+        self.loadCount += 1
+        return frozenset(walls)
+
+    def isWall (self, cellx, cellz):
+        return (cellx, cellz) in self.getTile(cellx // self.tileSize, cellz // self.tileSize)
+
+    # so that a TiledMap can stand in for the set of wall cells of a WallGrid
+    def __contains__ (self, cell):
+        return self.isWall(*cell)
+
+    # returns the keys of the tiles with walls that come within radius of the point (x, z), nearest first
+    def tilesNear (self, x, z, radius):
+        tileSize = self.tileSize
+        tiles = []
+        for tilez in range(int(math.floor((z - radius) / tileSize)), int(math.floor((z + radius) / tileSize)) + 1):
+            for tilex in range(int(math.floor((x - radius) / tileSize)), int(math.floor((x + radius) / tileSize)) + 1):
+                if (tilex, tilez) not in self.index:
+                    continue
+                # distance from the point to the nearest point of the tile
+                dx = max(tilex * tileSize - x, 0, x - (tilex + 1) * tileSize)
+                dz = max(tilez * tileSize - z, 0, z - (tilez + 1) * tileSize)
+                distance = math.sqrt(dx * dx + dz * dz)
+                if distance <= radius:
+                    tiles.append((distance, (tilex, tilez)))
+        tiles.sort()
+        return [key for (distance, key) in tiles]
+
+    def close (self):
+        self.mapFile.close()
+        self.tiles = collections.OrderedDict()
+        self.lastKey = None
+        self.lastTile = None
+
+# returns True if filename is a tiled map made by convertMap
+def isTiledMap(filename):
+    mapFile = open(filename, 'rb')
+    magic = mapFile.read(len(TiledMap.magic))
+    mapFile.close()
+    return magic == TiledMap.magic
+
+# Converts a text map (like map.txt) to a tiled map file.
+# The text map is read tileSize rows at a time, so a map of any size can be converted.
+def convertMap(textFilename, tiledFilename, tileSize=32):
+    textFile = open(textFilename, 'r')
+    tiledFile = open(tiledFilename, 'wb')
+    tiledFile.write("\0" * struct.calcsize(TiledMap.HEADER_FORMAT))
+    index = []
+    markers = dict()
+    width = 0
+    height = 0
+    # cells start from 1 on both axes, so the first band of tiles has one row fewer and
+    # every row is shifted one character to the right
+    band = ["." * tileSize]
+    tilez = 0
+    for line in textFile:
+        line = line.rstrip("\r\n")
+        height += 1
+        width = max(width, len(line))
+        for marker in "SMW":
+            position = line.find(marker)
+            if position >= 0:
+                markers[marker] = (position + 1, height)
+        band.append("." + line.replace("S", ".").replace("M", ".").replace("W", "."))
+        if len(band) == tileSize:
+            index.extend(_writeTileBand(tiledFile, band, tilez, tileSize))
+            band = []
+            tilez += 1
+    if len(band) > 0:
+        index.extend(_writeTileBand(tiledFile, band, tilez, tileSize))
+    textFile.close()
+    for marker in "SMW":
+        if marker not in markers:
+            raise ValueError(textFilename + " has no " + marker)
+    indexStart = tiledFile.tell()
+    for entry in index:
+        tiledFile.write(struct.pack(TiledMap.INDEX_FORMAT, *entry))
+    tiledFile.seek(0)
+    tiledFile.write(struct.pack(TiledMap.HEADER_FORMAT, TiledMap.magic, TiledMap.version, width, height, tileSize,
+                                len(index), indexStart, markers['S'][0], markers['S'][1], markers['M'][0],
+                                markers['M'][1], markers['W'][0], markers['W'][1]))
+    tiledFile.close()
+
+# writes the tiles of tileSize rows of a text map and returns their index entries
+def _writeTileBand(tiledFile, band, tilez, tileSize):
+    band = band + [""] * (tileSize - len(band))
+    bandWidth = max([len(row) for row in band])
+    entries = []
+    for tilex in range((bandWidth + tileSize - 1) // tileSize):
+        left = tilex * tileSize
+        rows = "".join([row[left:left + tileSize].ljust(tileSize, ".") for row in band])
+        if "X" not in rows:
+            continue
+        data = zlib.compress(rows)
+        entries.append((tilex, tilez, tiledFile.tell(), len(data)))
+        tiledFile.write(data)
+    return entries
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print "usage: python maze.py map.txt map.tiles [tile size]"
+        sys.exit(1)
+    if len(sys.argv) == 4:
+        convertMap(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    else:
+        convertMap(sys.argv[1], sys.argv[2])
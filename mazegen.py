@@ -0,0 +1,204 @@
+# Makes maze maps in the format of map.txt at any size, to test the game on much larger maps:
+#   X wall   . floor   S start   M monster   W goal
+# Each generator returns the map as a list of rows (lists of characters) with walls all around,
+# and placeMarkers puts S, W and M on floor cells that are connected to each other.
+# From the command line:
+#   python mazegen.py backtracker 1010 1020 bigmaze.txt --seed 1
+import argparse, collections, random
+
+
+# A perfect maze made by a depth first walk over a grid of corridor cells, with corridors
+# corridorWidth cells wide and walls one cell thick, like map.txt.
+# density is the fraction of the walls between corridors that stay: 1 makes a maze with
+# exactly one way between any two places, lower values open up loops.
+def recursiveBacktracker(width, height, density=1.0, randomizer=random, corridorWidth=4):
+    rows = [['X'] * width for z in range(height)]
+    step = corridorWidth + 1
+    cellsx = max((width - 1) // step, 1)
+    cellsz = max((height - 1) // step, 1)
+
+    def carve(left, top, cellWidth, cellHeight):
+        for z in range(top, min(top + cellHeight, height - 1)):
+            for x in range(left, min(left + cellWidth, width - 1)):
+                rows[z][x] = '.'
+
+    # opens the wall between a corridor cell and the one to its right (dx=1) or below (dz=1)
+    def openWall(cellx, cellz, dx, dz):
+        if dx == 1:
+            carve(1 + cellx*step + corridorWidth, 1 + cellz*step, 1, corridorWidth)
+        else:
+            carve(1 + cellx*step, 1 + cellz*step + corridorWidth, corridorWidth, 1)
+
+    for cellz in range(cellsz):
+        for cellx in range(cellsx):
+            carve(1 + cellx*step, 1 + cellz*step, corridorWidth, corridorWidth)
+
+    # the walk keeps its own stack, since large maps are far deeper than Python's recursion limit
+    opened = set()
+    visited = set([(0, 0)])
+    stack = [(0, 0)]
+    while len(stack) > 0:
+        (cellx, cellz) = stack[-1]
+        neighbors = [(cellx + dx, cellz + dz) for (dx, dz) in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                     if 0 <= cellx + dx < cellsx and 0 <= cellz + dz < cellsz and (cellx + dx, cellz + dz) not in visited]
+        if len(neighbors) == 0:
+            stack.pop()
+            continue
+        (nextx, nextz) = randomizer.choice(neighbors)
+        (firstx, firstz) = (min(cellx, nextx), min(cellz, nextz))
+        openWall(firstx, firstz, abs(nextx - cellx), abs(nextz - cellz))
+        opened.add((firstx, firstz, abs(nextx - cellx)))
+        visited.add((nextx, nextz))
+        stack.append((nextx, nextz))
+
+    if density < 1:
+        for cellz in range(cellsz):
+            for cellx in range(cellsx):
+                for (dx, dz) in ((1, 0), (0, 1)):
+                    if (cellx + dx < cellsx and cellz + dz < cellsz and (cellx, cellz, dx) not in opened
+                            and randomizer.random() >= density):
+                        openWall(cellx, cellz, dx, dz)
+    return rows
+
+# Rectangular rooms joined by corridors two cells wide.
+# density is the fraction of the map that is covered by rooms (before the corridors are dug),
+# rooms are placed at random until they cover that much or no more of them fit.
+def roomsAndCorridors(width, height, density=0.4, randomizer=random, minRoomSize=4, maxRoomSize=20):
+    rows = [['X'] * width for z in range(height)]
+    taken = [[False] * width for z in range(height)]
+    maxRoomSize = max(min(maxRoomSize, width - 3, height - 3), minRoomSize)
+    rooms = []
+    area = 0
+    failures = 0
+    while area < density * (width - 2) * (height - 2) and failures < 200:
+        roomWidth = randomizer.randint(minRoomSize, maxRoomSize)
+        roomHeight = randomizer.randint(minRoomSize, maxRoomSize)
+        if roomWidth > width - 3 or roomHeight > height - 3:
+            break
+        left = randomizer.randint(1, width - roomWidth - 2)
+        top = randomizer.randint(1, height - roomHeight - 2)
+        # rooms keep at least one wall cell between them
+        if any([any(taken[z][left - 1:left + roomWidth + 1]) for z in range(top - 1, top + roomHeight + 1)]):
+            failures += 1
+            continue
+        failures = 0
+        for z in range(top, top + roomHeight):
+            taken[z][left:left + roomWidth] = [True] * roomWidth
+            rows[z][left:left + roomWidth] = ['.'] * roomWidth
+        rooms.append((left + roomWidth // 2, top + roomHeight // 2))
+        area += roomWidth * roomHeight
+
+    def carve(x, z):
+        if 1 <= x < width - 1 and 1 <= z < height - 1:
+            rows[z][x] = '.'
+
+    # joins the rooms in a snake through bands of the map, so that neighbors in the order are close
+    band = 2 * maxRoomSize
+    rooms.sort(key=lambda (x, z): (z // band, x if (z // band) % 2 == 0 else -x))
+    for index in range(1, len(rooms)):
+        ((fromx, fromz), (tox, toz)) = (rooms[index - 1], rooms[index])
+        for x in range(min(fromx, tox), max(fromx, tox) + 1):
+            carve(x, fromz)
+            carve(x, fromz + 1)
+        for z in range(min(fromz, toz), max(fromz, toz) + 1):
+            carve(tox, z)
+            carve(tox + 1, z)
+    return rows
+
+# An open floor with single wall cells scattered over it, density is the chance of each cell being a wall.
+def openField(width, height, density=0.1, randomizer=random):
+    rows = [['X'] * width for z in range(height)]
+    for z in range(1, height - 1):
+        for x in range(1, width - 1):
+            if randomizer.random() >= density:
+                rows[z][x] = '.'
+    return rows
+
+# generator, default density
+GENERATORS = collections.OrderedDict([("backtracker", (recursiveBacktracker, 1.0)),
+                                      ("rooms", (roomsAndCorridors, 0.4)),
+                                      ("field", (openField, 0.1))])
+
+
+# returns a dict with the distance in steps from (x, z) to every floor cell that can be reached from it
+def floorDistances(rows, x, z):
+    distances = {(x, z): 0}
+    queue = collections.deque([(x, z)])
+    while len(queue) > 0:
+        (cellx, cellz) = queue.popleft()
+        distance = distances[(cellx, cellz)] + 1
+        for (nextx, nextz) in ((cellx+1, cellz), (cellx-1, cellz), (cellx, cellz+1), (cellx, cellz-1)):
+            if rows[nextz][nextx] != 'X' and (nextx, nextz) not in distances:
+                distances[(nextx, nextz)] = distance
+                queue.append((nextx, nextz))
+    return distances
+
+# Puts the start and the goal at the two ends of a long path, and the monster halfway between them.
+# The path is found from a floor cell in a region holding at least half of the floor,
+# so a few cells walled in by chance do not end up holding the whole game.
+def placeMarkers(rows, randomizer=random):
+    floor = [(x, z) for z in range(len(rows)) for x in range(len(rows[z])) if rows[z][x] == '.']
+    if len(floor) < 3:
+        raise ValueError("the map needs at least 3 floor cells")
+    region = None
+    for attempt in range(10):
+        distances = floorDistances(rows, *randomizer.choice(floor))
+        if len(distances) >= 3 and (region is None or len(distances) > len(region)):
+            region = distances
+        if len(distances) * 2 >= len(floor):
+            break
+    # only tiny regions were picked, so look through all of the floor for one that is big enough
+    if region is None:
+        seen = set()
+        for cell in floor:
+            if cell not in seen:
+                distances = floorDistances(rows, *cell)
+                if len(distances) >= 3:
+                    region = distances
+                    break
+                seen.update(distances)
+    if region is None:
+        raise ValueError("the map is too dense, no 3 floor cells are connected")
+    distances = region
+    # the farthest cell from anywhere is one end of a long path, and the farthest cell from it the other
+    start = max(distances, key=distances.get)
+    distances = floorDistances(rows, *start)
+    goal = max(distances, key=distances.get)
+    halfway = distances[goal] // 2
+    monster = min([cell for cell in distances if cell != start and cell != goal],
+                  key=lambda cell: abs(distances[cell] - halfway))
+    for ((x, z), marker) in ((start, 'S'), (goal, 'W'), (monster, 'M')):
+        rows[z][x] = marker
+    return rows
+
+# returns a finished map as a list of rows, style is one of the names in GENERATORS
+def generateMap(style, width, height, density=None, seed=None):
+    if style not in GENERATORS:
+        raise ValueError("unknown map style: " + str(style) + ", use one of " + ", ".join(GENERATORS))
+    if width < 7 or height < 7:
+        raise ValueError("maps have to be at least 7 by 7 cells")
+    (generator, defaultDensity) = GENERATORS[style]
+    if density is None:
+        density = defaultDensity
+    randomizer = random.Random(seed)
+    rows = generator(width, height, density, randomizer)
+    return placeMarkers(rows, randomizer)
+
+def saveMap(rows, filename):
+    mapFile = open(filename, "w")
+    for row in rows:
+        mapFile.write("".join(row) + "\n")
+    mapFile.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a maze map in the format of map.txt.")
+    parser.add_argument("style", choices=list(GENERATORS))
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("filename")
+    parser.add_argument("--density", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    arguments = parser.parse_args()
+    saveMap(generateMap(arguments.style, arguments.width, arguments.height, arguments.density, arguments.seed),
+            arguments.filename)
@@ -0,0 +1,70 @@
+# The rendered text cache shared by graphics.py and graphics3d.py.
+import collections
+
+# An LRU cache of rendered text surfaces, so text that is drawn every frame is only rendered once.
+# Entries are keyed by (text, fontSignature, color, opacity) and the oldest ones are
+# dropped when the surfaces take more than maxBytes.  Sizes are remembered separately
+# by (text, fontSignature), because the size of text does not depend on its color.
+class RenderedTextCache:
+    def __init__(self, maxBytes=4*1024*1024, maxSizes=4096):
+        self.maxBytes = maxBytes
+        self.maxSizes = maxSizes
+        self.surfaces = collections.OrderedDict()  # key = (text, fontSignature, color, opacity), value = (surface, bytes)
+        self.sizes = collections.OrderedDict()     # key = (text, fontSignature), value = (width, height)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.sizeHits = 0
+        self.sizeMisses = 0
+
+    # returns the surface for text, rendering it with font only if it is not in the cache
+    def getSurface(self, font, fontSignature, text, color, opacity=None):
+        color = tuple(color)
+        key = (text, fontSignature, color, opacity)
+        if key in self.surfaces:
+            self.hits += 1
+            entry = self.surfaces.pop(key)
+            self.surfaces[key] = entry
+            return entry[0]
+        self.misses += 1
+        textimage = font.render(text, False, color)
+        if opacity is not None:
+            textimage.set_alpha(opacity)
+        size = textimage.get_width() * textimage.get_height() * textimage.get_bytesize()
+        self.surfaces[key] = (textimage, size)
+        self.bytes += size
+        while self.bytes > self.maxBytes and len(self.surfaces) > 1:
+            (oldKey, (oldImage, oldSize)) = self.surfaces.popitem(False)
+            self.bytes -= oldSize
+        self.rememberSize(text, fontSignature, (textimage.get_width(), textimage.get_height()))
+        return textimage
+
+    # returns the (width, height) of text, measuring it with font only if it was never measured or rendered
+    def getSize(self, font, fontSignature, text):
+        key = (text, fontSignature)
+        if key in self.sizes:
+            self.sizeHits += 1
+            size = self.sizes.pop(key)
+            self.sizes[key] = size
+            return size
+        self.sizeMisses += 1
+        size = tuple(font.size(text))
+        self.rememberSize(text, fontSignature, size)
+        return size
+
+    def rememberSize(self, text, fontSignature, size):
+        key = (text, fontSignature)
+        if key in self.sizes:
+            del self.sizes[key]
+        self.sizes[key] = size
+        if len(self.sizes) > self.maxSizes:
+            self.sizes.popitem(False)
+
+    def clear(self):
+        self.surfaces.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.surfaces), 'bytes': self.bytes,
+                'sizeHits': self.sizeHits, 'sizeMisses': self.sizeMisses, 'sizeEntries': len(self.sizes)}